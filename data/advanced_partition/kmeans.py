@@ -1,12 +1,16 @@
 import h5py
 import argparse
+import hashlib
 import os
 import pickle
 import json
+import numpy as np
 from sentence_transformers import SentenceTransformer   
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.model_selection import train_test_split
 
+from data.raw_data_loader.base.columnar import INDEX_KEY, is_columnar, read_columns
+
 def get_embedding_Kmeans(embedding_exist,corpus, N_clients, bsz=16):
     embedding_data = {}
     corpus_embeddings = []
@@ -30,6 +34,146 @@ def get_embedding_Kmeans(embedding_exist,corpus, N_clients, bsz=16):
 
 
 
+CORPUS_FIELDS = {
+    'name_entity_recognition': ['X'],
+    'reading_comprehension': ['context_X', 'question_X', 'Y'],
+    'sequence_to_sequence': ['Y'],
+}
+
+
+def corpus_texts(task_type, columns):
+    """Texts to embed from the columns of a chunk of samples, the same as the in-memory corpus."""
+    if task_type == 'name_entity_recognition':
+        return [" ".join(sentence) for sentence in columns['X']]
+    elif task_type == 'reading_comprehension':
+        return [" ".join([question, context[answer[0]: answer[1]]]) for context, question, answer in
+                zip(columns['context_X'], columns['question_X'], columns['Y'])]
+    elif task_type == 'sequence_to_sequence':
+        return list(columns['Y'])
+    return list(columns['X'])
+
+
+def _read_legacy_chunk(f, field_names, index_list):
+    columns = {}
+    for name in field_names:
+        values = [f[name][str(i)][()] for i in index_list]
+        if len(values) > 0 and isinstance(values[0], bytes):
+            values = [v.decode('UTF-8') for v in values]
+        elif len(values) > 0 and isinstance(values[0], np.ndarray) and values[0].dtype.kind == 'O':
+            values = [[t.decode('UTF-8') for t in v] for v in values]
+        columns[name] = values
+    return columns
+
+
+def read_corpus_chunks(f, task_type, chunk_size):
+    """Yield (sample indexes, texts) of chunk_size samples at a time, in ascending sample index order."""
+    field_names = CORPUS_FIELDS.get(task_type, ['X'])
+    if is_columnar(f):
+        index = f[INDEX_KEY][()]
+    else:
+        index = np.array(sorted(int(i) for i in f[field_names[0]].keys()), dtype=np.int64)
+    for start in range(0, len(index), chunk_size):
+        index_chunk = index[start: start + chunk_size]
+        if is_columnar(f):
+            columns = read_columns(f, field_names, index_chunk,
+                                   rows=np.arange(start, start + len(index_chunk)))
+        else:
+            columns = _read_legacy_chunk(f, field_names, index_chunk)
+        yield index_chunk, corpus_texts(task_type, columns)
+
+
+def embedding_meta(data_file, task_type, sample_index):
+    """What the embeddings depend on: the data file content, the task type and the sample index of every row."""
+    sha1 = hashlib.sha1()
+    with open(data_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            sha1.update(block)
+    return {'data_sha1': sha1.hexdigest(), 'task_type': task_type,
+            'sample_index': np.asarray(sample_index, dtype=np.int64)}
+
+
+def same_embedding_meta(meta, expected):
+    return meta is not None and meta['data_sha1'] == expected['data_sha1'] and \
+        meta['task_type'] == expected['task_type'] and np.array_equal(meta['sample_index'], expected['sample_index'])
+
+
+def stream_embeddings(f, task_type, embedding_file, chunk_size, bsz=16, device=None):
+    """
+    Encode the corpus chunk by chunk into a float16 .npy file, row i is the i-th sample in ascending index order.
+    The embedding_meta of the embeddings is kept in <embedding_file>.meta, an existing embedding file is only
+    reused if it was computed from the same data file, task type and samples. Returns the memory-mapped
+    embeddings and the sample index of every row.
+    """
+    sample_index = f[INDEX_KEY][()] if is_columnar(f) else np.array(
+        sorted(int(i) for i in f[CORPUS_FIELDS.get(task_type, ['X'])[0]].keys()), dtype=np.int64)
+    meta = embedding_meta(f.filename, task_type, sample_index)
+    meta_file = embedding_file + '.meta'
+    if os.path.exists(embedding_file):
+        existing_meta = None
+        if os.path.exists(meta_file):
+            with open(meta_file, 'rb') as meta_f:
+                existing_meta = pickle.load(meta_f)
+        if same_embedding_meta(existing_meta, meta):
+            print("use the existing embedding file %s" % embedding_file)
+            return np.load(embedding_file, mmap_mode='r'), sample_index
+        print("the existing embedding file %s is not of these samples, computing it again" % embedding_file)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    embedder = SentenceTransformer('distilbert-base-nli-stsb-mean-tokens', device=device)
+    embeddings = np.lib.format.open_memmap(
+        embedding_file, mode='w+', dtype=np.float16,
+        shape=(len(sample_index), embedder.get_sentence_embedding_dimension()))
+    row = 0
+    for index_chunk, texts in read_corpus_chunks(f, task_type, chunk_size):
+        embeddings[row: row + len(texts)] = embedder.encode(texts, batch_size=bsz).astype(np.float16)
+        row += len(texts)
+        print("embedded %d / %d" % (row, len(sample_index)))
+    embeddings.flush()
+    # written last, an interrupted run leaves no meta and is not reused
+    with open(meta_file, 'wb') as meta_f:
+        pickle.dump(meta, meta_f, pickle.HIGHEST_PROTOCOL)
+    return np.load(embedding_file, mmap_mode='r'), sample_index
+
+
+def streaming_kmeans(embeddings, n_clusters, chunk_size, epochs=1, seed=0):
+    """Mini-batch k-means over chunks of the memory-mapped embeddings, only one chunk is in memory at a time."""
+    clustering_model = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed)
+    # the first partial_fit needs at least n_clusters samples
+    chunk_size = max(chunk_size, n_clusters)
+    for epoch in range(epochs):
+        for start in range(0, len(embeddings), chunk_size):
+            clustering_model.partial_fit(np.asarray(embeddings[start: start + chunk_size], dtype=np.float32))
+        print("kmeans epoch %d done" % epoch)
+    cluster_assignment = np.zeros(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), chunk_size):
+        cluster_assignment[start: start + chunk_size] = clustering_model.predict(
+            np.asarray(embeddings[start: start + chunk_size], dtype=np.float32))
+    return cluster_assignment
+
+
+def write_partition(partition_file, cluster_number, cluster_assignment, train_index_list, test_index_list):
+    """cluster_assignment[index] is the cluster of the sample index, the clusters are the clients."""
+    partition = h5py.File(partition_file, "a")
+    prefix = '/kmeans_clusters=%d' % cluster_number
+    if prefix in partition:
+        del partition[prefix]
+
+    partition[prefix + '/n_clients'] = cluster_number
+    partition[prefix + '/client_assignment'] = cluster_assignment
+
+    split_indexes = []
+    for index_list in [train_index_list, test_index_list]:
+        index_list = np.asarray(index_list, dtype=np.int64)
+        clusters = np.asarray(cluster_assignment)[index_list]
+        order = np.argsort(clusters, kind='stable')
+        split_indexes.append(np.split(index_list[order], np.cumsum(np.bincount(clusters,
+                                                                             minlength=cluster_number))[:-1]))
+    for i in range(cluster_number):
+        partition[prefix + '/partition_data/' + str(i) + '/train/'] = split_indexes[0][i]
+        partition[prefix + '/partition_data/' + str(i) + '/test/'] = split_indexes[1][i]
+    partition.close()
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -54,8 +198,26 @@ def main():
     parser.add_argument('--overwrite', action='store_false',default=True,
                             help='True if embedding data file does not exist False if it does exist')
 
+    parser.add_argument('--streaming', action='store_true',
+                        help='read the texts in chunks, keep the embeddings in a float16 .npy file (--embedding_file) '
+                             'and cluster with mini-batch k-means, with bounded memory')
+
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                        help='number of samples per chunk of the streaming mode')
+
+    parser.add_argument('--kmeans_epochs', type=int, default=3,
+                        help='passes of mini-batch k-means over the embeddings in the streaming mode')
+
+    parser.add_argument('--device', type=str, default=None,
+                        help='device of sentenceBERT in the streaming mode, e.g. cpu or cuda:0')
+
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the streaming mode')
+
     # add a stroe_true for --overwrite 
     args = parser.parse_args()
+    if args.streaming:
+        streaming_main(args)
+        return
     N_Clients = args.cluster_number
     print("start reading data")
     f = h5py.File(args.data_file,"r")
@@ -70,36 +232,15 @@ def main():
         train_index_list = attributes['train_index_list']
         print(len(train_index_list))
     
+    # the texts in ascending sample index order, from the columnar or the legacy layout
     corpus = []
-    if args.task_type == 'name_entity_recognition': # specifically wnut and wikiner datesets
-        for i in f['X'].keys():
-            sentence = f['X'][i][()]
-            sentence = [i.decode('UTF-8') for i in sentence]
-            corpus.append(" ".join(sentence))
-
-    elif args.task_type == 'reading_comprehension': # specifically Squad1.1 dataset
-        for i in f['context_X'].keys():
-            question_components = []
-            # context = f['context_X'][i][()].decode('UTF-8')
-            question = f['question_X'][i][()].decode('UTF-8')
-            answer_start = f['Y'][i][()][0]
-            answer_end = f['Y'][i][()][1]
-            answer = f['context_X'][i][()].decode('UTF-8')[answer_start : answer_end]
-
-            question_components.append(question)
-            question_components.append(answer)
-            corpus.append(" ".join(question_components))
-
-    elif args.task_type == 'sequence_to_sequence':
-        for i in f['Y'].keys():
-            sentence = f['Y'][i][()].decode('UTF-8')
-            corpus.append(sentence)
-            
-    else:
-        for i in f['X'].keys():
-            sentence = f['X'][i][()].decode('UTF-8')
-            corpus.append(sentence)
+    sample_index = []
+    for index_chunk, texts in read_corpus_chunks(f, args.task_type, args.chunk_size):
+        sample_index.extend(index_chunk.tolist())
+        corpus.extend(texts)
     f.close()
+    # the rows of the embeddings follow sample_index, it is stored with them
+    meta = embedding_meta(args.data_file, args.task_type, sample_index)
 
     print("start process embedding data and kmeans partition")
     cluster_assignment = []
@@ -108,58 +249,55 @@ def main():
         cluster_assignment, corpus_embedding = get_embedding_Kmeans(False,corpus, N_Clients, args.bsz)
         embedding_data = {}
         embedding_data['data'] = corpus_embedding
+        embedding_data['meta'] = meta
         with open(args.embedding_file,'wb') as f:
             pickle.dump(embedding_data, f, pickle.HIGHEST_PROTOCOL)
     else:
         with open(args.embedding_file,'rb') as f:
             embedding_data = pickle.load(f)
+            if not same_embedding_meta(embedding_data.get('meta'), meta):
+                raise Exception("%s was not computed from the samples of %s for %s (or by an older version whose "
+                                "rows are in another order), use --overwrite to compute it again" % (
+                                    args.embedding_file, args.data_file, args.task_type))
             embedding_data = embedding_data['data']
             if isinstance(embedding_data,dict):
                 embedding_data = embedding_data['data']
             cluster_assignment, corpus_embedding = get_embedding_Kmeans(True,embedding_data, N_Clients, args.bsz)
 
 
-    print("start insert data")
-    partition_pkl_train = {}
-    partition_pkl_test = {}
+    # cluster_assignment[i] is the cluster of the i-th text, write_partition indexes it by sample index
+    row_assignment = np.asarray(cluster_assignment)
+    cluster_assignment = np.zeros(max(sample_index) + 1 if len(sample_index) > 0 else 0, dtype=np.int64)
+    cluster_assignment[sample_index] = row_assignment
 
-    for cluster_id in range(N_Clients):
-        partition_pkl_train[cluster_id] = []
-        partition_pkl_test[cluster_id] = []
-    
-    for index in train_index_list:
-        idx = cluster_assignment[index]
-        if idx in partition_pkl_train :
-            partition_pkl_train[idx].append(index)
-        else:
-            partition_pkl_train[idx] = [index]
+    print("store kmeans partition to file")
+    write_partition(args.partition_file, args.cluster_number, cluster_assignment, train_index_list, test_index_list)
 
-    for index in test_index_list:
-        idx = cluster_assignment[index]
-        if idx in partition_pkl_test :
-            partition_pkl_test[idx].append(index)
-        else:
-            partition_pkl_test[idx] = [index]
 
+def streaming_main(args):
+    print("start reading data")
+    f = h5py.File(args.data_file, "r")
+    attributes = json.loads(f["attributes"][()])
+    train_index_list = attributes.get('train_index_list', [])
+    test_index_list = attributes.get('test_index_list', [])
+    if not args.overwrite and os.path.exists(args.embedding_file):
+        os.remove(args.embedding_file)
+
+    print("start process embedding data")
+    embeddings, sample_index = stream_embeddings(f, args.task_type, args.embedding_file, args.chunk_size,
+                                                 args.bsz, args.device)
+    f.close()
+
+    print("start Kmeans")
+    row_assignment = streaming_kmeans(embeddings, args.cluster_number, args.chunk_size, args.kmeans_epochs,
+                                      args.seed)
+    print("end Kmeans")
+    cluster_assignment = np.zeros(int(sample_index.max()) + 1 if len(sample_index) > 0 else 0, dtype=np.int64)
+    cluster_assignment[sample_index] = row_assignment
 
     print("store kmeans partition to file")
-    partition = ""
-    partition = h5py.File(args.partition_file,"a")
-    if '/kmeans_clusters=%d'%args.cluster_number in partition:
-        del partition['/kmeans_clusters=%d'%args.cluster_number]
-
-    partition['/kmeans_clusters=%d'%args.cluster_number+'/n_clients'] = args.cluster_number
-    partition['/kmeans_clusters=%d'%args.cluster_number+'/client_assignment'] = cluster_assignment
-
-    for i in sorted(partition_pkl_train.keys()):
-        train = partition_pkl_train[i]
-        test = partition_pkl_test[i]
-        train_path = '/kmeans_clusters=%d'%args.cluster_number+'/partition_data/'+str(i)+'/train/'
-        test_path = '/kmeans_clusters=%d'%args.cluster_number+'/partition_data/'+str(i)+'/test/'
-        partition[train_path] = train
-        partition[test_path] = test
-    
-    partition.close()
+    write_partition(args.partition_file, args.cluster_number, cluster_assignment, train_index_list, test_index_list)
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
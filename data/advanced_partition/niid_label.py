@@ -7,7 +7,8 @@ import math
 from decimal import *
 import random
 from collections import Counter
-from numpy.lib.shape_base import split
+
+from data.raw_data_loader.base.columnar import is_columnar, read_columns
 
 
 def dynamic_batch_fill(label_index_tracker, label_index_matrix,
@@ -90,6 +91,83 @@ def dynamic_batch_fill(label_index_tracker, label_index_matrix,
     return label_index_offset
 
 
+def _client_lengths(client_num, data_length):
+    # every client gets data_length / client_num samples, the last one also gets the remainder
+    client_lengths = np.zeros(client_num, dtype=np.int64)
+    each_client_index_length = int(data_length / client_num)
+    total_index = data_length
+    for client_id in range(client_num):
+        client_length = min(each_client_index_length, total_index)
+        if total_index < client_length * 2:
+            client_length = total_index
+        total_index -= client_length
+        client_lengths[client_id] = client_length
+    return client_lengths
+
+
+def _client_label_offsets(proportions, client_lengths):
+    """
+    Number of samples of each label for each client: round(proportion * client length), cut off once the
+    client is full, the last label takes the rest of the client.
+    """
+    offsets = np.round(proportions * client_lengths[:, None]).astype(np.int64)
+    filled = np.minimum(np.cumsum(offsets, axis=1), client_lengths[:, None])
+    offsets = np.diff(filled, axis=1, prepend=0)
+    offsets[:, -1] = client_lengths - filled[:, -2] if offsets.shape[1] > 1 else client_lengths
+    return offsets
+
+
+def _fill_client_segments(client_offsets, label_index_tracker, label_index_matrix):
+    """
+    Take the samples of one client whose offsets exceed the remaining samples of some label: the missing samples are
+    taken from the other labels by dynamic_batch_fill. Returns the (label, start, end) segments in order.
+    """
+    segments = []
+    for label_id, offset in enumerate(client_offsets):
+        start = int(label_index_tracker[label_id])
+        end = start + int(offset)
+        label_data_length = len(label_index_matrix[label_id])
+        if end > label_data_length:
+            segments.append((label_id, start, label_data_length))
+            label_index_tracker[label_id] = label_data_length
+            label_index_offset = dynamic_batch_fill(
+                label_index_tracker, label_index_matrix,
+                end - label_data_length, label_id)
+            for fill_label_id in label_index_offset.keys():
+                start = int(label_index_tracker[fill_label_id])
+                end = start + int(label_index_offset[fill_label_id])
+                segments.append(_clip_segment(fill_label_id, start, end, len(label_index_matrix[fill_label_id])))
+                label_index_tracker[fill_label_id] = end
+        else:
+            segments.append(_clip_segment(label_id, start, end, label_data_length))
+            label_index_tracker[label_id] = end
+    return segments
+
+
+def _clip_segment(label_id, start, end, label_data_length):
+    # same as slicing a python list: the tracker of a label may run past its end
+    start = min(max(start, 0), label_data_length)
+    return label_id, start, min(max(end, start), label_data_length)
+
+
+def _label_ids(label_vocab, label_assignment):
+    """Position of every label in label_vocab, len(label_vocab) for labels that are not in it."""
+    label_num = len(label_vocab)
+    label_assignment = np.asarray(label_assignment)
+    vocab_array = np.asarray(label_vocab)
+    if label_assignment.dtype.kind in "iu" and vocab_array.dtype.kind in "iu" and len(label_assignment) > 0 and \
+            vocab_array.min() >= 0 and label_assignment.min() >= 0 and vocab_array.max() < len(label_assignment):
+        # integer labels (e.g. k-means clusters): look them up in a table
+        table = np.full(max(vocab_array.max(), label_assignment.max()) + 1, label_num, dtype=np.int64)
+        table[vocab_array[::-1]] = np.arange(label_num - 1, -1, -1)
+        return table[label_assignment]
+    sorter = np.argsort(vocab_array, kind="stable")
+    positions = np.minimum(np.searchsorted(vocab_array, label_assignment, sorter=sorter), label_num - 1)
+    label_ids = sorter[positions]
+    label_ids[vocab_array[label_ids] != label_assignment] = label_num
+    return label_ids
+
+
 def label_skew_process(label_vocab, label_assignment, client_num, alpha,
                        data_length):
     """
@@ -102,95 +180,93 @@ def label_skew_process(label_vocab, label_assignment, client_num, alpha,
     -------------------------------------------------------------------
     return 
     ------------------------------------------------------------------
-    partition_result : 2d array list of partition index of each client 
+    partition_result : list of 1d int64 arrays, partition index of each client
     ------------------------------------------------------------------
+    The samples of each label are shuffled, every client draws its label proportions from Dir(alpha * p) and takes the
+    next samples of each label. The allocation of all the clients is computed with cumulative sums over the clients;
+    only the clients that ask for more samples of a label than are left are filled one by one with dynamic_batch_fill.
+    Draws the same random numbers as the former loop over clients and labels, so the result is the same under a seed.
     """
-    label_index_matrix = [[] for _ in label_vocab]
-    label_proportion = []
-    partition_result = [[] for _ in range(client_num)]
-    client_length = 0
+    label_vocab = list(label_vocab)
+    label_num = len(label_vocab)
     print("client_num", client_num)
-    # shuffle indexs and calculate each label proportion of the dataset
-    for index, value in enumerate(label_vocab):
-        label_location = np.where(label_assignment == value)[0]
-        label_proportion.append(len(label_location) / data_length)
-        np.random.shuffle(label_location)
-        label_index_matrix[index].extend(label_location[:])
-    print(label_proportion)
+    # group the indexes by label with one stable sort and shuffle the indexes of each label
+    label_ids = _label_ids(label_vocab, label_assignment)
+    label_counts = np.bincount(label_ids, minlength=label_num + 1)[:label_num]
+    # a stable sort of small integers is a radix sort
+    grouped_index = np.argsort(label_ids.astype(np.uint16 if label_num < (1 << 16) - 1 else np.int64),
+                               kind="stable")[:label_counts.sum()]
+    label_index_matrix = np.split(grouped_index, np.cumsum(label_counts)[:-1])
+    for label_index in label_index_matrix:
+        np.random.shuffle(label_index)
+    label_proportion = label_counts / data_length
+    print(label_proportion.tolist())
     # calculate size for each partition client
-    label_index_tracker = np.zeros(len(label_vocab), dtype=int)
-    total_index = data_length
-    each_client_index_length = int(total_index / client_num)
-    print("each index length", each_client_index_length)
-    client_dir_dis = np.array([alpha * l for l in label_proportion])
+    client_lengths = _client_lengths(client_num, data_length)
+    print("each index length", int(data_length / client_num))
+    client_dir_dis = alpha * label_proportion
     print("alpha", alpha)
     print("client dir dis", client_dir_dis)
     proportions = np.random.dirichlet(client_dir_dis)
     print("dir distribution", proportions)
-    # add all the unused data to the client
-    for client_id in range(len(partition_result)):
-        each_client_partition_result = partition_result[client_id]
-        proportions = np.random.dirichlet(client_dir_dis)
-        client_length = min(each_client_index_length, total_index)
-        if total_index < client_length * 2:
-            client_length = total_index
-        total_index -= client_length
-        client_length_pointer = client_length
-        # for each label calculate the offset length assigned to by Dir distribution and then extend assignment
-        for label_id, _ in enumerate(label_vocab):
-            offset = round(proportions[label_id] * client_length)
-            if offset >= client_length_pointer:
-                offset = client_length_pointer
-                client_length_pointer = 0
-            else:
-                if label_id == (len(label_vocab) - 1):
-                    offset = client_length_pointer
-                client_length_pointer -= offset
-
-            start = int(label_index_tracker[label_id])
-            end = int(label_index_tracker[label_id] + offset)
-            label_data_length = len(label_index_matrix[label_id])
-            # if the the label is assigned to a offset length that is more than what its remaining length
-            if end > label_data_length:
-                each_client_partition_result.extend(
-                    label_index_matrix[label_id][start:])
-                label_index_tracker[label_id] = label_data_length
-                label_index_offset = dynamic_batch_fill(
-                    label_index_tracker, label_index_matrix,
-                    end - label_data_length, label_id)
-                for fill_label_id in label_index_offset.keys():
-                    start = label_index_tracker[fill_label_id]
-                    end = (label_index_tracker[fill_label_id] +
-                           label_index_offset[fill_label_id])
-                    each_client_partition_result.extend(
-                        label_index_matrix[fill_label_id][start:end])
-                    label_index_tracker[fill_label_id] = (
-                        label_index_tracker[fill_label_id] +
-                        label_index_offset[fill_label_id])
-            else:
-                each_client_partition_result.extend(
-                    label_index_matrix[label_id][start:end])
-                label_index_tracker[
-                    label_id] = label_index_tracker[label_id] + offset
-
-        # if last client still has empty rooms, fill empty rooms with the rest of the unused data
-        if client_id == len(partition_result) - 1:
-            print("last id length", len(each_client_partition_result))
-            print("Last client fill the rest of the unfilled lables.")
-            for not_fillall_label_id in range(len(label_vocab)):
-                if label_index_tracker[not_fillall_label_id] < len(
-                        label_index_matrix[not_fillall_label_id]):
-                    print("fill more id", not_fillall_label_id)
-                    start = label_index_tracker[not_fillall_label_id]
-                    each_client_partition_result.extend(
-                        label_index_matrix[not_fillall_label_id][start:])
-                    label_index_tracker[not_fillall_label_id] = len(
-                        label_index_matrix[not_fillall_label_id])
-        partition_result[client_id] = each_client_partition_result
-
+    proportions = np.random.dirichlet(client_dir_dis, size=client_num)
+    offsets = _client_label_offsets(proportions, client_lengths)
+
+    # (client, label, start, end) of the index segments in the order they are assigned
+    segment_blocks = []
+    label_index_tracker = np.zeros(label_num, dtype=np.int64)
+    client_id = 0
+    while client_id < client_num:
+        # the clients up to the first one that runs out of some label take consecutive slices of every label
+        demand = label_index_tracker + np.cumsum(offsets[client_id:], axis=0)
+        overflow = np.flatnonzero((demand > label_counts).any(axis=1))
+        block_size = overflow[0] if len(overflow) > 0 else client_num - client_id
+        if block_size > 0:
+            ends = demand[:block_size]
+            starts = np.vstack([label_index_tracker[None, :], ends[:-1]])
+            segment_blocks.append(np.stack([
+                np.repeat(np.arange(client_id, client_id + block_size), label_num),
+                np.tile(np.arange(label_num), block_size),
+                starts.reshape(-1), ends.reshape(-1)], axis=1))
+            label_index_tracker = ends[-1].copy()
+            client_id += block_size
+        if client_id < client_num:
+            segments = _fill_client_segments(offsets[client_id], label_index_tracker, label_index_matrix)
+            segment_blocks.append(np.array([(client_id,) + segment for segment in segments], dtype=np.int64))
+            client_id += 1
+
+    # the last client fills the rest of the unfilled labels
+    print("Last client fill the rest of the unfilled lables.")
+    rest = np.flatnonzero(label_index_tracker < label_counts)
+    segment_blocks.append(np.stack([np.full(len(rest), client_num - 1), rest, label_index_tracker[rest],
+                                    label_counts[rest]], axis=1))
+    segments = np.concatenate(segment_blocks).astype(np.int64)
+
+    # gather all the segments at once and split them by client
+    label_starts = np.concatenate([[0], np.cumsum(label_counts)[:-1]]).astype(np.int64)
+    lengths = segments[:, 3] - segments[:, 2]
+    segment_offsets = np.cumsum(lengths) - lengths
+    positions = np.repeat(label_starts[segments[:, 1]] + segments[:, 2] - segment_offsets, lengths) + \
+        np.arange(lengths.sum(), dtype=np.int64)
+    client_sizes = np.bincount(segments[:, 0], weights=lengths, minlength=client_num).astype(np.int64)
+    partition_result = np.split(grouped_index[positions], np.cumsum(client_sizes)[:-1])
+    print("last id length", len(partition_result[-1]))
     return partition_result
 
 
+def read_labels(data, index_list):
+    """Labels (str, or list of str for sequence tagging) of the given samples of a data file."""
+    if is_columnar(data):
+        return read_columns(data, ["Y"], index_list)["Y"]
+    return [_decode_label(data["Y"][str(idx)][()]) for idx in index_list]
+
+
+def _decode_label(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return [token.decode("utf-8") for token in value]
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -297,17 +373,9 @@ def main():
             label_vocab_train = attributes["label_vocab"].keys()
             label_vocab_test = attributes["label_vocab"].keys()
             print(attributes["label_vocab"])
-            label_assignment = np.array([
-                data["Y"][str(i)][()].decode("utf-8") for i in total_index_list
-            ])
-            label_assignment_test = np.array([
-                data["Y"][str(idx)][()].decode("utf-8")
-                for idx in test_index_list
-            ])
-            label_assignment_train = np.array([
-                data["Y"][str(idx)][()].decode("utf-8")
-                for idx in train_index_list
-            ])
+            label_assignment = np.array(read_labels(data, total_index_list))
+            label_assignment_test = np.array(read_labels(data, test_index_list))
+            label_assignment_train = np.array(read_labels(data, train_index_list))
             train_length = len(label_assignment_train)
             test_length = len(label_assignment_test)
         elif args.task_type == "sequence_tagging":
@@ -321,13 +389,11 @@ def main():
                 "LANGUAGE", "WORK_OF_ART", "LAW", "PERCENT"
             ]
             label = ""
+            tag_lists = dict(zip(total_index_list, read_labels(data, total_index_list)))
             random.shuffle(train_index_list)
             random.shuffle(test_index_list)
             for index in total_index_list:
-                tags = filter(lambda x: x != "O", [
-                    token.decode("utf-8")
-                    for token in data["Y"][str(index)][()]
-                ])
+                tags = filter(lambda x: x != "O", tag_lists[index])
                 label_tags = set([t.split("-")[1] for t in tags])
                 label_tags -= set(blacklist)
                 label = "-".join(sorted(label_tags))
@@ -346,10 +412,7 @@ def main():
                 test_length = args.test_cutoff
 
             for index, value in enumerate(train_index_list[:train_length]):
-                tags = filter(lambda x: x != "O", [
-                    token.decode("utf-8")
-                    for token in data["Y"][str(value)][()]
-                ])
+                tags = filter(lambda x: x != "O", tag_lists[value])
                 label_tags = set([t.split("-")[1] for t in tags])
                 label_tags -= set(blacklist)
                 label = "-".join(sorted(label_tags))
@@ -363,10 +426,7 @@ def main():
             label_assignment_train = np.array(label_assignment_train)
 
             for index, value in enumerate(test_index_list[:test_length]):
-                tags = filter(lambda x: x != "O", [
-                    token.decode("utf-8")
-                    for token in data["Y"][str(value)][()]
-                ])
+                tags = filter(lambda x: x != "O", tag_lists[value])
                 label_tags = set([t.split("-")[1] for t in tags])
                 label_tags -= set(blacklist)
                 label = "-".join(sorted(label_tags))
@@ -437,8 +497,7 @@ def main():
                                                client_num, alpha, test_length)
     # for test add train_length to each index
     for client_id in range(len(partition_result_test)):
-        for index in range(len(partition_result_test[client_id])):
-            partition_result_test[client_id][index] += len(train_index_list)
+        partition_result_test[client_id] += len(train_index_list)
 
 
     print("store data in h5 data")
@@ -473,4 +532,5 @@ def main():
     partition.close()
 
 
-main()
+if __name__ == "__main__":
+    main()
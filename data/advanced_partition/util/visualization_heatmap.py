@@ -7,6 +7,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from scipy.spatial import distance
 
+from data.raw_data_loader.base.columnar import INDEX_KEY, is_columnar, read_columns
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--partition_name', type=str, metavar='PN',
@@ -32,7 +34,10 @@ client_assignment = []
 
 if args.task_type == "text_classification":
     data = h5py.File(args.data_file,"r")
-    client_assignment = [data['Y'][i][()] for i in data['Y'].keys()]
+    if is_columnar(data):
+        client_assignment = read_columns(data, ['Y'], data[INDEX_KEY][()])['Y']
+    else:
+        client_assignment = [data['Y'][i][()] for i in data['Y'].keys()]
     for index, value in enumerate(set(client_assignment)):
         client_assignment = [index if i == value else i for i in client_assignment ]
     data.close()
@@ -8,6 +8,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from scipy.spatial import distance
 
+from data.raw_data_loader.base.columnar import INDEX_KEY, is_columnar, read_columns
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--partition_name', type=str, metavar='PN',
@@ -33,7 +35,10 @@ client_assignment = []
 
 if args.task_type == "text_classification":
     data = h5py.File(args.data_file,"r")
-    total_labels = [data['Y'][i][()] for i in data['Y'].keys()]
+    if is_columnar(data):
+        total_labels = read_columns(data, ['Y'], data[INDEX_KEY][()])['Y']
+    else:
+        total_labels = [data['Y'][i][()] for i in data['Y'].keys()]
     attributes = json.loads(data["attributes"][()])
     label_vocab = attributes['label_vocab']
     client_assignment = [label_vocab[label] for label in total_labels]
@@ -1,11 +1,9 @@
 import os
 import random
-import h5py
-import numpy as np
-import json
 
 
 from data.raw_data_loader.base.base_raw_data_loader import Seq2SeqRawDataLoader
+from data.raw_data_loader.base.sharded_writer import write_sharded_columnar_h5
 
 
 class RawDataLoader(Seq2SeqRawDataLoader):
@@ -57,11 +55,4 @@ class RawDataLoader(Seq2SeqRawDataLoader):
         return cnt
 
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        utf8_type = h5py.string_dtype('utf-8', None)
-        for key in self.X.keys():
-            f["X/" + str(key)] = self.X[key]
-            f["Y/" + str(key)] = self.Y[key]
-            f["history/" + str(key)] = np.array(self.history[key], dtype=utf8_type)
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X, "Y": self.Y, "history": self.history})
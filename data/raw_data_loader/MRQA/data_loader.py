@@ -1,11 +1,11 @@
 from logging import error
 import os
 import json
-import h5py
 import string
 from numpy.core.arrayprint import repr_format
 
 from data.raw_data_loader.base.base_raw_data_loader import SpanExtractionRawDataLoader
+from data.raw_data_loader.base.sharded_writer import write_sharded_columnar_h5
 
 # test script  python test_rawdataloader.py --dataset MRQA --data_dir "../../../../reading_comprehension/" --h5_file_path ./mrqa_data.h5
 
@@ -65,14 +65,9 @@ class RawDataLoader(SpanExtractionRawDataLoader):
         print("finish loading ",file_path)
         return cnt
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        for key in self.context_X.keys():
-            f["context_X/" + str(key)] = self.context_X[key]
-            f["question_X/" + str(key)] = self.question_X[key]
-            f["Y/" + str(key)] = self.Y[key]
-            f["question_ids/" + str(key)] = self.question_ids[key]
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes,
+                                  {"context_X": self.context_X, "question_X": self.question_X, "Y": self.Y,
+                                   "question_ids": self.question_ids})
 
 
 
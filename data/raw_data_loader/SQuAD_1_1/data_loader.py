@@ -3,10 +3,10 @@ import os
 import random
 import re
 import nltk
-import h5py
 
 
 from data.raw_data_loader.base.base_raw_data_loader import SpanExtractionRawDataLoader
+from data.raw_data_loader.base.sharded_writer import write_sharded_columnar_h5
 
 
 class RawDataLoader(SpanExtractionRawDataLoader):
@@ -48,11 +48,6 @@ class RawDataLoader(SpanExtractionRawDataLoader):
         return cnt
 
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        for key in self.context_X.keys():
-            f["context_X/" + str(key)] = self.context_X[key]
-            f["question_X/" + str(key)] = self.question_X[key]
-            f["Y/" + str(key)] = self.Y[key]
-            f["question_ids/" + str(key)] = self.question_ids[key]
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes,
+                                  {"context_X": self.context_X, "question_X": self.question_X, "Y": self.Y,
+                                   "question_ids": self.question_ids})
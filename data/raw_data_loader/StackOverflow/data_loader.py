@@ -1,21 +1,15 @@
 import os
 import h5py
-import json
 
 # temp
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../../")))
 
 from data.raw_data_loader.base.base_raw_data_loader import LanguageModelRawDataLoader
+from data.raw_data_loader.base.sharded_writer import write_sharded_columnar_h5
 from tqdm import tqdm
-import math
-from multiprocessing import Pool
 import logging
 
-global_X = None
-
-CHUNK_SIZE = 1000000
-
 logging.basicConfig(level=logging.INFO,
                         format='%(process)s %(asctime)s.%(msecs)03d - {%(module)s.py (%(lineno)d)} - %(funcName)s(): %(message)s',
                         datefmt='%Y-%m-%d,%H:%M:%S')
@@ -69,46 +63,10 @@ class RawDataLoader(LanguageModelRawDataLoader):
             f[prefix_name + key + "/test"] = self.nature_partition_dict[key]["test"]
         f.close()
     
-    @staticmethod
-    def generate_partial_h5_file(group_id):
-        global global_X
-        logging.basicConfig(level=logging.INFO,
-                        format='%(process)s %(asctime)s.%(msecs)03d - {%(module)s.py (%(lineno)d)} - %(funcName)s(): %(message)s',
-                        datefmt='%Y-%m-%d,%H:%M:%S',
-                        filename="out_%d.log" % group_id,
-                        filemode="a")
-        f = h5py.File("./tmp_h5_data_group_%d.h5" % group_id, "w")
-        start = group_id * CHUNK_SIZE
-        end = len(global_X) if (group_id + 1) * CHUNK_SIZE > len(global_X) else (group_id + 1) * CHUNK_SIZE
-        logging.info("child rocess %d start" % group_id)
-        for idx in tqdm(range(start, end), desc="group %d loading data" % group_id):
-            f["X/" + str(idx)] = global_X[idx]
-        f.close()
-        logging.info("child process %d end" % group_id)
-        
-    
     def generate_h5_file(self, file_path):
-        global global_X
-        global_X = self.X
-        pool = Pool(15)
-        num_groups = math.ceil(len(self.X) / self.CHUNK_SIZE)
-        logging.info("total number of groups: %d" % num_groups)
-        for i in range(num_groups):
-            logging.info("start loading group %d" % i)
-            pool.apply_async(self.generate_partial_h5_file, (i, ))
-        pool.close()
-        pool.join()
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        logging.info("start merging")
-        for i in tqdm(range(num_groups)):
-            tmp_f = h5py.File("./tmp_h5_data_group_%d.h5" % i, "r")
-            f.create_group("X_%d" % i)
-            tmp_f.copy("X", f["X_%d" % i])
-            tmp_f.close()
-            os.remove("./tmp_h5_data_group_%d.h5" % i)
+        logging.info("start generating data file")
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X})
         logging.info("done for generating data file")
-        f.close()
 
 
 # if __name__ == "__main__":
@@ -1,8 +1,6 @@
 from abc import ABC, abstractmethod
-import h5py
-import json
-import numpy as np
-from tqdm import tqdm
+
+from data.raw_data_loader.base.sharded_writer import write_sharded_columnar_h5
 
 class BaseRawDataLoader(ABC):
     @abstractmethod
@@ -33,12 +31,7 @@ class TextClassificationRawDataLoader(BaseRawDataLoader):
         self.attributes["task_type"] = "text_classification"
     
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        for key in self.X.keys():
-            f["X/" + str(key)] = self.X[key]
-            f["Y/" + str(key)] = self.Y[key]
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X, "Y": self.Y})
 
 class SpanExtractionRawDataLoader(BaseRawDataLoader):
     def __init__(self, data_path):
@@ -49,13 +42,8 @@ class SpanExtractionRawDataLoader(BaseRawDataLoader):
         self.attributes["task_type"] = "span_extraction"
 
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        for key in self.context_X.keys():
-            f["context_X/" + str(key)] = self.context_X[key]
-            f["question_X/" + str(key)] = self.question_X[key]
-            f["Y/" + str(key)] = self.Y[key]
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes,
+                                  {"context_X": self.context_X, "question_X": self.question_X, "Y": self.Y})
 
 class SeqTaggingRawDataLoader(BaseRawDataLoader):
     def __init__(self, data_path):
@@ -67,13 +55,7 @@ class SeqTaggingRawDataLoader(BaseRawDataLoader):
         self.attributes["task_type"] = "seq_tagging"
 
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        utf8_type = h5py.string_dtype('utf-8', None)
-        for key in self.X.keys():
-            f["X/" + str(key)] = np.array(self.X[key], dtype=utf8_type)
-            f["Y/" + str(key)] = np.array(self.Y[key], dtype=utf8_type)
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X, "Y": self.Y})
 
 class Seq2SeqRawDataLoader(BaseRawDataLoader):
     def __init__(self, data_path):
@@ -83,12 +65,7 @@ class Seq2SeqRawDataLoader(BaseRawDataLoader):
         self.task_type = "seq2seq"
     
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        for key in self.X.keys():
-            f["X/" + str(key)] = self.X[key]
-            f["Y/" + str(key)] = self.Y[key]
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X, "Y": self.Y})
 
 class LanguageModelRawDataLoader(BaseRawDataLoader):
     def __init__(self, data_path):
@@ -97,11 +74,7 @@ class LanguageModelRawDataLoader(BaseRawDataLoader):
         self.task_type = "lm"
     
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        for key in tqdm(self.X.keys(), desc="generate data h5 file"):
-            f["X/" + str(key)] = self.X[key]
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X})
 
 
 
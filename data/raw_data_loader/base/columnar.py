@@ -0,0 +1,262 @@
+"""
+Columnar layout of the h5 data files.
+
+The legacy layout stores every sample as its own h5 dataset ("X/0", "X/1", ...), so
+reading a client costs one h5 object lookup per sample and field. The columnar layout
+stores every field as one contiguous dataset instead:
+
+    attributes          json string, same as the legacy layout
+    index               int64 [N], sample index of every row, ascending
+    <field>             [N] variable-length utf-8 strings or [N, ...] numbers
+    <field>_offsets     int64 [N + 1], only for list-valued fields (e.g. the tokens of
+                        sequence tagging). <field> then holds the flattened items and
+                        row i is <field>[offsets[i]:offsets[i + 1]]
+
+The root group is marked with the attribute layout = "columnar". The fields of a data file written in shards (see
+sharded_writer.py) are virtual datasets whose sources are the files of the <file>.shards directory next to it.
+"""
+import argparse
+import json
+import logging
+import os
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+LAYOUT_ATTR = "layout"
+COLUMNAR_LAYOUT = "columnar"
+INDEX_KEY = "index"
+OFFSETS_SUFFIX = "_offsets"
+
+# read the whole [min_row, max_row] block and select in memory when the requested rows
+# cover at least 1 / DENSE_READ_RATIO of it, otherwise use a point selection
+DENSE_READ_RATIO = 4
+
+
+def is_columnar(data_file):
+    if data_file.attrs.get(LAYOUT_ATTR, None) != COLUMNAR_LAYOUT:
+        return False
+    check_virtual_sources(data_file)
+    return True
+
+
+def check_virtual_sources(data_file, names=None):
+    """
+    Raise if a source file of a virtual dataset of the data file is missing. h5py reads the missing sources as
+    the fill value ('' or 0) without an error, e.g. when a sharded data file is copied without its .shards directory.
+    """
+    data_dir = os.path.dirname(os.path.abspath(data_file.filename))
+    for name in data_file.keys() if names is None else names:
+        dataset = data_file[name]
+        if not isinstance(dataset, h5py.Dataset) or not dataset.is_virtual:
+            continue
+        for source in dataset.virtual_sources():
+            if source.file_name == ".":
+                continue
+            source_path = source.file_name if os.path.isabs(source.file_name) \
+                else os.path.join(data_dir, source.file_name)
+            if not os.path.exists(source_path):
+                raise Exception("%s of %s is missing, the data file must be kept next to its shards "
+                                "(or folded into one file with convert_to_columnar --fold_shards 1)" % (
+                                    source_path, data_file.filename))
+
+
+def _is_sequence(value):
+    return isinstance(value, (list, tuple, np.ndarray))
+
+
+def _is_string(value):
+    return isinstance(value, (str, bytes))
+
+
+def _to_str(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _create_dataset(f, name, data, compression=None, chunk_rows=None):
+    chunks = None
+    if chunk_rows is not None and len(data) > 0:
+        chunks = (min(len(data), chunk_rows),) + data.shape[1:]
+    f.create_dataset(name, data=data, compression=compression, chunks=chunks)
+
+
+def _write_field(f, name, values, compression=None, chunk_rows=None):
+    utf8_type = h5py.string_dtype('utf-8', None)
+    first = values[0] if len(values) > 0 else ""
+    if _is_string(first):
+        _create_dataset(f, name, np.array([_to_str(v) for v in values], dtype=utf8_type), compression, chunk_rows)
+    elif _is_sequence(first) and (len(first) == 0 or _is_string(first[0])):
+        lengths = np.array([len(v) for v in values], dtype=np.int64)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = [_to_str(item) for v in values for item in v]
+        _create_dataset(f, name, np.array(flat, dtype=utf8_type), compression, chunk_rows)
+        f.create_dataset(name + OFFSETS_SUFFIX, data=offsets)
+    else:
+        _create_dataset(f, name, np.asarray(values), compression, chunk_rows)
+
+
+def write_columnar_h5(file_path, attributes, fields, compression=None, chunk_rows=None):
+    """
+    fields: dict of field name -> dict of sample index -> value. All fields must share
+    the same sample indices; rows are written in ascending sample index order.
+    """
+    field_names = list(fields.keys())
+    keys = sorted(fields[field_names[0]].keys(), key=int)
+    for name in field_names:
+        if len(fields[name]) != len(keys):
+            raise Exception("field %s has %d samples, expected %d" % (name, len(fields[name]), len(keys)))
+    write_columnar_rows(file_path, attributes, keys, {name: [fields[name][key] for key in keys]
+                                                      for name in field_names}, compression, chunk_rows)
+
+
+def write_columnar_rows(file_path, attributes, keys, columns, compression=None, chunk_rows=None):
+    """Write rows that are already in ascending sample index order; columns maps field name -> list of values."""
+    f = h5py.File(file_path, "w")
+    f.attrs[LAYOUT_ATTR] = COLUMNAR_LAYOUT
+    f["attributes"] = json.dumps(attributes)
+    f.create_dataset(INDEX_KEY, data=np.array(keys, dtype=np.int64))
+    for name, values in columns.items():
+        _write_field(f, name, values, compression, chunk_rows)
+    f.close()
+
+
+def _take(dataset, rows):
+    """Read dataset[rows] for an arbitrary (unsorted, repeated) row array with one selection."""
+    if len(rows) == 0:
+        return dataset[0:0]
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    lo, hi = int(unique_rows[0]), int(unique_rows[-1]) + 1
+    if hi - lo <= DENSE_READ_RATIO * len(unique_rows):
+        values = dataset[lo:hi][unique_rows - lo]
+    else:
+        values = dataset[unique_rows]
+    return values[inverse]
+
+
+def _decode(dataset, values):
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return [_to_str(v) for v in values]
+    return list(values)
+
+
+def get_rows(data_file, index_list):
+    """Map sample indices to row numbers of a columnar data file."""
+    index = data_file[INDEX_KEY][()]
+    keys = np.asarray(index_list, dtype=np.int64).reshape(-1)
+    rows = np.searchsorted(index, keys)
+    rows[rows == len(index)] = 0
+    missing = index[rows] != keys if len(index) > 0 else np.ones(len(keys), dtype=bool)
+    if np.any(missing):
+        raise Exception("sample index %d is not in the data file" % keys[np.argmax(missing)])
+    return rows
+
+
+def read_columns(data_file, field_names, index_list, rows=None):
+    """
+    Bulk read the given fields of the samples in index_list from a columnar data file.
+    Strings are decoded to str, list-valued fields are returned as lists of str.
+    """
+    check_virtual_sources(data_file, field_names)
+    if rows is None:
+        rows = get_rows(data_file, index_list)
+    columns = dict()
+    for name in field_names:
+        dataset = data_file[name]
+        if name + OFFSETS_SUFFIX in data_file:
+            offsets = data_file[name + OFFSETS_SUFFIX][()]
+            starts = offsets[rows]
+            lengths = offsets[rows + 1] - starts
+            bounds = np.cumsum(lengths)
+            positions = np.arange(bounds[-1] if len(bounds) > 0 else 0, dtype=np.int64) \
+                + np.repeat(starts - (bounds - lengths), lengths)
+            flat = _decode(dataset, _take(dataset, positions))
+            bounds = [0] + bounds.tolist()
+            columns[name] = [flat[bounds[i]:bounds[i + 1]] for i in range(len(rows))]
+        else:
+            columns[name] = _decode(dataset, _take(dataset, rows))
+    return columns
+
+
+def _read_legacy_value(dataset):
+    value = dataset[()]
+    if isinstance(value, np.ndarray) and value.dtype.kind == "O":
+        return [_to_str(v) for v in value]
+    return value
+
+
+def _fold_shards(src, dst_path, compression=None, chunk_rows=4096):
+    dst = h5py.File(dst_path, "w")
+    for key, value in src.attrs.items():
+        dst.attrs[key] = value
+    for name in src.keys():
+        dataset = src[name]
+        if not dataset.is_virtual:
+            src.copy(name, dst)
+            continue
+        chunks = (min(len(dataset), chunk_rows),) + dataset.shape[1:] if len(dataset) > 0 else None
+        folded = dst.create_dataset(name, shape=dataset.shape, dtype=dataset.dtype, compression=compression,
+                                    chunks=chunks)
+        for start in tqdm(range(0, len(dataset), chunk_rows), desc="fold %s" % name):
+            folded[start: start + chunk_rows] = dataset[start: start + chunk_rows]
+    dst.close()
+
+
+def convert_to_columnar(src_path, dst_path, compression=None, fold_shards=False):
+    """
+    Convert a data file in the legacy per-sample layout to the columnar layout. With fold_shards, src_path is a
+    columnar data file written in shards instead, which is copied into one file that does not need its shards.
+    """
+    src = h5py.File(src_path, "r")
+    if fold_shards:
+        try:
+            if not is_columnar(src):
+                raise Exception("%s is not in the columnar layout" % src_path)
+            _fold_shards(src, dst_path, compression)
+        finally:
+            src.close()
+        return
+    if is_columnar(src):
+        src.close()
+        raise Exception("%s is already in the columnar layout" % src_path)
+    attributes = json.loads(src["attributes"][()])
+    fields = dict()
+    for group_name in src.keys():
+        if group_name == "attributes":
+            continue
+        group = src[group_name]
+        # the StackOverflow loader splits a field into chunk groups "X_0/X", "X_1/X", ...
+        members = [group[k] for k in group.keys()] if all(
+            isinstance(group[k], h5py.Group) for k in group.keys()) else [group]
+        for member in members:
+            field_name = member.name.split("/")[-1]
+            field = fields.setdefault(field_name, dict())
+            for key in tqdm(member.keys(), desc="convert %s" % member.name):
+                field[int(key)] = _read_legacy_value(member[key])
+    src.close()
+    logging.info("fields: %s" % str(list(fields.keys())))
+    write_columnar_h5(dst_path, attributes, fields, compression)
+
+
+def add_args(parser):
+    parser.add_argument('--src_file_path', type=str, required=True,
+                        help='h5 data file in the legacy per-sample layout (columnar with --fold_shards 1)')
+
+    parser.add_argument('--dst_file_path', type=str, required=True,
+                        help='output h5 data file in the columnar layout')
+
+    parser.add_argument('--compression', type=str, default=None,
+                        help='h5 compression filter of the output datasets, e.g. gzip')
+
+    parser.add_argument('--fold_shards', type=int, default=0,
+                        help='1: copy a columnar data file written in shards into one standalone file')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='convert h5 data file to columnar layout'))
+    convert_to_columnar(args.src_file_path, args.dst_file_path, args.compression, args.fold_shards == 1)
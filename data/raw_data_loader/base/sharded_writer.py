@@ -0,0 +1,135 @@
+"""
+Parallel writer of columnar h5 data files.
+
+The rows (in ascending sample index order) are cut into shards of shard_size rows, and a pool of
+worker processes writes every shard as a chunked and compressed columnar file
+
+    <file_path>.shards/shard_00000.h5, shard_00001.h5, ...
+
+The data file itself is then stitched together from h5 virtual datasets that map onto the shards, so
+no data is copied after the workers are done. Only the index and the <field>_offsets datasets are real
+datasets of the data file, since the offsets of a shard are relative to the shard. The data file has
+the same layout as the one of write_columnar_h5 (see columnar.py) and is read the same way, but it
+must be kept next to its .shards directory (the readers raise if a shard is missing). To get a standalone
+file, fold the shards with convert_to_columnar(..., fold_shards=True).
+"""
+import json
+import logging
+import os
+import shutil
+from multiprocessing import Pool, cpu_count, get_start_method
+
+import h5py
+import numpy as np
+
+from data.raw_data_loader.base.columnar import write_columnar_h5, write_columnar_rows, COLUMNAR_LAYOUT, \
+    INDEX_KEY, LAYOUT_ATTR, OFFSETS_SUFFIX
+
+SHARD_SIZE = 50000
+CHUNK_ROWS = 4096
+SHARDS_SUFFIX = ".shards"
+
+
+def _shard_file_name(shard_id):
+    return "shard_%05d.h5" % shard_id
+
+
+# (keys, columns) of the file being written. The forked workers inherit them instead of receiving a pickled copy.
+_rows = None
+
+
+def _write_shard(shard_args):
+    shard_path, start, end, compression, chunk_rows = shard_args
+    if isinstance(start, tuple):
+        # not forked: the rows of the shard are passed along
+        keys, columns = start
+    else:
+        keys = _rows[0][start: end]
+        columns = {name: values[start: end] for name, values in _rows[1].items()}
+    write_columnar_rows(shard_path, {}, keys, columns, compression, chunk_rows)
+    return shard_path
+
+
+def _virtual_dataset(f, name, shard_files, shard_paths):
+    sources = list()
+    total = 0
+    dtype, row_shape = None, None
+    for shard_file, shard_path in zip(shard_files, shard_paths):
+        dataset = shard_file[name]
+        if dtype is None:
+            dtype, row_shape = dataset.dtype, dataset.shape[1:]
+        elif dataset.dtype != dtype or dataset.shape[1:] != row_shape:
+            raise Exception("field %s has dtype %s %s in %s, expected %s %s" % (
+                name, dataset.dtype, dataset.shape[1:], shard_path, dtype, row_shape))
+        if dataset.shape[0] > 0:
+            sources.append((total, h5py.VirtualSource(shard_path, name, shape=dataset.shape)))
+        total += dataset.shape[0]
+    layout = h5py.VirtualLayout(shape=(total,) + row_shape, dtype=dtype)
+    for start, source in sources:
+        layout[start: start + source.shape[0]] = source
+    f.create_virtual_dataset(name, layout)
+
+
+def _concat_offsets(f, name, shard_files):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for shard_file in shard_files:
+        shard_offsets = shard_file[name + OFFSETS_SUFFIX][()]
+        offsets.append(shard_offsets[1:] + base)
+        base += int(shard_offsets[-1])
+    f.create_dataset(name + OFFSETS_SUFFIX, data=np.concatenate(offsets))
+
+
+def write_sharded_columnar_h5(file_path, attributes, fields, num_workers=None, shard_size=SHARD_SIZE,
+                              compression="gzip", chunk_rows=CHUNK_ROWS):
+    """
+    Same arguments as write_columnar_h5, written by num_workers processes (default: all cores).
+    Data that fits into one shard is written as a single (chunked, compressed) file.
+    """
+    field_names = list(fields.keys())
+    keys = sorted(fields[field_names[0]].keys(), key=int)
+    for name in field_names:
+        if len(fields[name]) != len(keys):
+            raise Exception("field %s has %d samples, expected %d" % (name, len(fields[name]), len(keys)))
+    if num_workers is None:
+        num_workers = cpu_count()
+
+    shard_dir = file_path + SHARDS_SUFFIX
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    if len(keys) <= shard_size or num_workers <= 1:
+        write_columnar_h5(file_path, attributes, fields, compression, chunk_rows)
+        return
+
+    os.makedirs(shard_dir)
+    global _rows
+    _rows = (keys, {name: [fields[name][key] for key in keys] for name in field_names})
+    forked = get_start_method() == "fork"
+    shard_args = list()
+    for shard_id, start in enumerate(range(0, len(keys), shard_size)):
+        end = start + shard_size
+        rows = (start, end) if forked else \
+            ((keys[start: end], {name: values[start: end] for name, values in _rows[1].items()}), None)
+        shard_args.append((os.path.join(shard_dir, _shard_file_name(shard_id)),) + rows + (compression, chunk_rows))
+    logging.info("writing %d rows in %d shards with %d processes" % (len(keys), len(shard_args), num_workers))
+    try:
+        with Pool(min(num_workers, len(shard_args))) as pool:
+            pool.map(_write_shard, shard_args)
+    finally:
+        _rows = None
+
+    # paths of the sources are relative to the data file, so the data file and its shards can be moved together
+    shard_paths = [os.path.join(os.path.basename(shard_dir), _shard_file_name(shard_id))
+                   for shard_id in range(len(shard_args))]
+    shard_files = [h5py.File(args[0], "r") for args in shard_args]
+    f = h5py.File(file_path, "w")
+    f.attrs[LAYOUT_ATTR] = COLUMNAR_LAYOUT
+    f["attributes"] = json.dumps(attributes)
+    f.create_dataset(INDEX_KEY, data=np.array(keys, dtype=np.int64))
+    for name in field_names:
+        _virtual_dataset(f, name, shard_files, shard_paths)
+        if name + OFFSETS_SUFFIX in shard_files[0]:
+            _concat_offsets(f, name, shard_files)
+    f.close()
+    for shard_file in shard_files:
+        shard_file.close()
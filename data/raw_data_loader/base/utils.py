@@ -10,7 +10,14 @@ from data_preprocessing.base.globals import *
 
 import gensim
 import h5py
+import hashlib
 import json
+import logging
+import os
+import shutil
+from collections import Counter
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
 
 
@@ -175,6 +182,53 @@ def label_to_idx(y, vocab):
     return idx_y
 
 
+def _lookup_ids(tokens, vocab):
+    # one dict lookup per token, the unknown tokens get the index of UNK_TOKEN
+    unk_idx = vocab[UNK_TOKEN]
+    get = vocab.get
+    return np.fromiter((get(token, unk_idx) for token in tokens), dtype=np.int32, count=len(tokens))
+
+
+def token_to_idx_array(x, vocab, max_sequence_length):
+    """
+    token_to_idx(padding_data(x, max_sequence_length)) written directly into int32 arrays.
+    Returns the [num_seqs, max_sequence_length] token indexes and the [num_seqs] sequence lengths.
+    """
+    seq_lens = np.fromiter((min(len(single_x), max_sequence_length) for single_x in x), dtype=np.int32,
+                           count=len(x))
+    idx_x = np.full((len(x), max_sequence_length), vocab.get(PAD_TOKEN, vocab[UNK_TOKEN]), dtype=np.int32)
+    # a boolean mask fills the tokens in row major order, the order of the flattened tokens
+    idx_x[np.arange(max_sequence_length) < seq_lens[:, None]] = _lookup_ids(
+        [token for single_x in x for token in single_x[:max_sequence_length]], vocab)
+    return idx_x, seq_lens
+
+
+def char_to_idx_array(x, vocab, max_sequence_length, max_word_length):
+    """
+    char_to_idx(padding_char_data(x, max_sequence_length, max_word_length)) written directly into int32 arrays.
+    Returns the [num_seqs, max_sequence_length, max_word_length] char indexes and the
+    [num_seqs, max_sequence_length] word lengths (0 for the padding words).
+    """
+    pad_idx = vocab.get(PAD_TOKEN, vocab[UNK_TOKEN])
+    seq_lens = np.fromiter((min(len(sent), max_sequence_length) for sent in x), dtype=np.int32, count=len(x))
+    word_mask = np.arange(max_sequence_length) < seq_lens[:, None]
+    words = [chars[:max_word_length] for sent in x for chars in sent[:max_sequence_length]]
+    word_lens = np.zeros((len(x), max_sequence_length), dtype=np.int32)
+    word_lens[word_mask] = np.fromiter((len(chars) for chars in words), dtype=np.int32, count=len(words))
+
+    word_idx = np.full((len(words), max_word_length), pad_idx, dtype=np.int32)
+    word_idx[np.arange(max_word_length) < word_lens[word_mask][:, None]] = _lookup_ids(
+        [ch for chars in words for ch in chars], vocab)
+    idx_x = np.full((len(x), max_sequence_length, max_word_length), pad_idx, dtype=np.int32)
+    idx_x[word_mask] = word_idx
+    return idx_x, word_lens
+
+
+def label_to_idx_array(y, vocab):
+    # int64, the targets of the classification losses
+    return np.fromiter((vocab[label] for label in y), dtype=np.int64, count=len(y))
+
+
 def remove_words(x, removed_words):
     remove_x = []
     for single_x in x:
@@ -228,6 +282,212 @@ def load_glove_embedding(path, source_vocab, dimension):
     return vocab, weights
 
 
+def _count_chunk(x):
+    return Counter(token for single_x in x for token in single_x)
+
+
+def count_tokens(x, num_workers=None, chunk_size=20000):
+    """
+    Same as build_freq_vocab, counted by num_workers processes (default: all cores) over chunks of chunk_size
+    sequences. The tokens keep the order of their first appearance, like build_vocab.
+    """
+    if num_workers is None:
+        num_workers = cpu_count()
+    chunks = [x[start: start + chunk_size] for start in range(0, len(x), chunk_size)]
+    freq_vocab = Counter()
+    if num_workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            freq_vocab.update(_count_chunk(chunk))
+    else:
+        with Pool(min(num_workers, len(chunks))) as pool:
+            # imap keeps the order of the chunks, so the first appearance order is kept when merging
+            for chunk_freq in pool.imap(_count_chunk, chunks):
+                freq_vocab.update(chunk_freq)
+    return dict(freq_vocab)
+
+
+def build_vocab_from_freq(freq_vocab, min_freq=0, removed_words=None):
+    """
+    The vocab build_vocab returns after remove_words dropped the tokens that appear at most min_freq times and
+    the removed_words.
+    """
+    vocab = dict()
+    for token, freq in freq_vocab.items():
+        if freq > min_freq and (removed_words is None or token not in removed_words):
+            vocab[token] = len(vocab)
+    vocab[PAD_TOKEN] = len(vocab)
+    vocab[UNK_TOKEN] = len(vocab)
+    return vocab
+
+
+def _hash_words(words):
+    # stable across processes, unlike hash()
+    return np.array([int.from_bytes(hashlib.blake2b(word.encode("utf8"), digest_size=8).digest(), "little")
+                     for word in words], dtype=np.uint64)
+
+
+class VocabularyService:
+    """
+    Builds the source vocabulary and loads the pretrained embeddings of the BiLSTM pipelines, caching both in
+    cache_dir.
+
+    The vocabulary is counted in one parallel pass over the sequences of all the clients and saved as
+    <cache_dir>/vocab_<cache_key hash>.json, later runs with the same cache_key read it back.
+    A GloVe text file or word2vec binary file is converted once into numpy files in
+    <cache_dir>/<embedding file name>.npy/: the float32 vectors, the utf-8 words and a sorted hash table of the
+    words. Later runs memory-map the vectors and look the vocabulary up in the hash table, so only the vectors of
+    the vocabulary are read.
+    """
+
+    def __init__(self, cache_dir, num_workers=None):
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def build_vocab(self, x, min_freq=0, removed_words=None, cache_key=None):
+        """
+        x is the list of tokenized sequences, or a function that returns it so it is only collected on a cache miss.
+        cache_key is a json serializable description of the data (dataset, partition, ...).
+        """
+        cache_path = None
+        if self.cache_dir and cache_key is not None:
+            key = json.dumps([cache_key, min_freq, sorted(removed_words) if removed_words else None], sort_keys=True)
+            cache_path = os.path.join(self.cache_dir, "vocab_%s.json" % hashlib.md5(key.encode("utf8")).hexdigest())
+            if os.path.exists(cache_path):
+                with open(cache_path, "r") as f:
+                    tokens = json.load(f)
+                logging.info("load vocab of %d tokens from %s" % (len(tokens), cache_path))
+                return {token: idx for idx, token in enumerate(tokens)}
+        if callable(x):
+            x = x()
+        freq_vocab = count_tokens(x, self.num_workers)
+        logging.info("frequency vocab size %d" % len(freq_vocab))
+        vocab = build_vocab_from_freq(freq_vocab, min_freq, removed_words)
+        if cache_path is not None:
+            # the processes of a distributed run may build the same vocab at the same time
+            tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(sorted(vocab, key=vocab.get), f)
+            os.replace(tmp_path, cache_path)
+        return vocab
+
+    def load_embedding(self, path, embedding_name, source_vocab, dimension=None):
+        """
+        Same result as load_glove_embedding / load_word2vec_embedding with float32 weights: the words of the
+        embedding file in source_vocab (all of them if source_vocab is None) in file order, then PAD_TOKEN and
+        UNK_TOKEN with zero vectors. A word that appears several times keeps its last vector.
+        """
+        embedding_dir = self.convert_embedding(path, embedding_name, dimension)
+        vectors = np.load(os.path.join(embedding_dir, "vectors.npy"), mmap_mode="r")
+        if source_vocab is None:
+            rows = np.arange(len(vectors))
+            words_data = np.load(os.path.join(embedding_dir, "words.npy"))
+            offsets = np.load(os.path.join(embedding_dir, "word_offsets.npy"))
+            words = [bytes(words_data[offsets[i]: offsets[i + 1]]).decode("utf8") for i in range(len(vectors))]
+        else:
+            words, rows = self._lookup(embedding_dir, [word for word in source_vocab
+                                                       if word != PAD_TOKEN and word != UNK_TOKEN])
+        order = np.argsort(rows, kind="stable")
+        vocab = dict()
+        for i in order:
+            vocab[words[i]] = len(vocab)
+        weights = np.zeros((len(vocab) + 2, vectors.shape[1]), dtype=np.float32)
+        # reading the rows in ascending order touches each page of the memory map once
+        weights[:len(vocab)] = vectors[np.asarray(rows, dtype=np.int64)[order]]
+        vocab[PAD_TOKEN] = len(vocab)
+        vocab[UNK_TOKEN] = len(vocab)
+        logging.info("load %d of %d embeddings from %s" % (len(vocab) - 2, len(vectors), embedding_dir))
+        return vocab, weights
+
+    def convert_embedding(self, path, embedding_name, dimension=None):
+        """Convert the embedding file into numpy files in cache_dir (next to the file without cache_dir) once."""
+        cache_dir = self.cache_dir if self.cache_dir else os.path.dirname(os.path.abspath(path))
+        embedding_dir = os.path.join(cache_dir, os.path.basename(path) + ".npy")
+        stat = os.stat(path)
+        meta = {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime,
+                "embedding_name": embedding_name, "dimension": dimension}
+        meta_path = os.path.join(embedding_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                if json.load(f) == meta:
+                    return embedding_dir
+        logging.info("convert %s into %s" % (path, embedding_dir))
+        # converted into a temporary directory that is renamed at the end, another process may convert at the same time
+        tmp_dir = "%s.%d.tmp" % (embedding_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        if embedding_name == "word2vec":
+            model = gensim.models.KeyedVectors.load_word2vec_format(path, binary=True)
+            words = list(model.index_to_key if hasattr(model, "index_to_key") else model.index2word)
+            vectors = np.asarray(model.vectors, dtype=np.float32)
+        elif embedding_name == "glove":
+            words, vectors = self._read_glove(path, dimension)
+        else:
+            raise Exception("No such embedding")
+
+        # the last occurrence of a word wins, as in the vocab of load_glove_embedding
+        last_row = dict()
+        for row, word in enumerate(words):
+            last_row[word] = row
+        hashes = _hash_words(last_row.keys())
+        hash_order = np.argsort(hashes, kind="stable")
+        encoded = [word.encode("utf8") for word in words]
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in encoded])
+        np.save(os.path.join(tmp_dir, "vectors.npy"), vectors)
+        np.save(os.path.join(tmp_dir, "words.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        np.save(os.path.join(tmp_dir, "word_offsets.npy"), offsets)
+        np.save(os.path.join(tmp_dir, "hashes.npy"), hashes[hash_order])
+        np.save(os.path.join(tmp_dir, "hash_rows.npy"),
+                np.fromiter(last_row.values(), dtype=np.int64, count=len(last_row))[hash_order])
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        if os.path.exists(meta_path):
+            # converted by another process in the meantime
+            shutil.rmtree(tmp_dir)
+        else:
+            # remove the conversion of an older version of the file
+            shutil.rmtree(embedding_dir, ignore_errors=True)
+            os.rename(tmp_dir, embedding_dir)
+        return embedding_dir
+
+    @staticmethod
+    def _read_glove(path, dimension):
+        words = []
+        vectors = []
+        with open(path, "r") as f:
+            for line in f:
+                temp = line.strip().split(" ")
+                words.append(" ".join(temp[:-dimension]))
+                # parse as float64 and cast, gives the same float32 values as the former float() parsing
+                vectors.append(np.array(temp[-dimension:], dtype=np.float64).astype(np.float32))
+        return words, np.array(vectors, dtype=np.float32).reshape(len(vectors), dimension)
+
+    @staticmethod
+    def _lookup(embedding_dir, words):
+        """The words found in the embedding and their rows."""
+        hashes = np.load(os.path.join(embedding_dir, "hashes.npy"), mmap_mode="r")
+        hash_rows = np.load(os.path.join(embedding_dir, "hash_rows.npy"), mmap_mode="r")
+        words_data = np.load(os.path.join(embedding_dir, "words.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(embedding_dir, "word_offsets.npy"), mmap_mode="r")
+        query = _hash_words(words)
+        positions = np.searchsorted(hashes, query)
+        found_words = []
+        rows = []
+        for word, word_hash, position in zip(words, query, positions):
+            encoded = word.encode("utf8")
+            # verify the word, several words can share a hash
+            while position < len(hashes) and hashes[position] == word_hash:
+                row = hash_rows[position]
+                if bytes(words_data[offsets[row]: offsets[row + 1]]) == encoded:
+                    found_words.append(word)
+                    rows.append(row)
+                    break
+                position += 1
+        return found_words, rows
+
+
 def NER_data_formatter(ner_data):
     formatted_data = []
     if len(ner_data["X"]) != len(ner_data["Y"]):
@@ -1,9 +1,7 @@
 
 from data.raw_data_loader.base.base_raw_data_loader import SeqTaggingRawDataLoader
+from data.raw_data_loader.base.sharded_writer import write_sharded_columnar_h5
 import os
-import h5py
-import json
-import numpy as np
 
 
 class RawDataLoader(SeqTaggingRawDataLoader):
@@ -49,12 +47,5 @@ class RawDataLoader(SeqTaggingRawDataLoader):
         return cnt
     
     def generate_h5_file(self, file_path):
-        f = h5py.File(file_path, "w")
-        f["attributes"] = json.dumps(self.attributes)
-        utf8_type = h5py.string_dtype('utf-8', None)
-        for key in self.X.keys():
-            f["X/" + str(key)] = np.array(self.X[key], dtype=utf8_type)
-            f["Y/" + str(key)] = np.array(self.Y[key], dtype=utf8_type)
-            f["all_deps/" + str(key)] = np.array(self.all_deps[key], dtype=utf8_type)
-        f.close()
+        write_sharded_columnar_h5(file_path, self.attributes, {"X": self.X, "Y": self.Y, "all_deps": self.all_deps})
 
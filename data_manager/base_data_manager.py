@@ -2,14 +2,21 @@ from abc import ABC, abstractmethod
 import h5py
 import json
 
-from data_preprocessing.base.base_data_loader import BaseDataLoader
+from data_preprocessing.base.base_data_loader import BaseDataLoader, DynamicPaddingCollator, LengthBucketBatchSampler
+from data_manager.client_data_provider import ClientDataProvider, ClientDataDict, TRAIN, TEST, TRAIN_NUM
+from data_manager.feature_cache import FeatureCache
 from tqdm import tqdm
 import logging
 import h5py
 import json
 import numpy as np
-import pickle
-import os
+from torch.utils.data import TensorDataset
+
+
+# model args that change the features produced by the preprocessors
+FEATURE_ARGS = ["model_type", "model_name", "model_class", "max_seq_length", "do_lower_case", "labels_map",
+                "regression", "sliding_window", "stride", "pad_token_label_id", "max_query_length", "doc_stride",
+                "max_length", "dataset_class"]
 
 
 class BaseDataManager(ABC):
@@ -32,6 +39,9 @@ class BaseDataManager(ABC):
         self.client_index_list = None
         self.client_index_pointer = 0
         self.attributes = None
+        self.feature_cache = None
+        self.client_data_provider = None
+        self._tokenizer_digest = None
 
         self.num_clients = self.load_num_clients(
             self.args.partition_file_path, self.args.partition_method)
@@ -89,49 +99,43 @@ class BaseDataManager(ABC):
         return list(range(0, self.num_clients))
 
     def load_centralized_data(self, cut_off=None):
-        state, res = self._load_data_loader_from_cache(-1)
+        partition_file = h5py.File(
+            self.args.partition_file_path, "r", swmr=True)
+        partition_method = self.args.partition_method
+        train_index_list = []
+        test_index_list = []
+        for client_idx in tqdm(
+            partition_file[partition_method]
+            ["partition_data"].keys(),
+                desc="Loading index from h5 file."):
+            train_index_list.extend(
+                partition_file[partition_method]["partition_data"]
+                [client_idx]["train"][()][:cut_off])
+            test_index_list.extend(
+                partition_file[partition_method]["partition_data"]
+                [client_idx]["test"][()][:cut_off])
+        partition_file.close()
+
+        state, res = self._load_data_loader_from_cache("centralized", train_index_list, test_index_list)
         if state:
             train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = res
         else:
             data_file = h5py.File(self.args.data_file_path, "r", swmr=True)
-            partition_file = h5py.File(
-                self.args.partition_file_path, "r", swmr=True)
-            partition_method = self.args.partition_method
-            train_index_list = []
-            test_index_list = []
-            for client_idx in tqdm(
-                partition_file[partition_method]
-                ["partition_data"].keys(),
-                    desc="Loading index from h5 file."):
-                train_index_list.extend(
-                    partition_file[partition_method]["partition_data"]
-                    [client_idx]["train"][()][:cut_off])
-                test_index_list.extend(
-                    partition_file[partition_method]["partition_data"]
-                    [client_idx]["test"][()][:cut_off])
             train_data = self.read_instance_from_h5(data_file, train_index_list)
             test_data = self.read_instance_from_h5(data_file, test_index_list)
             data_file.close()
-            partition_file.close()
             train_examples, train_features, train_dataset = self.preprocessor.transform(
                 **train_data, index_list=train_index_list)
             test_examples, test_features, test_dataset = self.preprocessor.transform(
                 **test_data, index_list=test_index_list, evaluate=True)
-            
-            with open(res, "wb") as handle:
-                pickle.dump((train_examples, train_features, train_dataset, test_examples, test_features, test_dataset), handle)
 
-        train_dl = BaseDataLoader(train_examples, train_features, train_dataset,
-                              batch_size=self.train_batch_size,
-                              num_workers=0,
-                              pin_memory=True,
-                              drop_last=False)
+            train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = \
+                self._save_data_loader_to_cache(res, (train_examples, train_features, train_dataset,
+                                                      test_examples, test_features, test_dataset))
+
+        train_dl = self._create_data_loader(train_examples, train_features, train_dataset, train=True)
 
-        test_dl = BaseDataLoader(test_examples, test_features, test_dataset,
-                             batch_size=self.eval_batch_size,
-                             num_workers=0,
-                             pin_memory=True,
-                             drop_last=False)
+        test_dl = self._create_data_loader(test_examples, test_features, test_dataset, train=False)
         
         return train_dl, test_dl
 
@@ -142,10 +146,32 @@ class BaseDataManager(ABC):
             return self._load_federated_data_local()
 
     def _load_federated_data_server(self, test_only=True, test_cut_off=None):
-        state, res = self._load_data_loader_from_cache(-1)
         train_data_local_dict = None
         train_data_local_num_dict = None
         test_data_local_dict = {}
+
+        partition_file = h5py.File(
+            self.args.partition_file_path, "r", swmr=True)
+        partition_method = self.args.partition_method
+        train_index_list = []
+        test_index_list = []
+        for client_idx in tqdm(
+            partition_file[partition_method]
+            ["partition_data"].keys(),
+                desc="Loading index from h5 file."):
+            train_index_list.extend(
+                partition_file[partition_method]["partition_data"]
+                [client_idx]["train"][()])
+            local_test_index_list = partition_file[partition_method][
+                "partition_data"][client_idx]["test"][()]
+            test_index_list.extend(local_test_index_list)
+        partition_file.close()
+        if test_cut_off:
+            test_index_list.sort()
+        test_index_list = test_index_list[:test_cut_off]
+
+        state, res = self._load_data_loader_from_cache(
+            "server", None if test_only else train_index_list, test_index_list)
         if state:
             train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = res
             logging.info("test data size "+ str(len(test_examples)))
@@ -155,37 +181,14 @@ class BaseDataManager(ABC):
                 train_data_num = len(train_dataset)
         else:
             data_file = h5py.File(self.args.data_file_path, "r", swmr=True)
-            partition_file = h5py.File(
-                self.args.partition_file_path, "r", swmr=True)
-            partition_method = self.args.partition_method
-            train_index_list = []
-            test_index_list = []
-            # test_examples = []
-            # test_features = []
-            # test_dataset = []
-            for client_idx in tqdm(
-                partition_file[partition_method]
-                ["partition_data"].keys(),
-                    desc="Loading index from h5 file."):
-                train_index_list.extend(
-                    partition_file[partition_method]["partition_data"]
-                    [client_idx]["train"][()])
-                local_test_index_list = partition_file[partition_method][
-                    "partition_data"][client_idx]["test"][()]
-                test_index_list.extend(local_test_index_list)
-
             if not test_only:
                 train_data = self.read_instance_from_h5(
                     data_file, train_index_list)
-            if test_cut_off:
-                test_index_list.sort()
-            test_index_list = test_index_list[:test_cut_off]
             logging.info("caching test index size "+ str(len(test_index_list)) + "test cut off " + str(test_cut_off))
 
             test_data = self.read_instance_from_h5(data_file, test_index_list)
 
             data_file.close()
-            partition_file.close()
 
             train_examples, train_features, train_dataset = None, None, None
             if not test_only:
@@ -195,26 +198,19 @@ class BaseDataManager(ABC):
                 **test_data, index_list=test_index_list)
             logging.info("caching test data size "+ str(len(test_examples)))
 
-            with open(res, "wb") as handle:
-                pickle.dump((train_examples, train_features, train_dataset, test_examples, test_features, test_dataset), handle)
+            train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = \
+                self._save_data_loader_to_cache(res, (train_examples, train_features, train_dataset,
+                                                      test_examples, test_features, test_dataset))
 
         if test_only or train_dataset is None:
             train_data_num = 0
             train_data_global = None
         else:
-            train_data_global = BaseDataLoader(train_examples, train_features, train_dataset,
-                                        batch_size=self.train_batch_size,
-                                        num_workers=0,
-                                        pin_memory=True,
-                                        drop_last=False)
+            train_data_global = self._create_data_loader(train_examples, train_features, train_dataset, train=True)
             train_data_num = len(train_examples)
             logging.info("train_dl_global number = " + str(len(train_data_global)))
 
-        test_data_global = BaseDataLoader(test_examples, test_features, test_dataset,
-                                      batch_size=self.eval_batch_size,
-                                      num_workers=0,
-                                      pin_memory=True,
-                                      drop_last=False)
+        test_data_global = self._create_data_loader(test_examples, test_features, test_dataset, train=False)
 
         logging.info("test_dl_global number = " + str(len(test_data_global)))
 
@@ -223,89 +219,145 @@ class BaseDataManager(ABC):
                 train_data_local_num_dict, train_data_local_dict, test_data_local_dict, self.num_clients)
 
     def _load_federated_data_local(self):
+        """
+        The loaders of a client are built lazily the first time the client is used (see ClientDataProvider), so only
+        model_args.max_cached_clients clients are held in memory and the next round's client is prefetched in the
+        background while the current round trains.
+        """
+        schedule = list(self.client_index_list)
+        self.client_index_list = list(set(self.client_index_list))
+        logging.info("self.client_index_list = " + str(self.client_index_list))
+
+        self.client_data_provider = ClientDataProvider(
+            self._load_client_data, schedule, self.model_args.max_cached_clients, self.model_args.prefetch_clients)
+        self.client_data_provider.start()
+        train_data_local_dict = ClientDataDict(self.client_data_provider, TRAIN)
+        test_data_local_dict = ClientDataDict(self.client_data_provider, TEST)
+        train_data_local_num_dict = ClientDataDict(self.client_data_provider, TRAIN_NUM)
+
+        train_data_global, test_data_global, train_data_num = None, None, 0
+        return (train_data_num, train_data_global, test_data_global,
+                train_data_local_num_dict, train_data_local_dict, test_data_local_dict, self.num_clients)
 
+    def _load_client_data(self, client_idx):
         data_file = h5py.File(self.args.data_file_path, "r", swmr=True)
         partition_file = h5py.File(
             self.args.partition_file_path, "r", swmr=True)
         partition_method = self.args.partition_method
 
-        train_data_local_dict = {}
-        test_data_local_dict = {}
-        train_data_local_num_dict = {}
-        self.client_index_list = list(set(self.client_index_list))
-        logging.info("self.client_index_list = " + str(self.client_index_list))
+        # TODO: cancel the partiation file usage
+        train_index_list = partition_file[partition_method][
+            "partition_data"][
+            str(client_idx)]["train"][
+            ()]
+        test_index_list = partition_file[partition_method][
+            "partition_data"][
+            str(client_idx)]["test"][
+            ()]
+        state, res = self._load_data_loader_from_cache("client", train_index_list, test_index_list)
+        if state:
+            train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = res
+        else:
+            train_data = self.read_instance_from_h5(
+                data_file, train_index_list, desc=" train data of client_id=%d [_load_federated_data_local] "%client_idx)
+            test_data = self.read_instance_from_h5(
+                data_file, test_index_list, desc=" test data of client_id=%d [_load_federated_data_local] "%client_idx)
 
-        for client_idx in self.client_index_list:
-            # TODO: cancel the partiation file usage
-            state, res = self._load_data_loader_from_cache(client_idx)
-            if state:
-                train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = res
-            else:
-                train_index_list = partition_file[partition_method][
-                    "partition_data"][
-                    str(client_idx)]["train"][
-                    ()]
-                test_index_list = partition_file[partition_method][
-                    "partition_data"][
-                    str(client_idx)]["test"][
-                    ()]
-                train_data = self.read_instance_from_h5(
-                    data_file, train_index_list, desc=" train data of client_id=%d [_load_federated_data_local] "%client_idx)
-                test_data = self.read_instance_from_h5(
-                    data_file, test_index_list, desc=" test data of client_id=%d [_load_federated_data_local] "%client_idx)
-                
-                train_examples, train_features, train_dataset = self.preprocessor.transform(
-                    **train_data, index_list=train_index_list)
-                test_examples, test_features, test_dataset = self.preprocessor.transform(
-                    **test_data, index_list=test_index_list, evaluate=True)
-                
-                with open(res, "wb") as handle:
-                    pickle.dump((train_examples, train_features, train_dataset, test_examples, test_features, test_dataset), handle)
-
-
-            train_loader = BaseDataLoader(train_examples, train_features, train_dataset,
-                                    batch_size=self.train_batch_size,
-                                    num_workers=0,
-                                    pin_memory=True,
-                                    drop_last=False)
-
-            test_loader = BaseDataLoader(test_examples, test_features, test_dataset,
-                                    batch_size=self.eval_batch_size,
-                                    num_workers=0,
-                                    pin_memory=True,
-                                    drop_last=False)
-            train_data_local_dict[client_idx] = train_loader
-            test_data_local_dict[client_idx] = test_loader
-            train_data_local_num_dict[client_idx] = len(train_loader)
+            train_examples, train_features, train_dataset = self.preprocessor.transform(
+                **train_data, index_list=train_index_list)
+            test_examples, test_features, test_dataset = self.preprocessor.transform(
+                **test_data, index_list=test_index_list, evaluate=True)
 
+            train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = \
+                self._save_data_loader_to_cache(res, (train_examples, train_features, train_dataset,
+                                                      test_examples, test_features, test_dataset))
         data_file.close()
         partition_file.close()
 
-        train_data_global, test_data_global, train_data_num = None, None, 0
-        return (train_data_num, train_data_global, test_data_global,
-                train_data_local_num_dict, train_data_local_dict, test_data_local_dict, self.num_clients)
-    
+        train_loader = self._create_data_loader(train_examples, train_features, train_dataset, train=True)
+        test_loader = self._create_data_loader(test_examples, test_features, test_dataset, train=False)
+        logging.info("loaded client %d, feature cache stats: %s" % (client_idx, str(self._get_feature_cache().stats())))
+        return train_loader, test_loader
 
-    def _load_data_loader_from_cache(self, client_id):
+    def _create_data_loader(self, examples, features, dataset, train=False):
         """
-        Different clients has different cache file. client_id = -1 means loading the cached file on server end.
+        With model_args.dynamic_padding every batch is padded to its longest sequence only; with
+        model_args.length_bucketing the train batches are also drawn from buckets of similar length.
+        Both need the features of a TensorDataset with the attention mask as its third tensor.
+        """
+        batch_size = self.train_batch_size if train else self.eval_batch_size
+        kwargs = {}
+        if isinstance(dataset, TensorDataset) and self.model_args.dynamic_padding:
+            kwargs["collate_fn"] = DynamicPaddingCollator()
+            if train and self.model_args.length_bucketing:
+                lengths = dataset.tensors[2].sum(dim=1).numpy()
+                kwargs["batch_sampler"] = LengthBucketBatchSampler(
+                    lengths, batch_size, self.model_args.bucket_size_multiplier,
+                    seed=self.model_args.manual_seed or 0)
+        if "batch_sampler" not in kwargs:
+            kwargs["batch_size"] = batch_size
+            kwargs["drop_last"] = False
+        return BaseDataLoader(examples, features, dataset,
+                              num_workers=self.model_args.dataloader_num_workers,
+                              pin_memory=True,
+                              **kwargs)
+
+    def _get_feature_cache(self):
+        if self.feature_cache is None:
+            self.feature_cache = FeatureCache(
+                self.model_args.cache_dir, self.model_args.max_cache_size_gb)
+        return self.feature_cache
+
+    def _get_tokenizer_digest(self):
+        if self._tokenizer_digest is None:
+            tokenizer = getattr(self.preprocessor, "tokenizer", None)
+            tokenizers = tokenizer if isinstance(tokenizer, (list, tuple)) else [tokenizer]
+            self._tokenizer_digest = FeatureCache.hash_object([
+                {"class": type(t).__name__,
+                 "do_lower_case": getattr(t, "do_lower_case", None),
+                 "vocab": sorted(t.get_vocab().items()) if hasattr(t, "get_vocab") else None}
+                for t in tokenizers])
+        return self._tokenizer_digest
+
+    def _get_preprocessor_config(self):
+        model_args = self.model_args
+        text_cleaner = getattr(self.preprocessor, "text_cleaner", None)
+        config = {name: getattr(model_args, name, None) for name in FEATURE_ARGS}
+        config["preprocessor"] = type(self.preprocessor).__module__ + "." + type(self.preprocessor).__name__
+        config["text_cleaner"] = getattr(text_cleaner, "__name__", None)
+        config["label_vocab"] = getattr(self.preprocessor, "label_vocab", None)
+        config["dataset"] = self.args.dataset
+        return config
+
+    def _load_data_loader_from_cache(self, role, train_index_list, test_index_list):
+        """
+        The cache key is a hash of the tokenizer vocab, the preprocessor config, the index lists and the data file
+        checksum. role is "centralized", "server" or "client" since they transform the data differently.
+        Returns (True, cached tuple) on a hit, otherwise (False, key) to pass to _save_data_loader_to_cache.
         """
-        args = self.args
         model_args = self.model_args
-        if not os.path.exists(model_args.cache_dir):
-            os.mkdir(model_args.cache_dir)
-        cached_features_file = os.path.join(
-            model_args.cache_dir, args.model_type + "_" + args.model_name.split("/")[-1] + "_cached_" + str(args.max_seq_length) + "_" + model_args.model_class + "_" 
-            + args.dataset + "_" + args.partition_method + "_" + str(client_id)
-        )
-
-        if os.path.exists(cached_features_file) and (
-            (not model_args.reprocess_input_data and not model_args.no_cache)
-            or (model_args.use_cached_eval_features and not model_args.no_cache)
-        ):
-            logging.info(" Loading features from cached file %s", cached_features_file)
-            train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = None, None, None, None, None, None
-            with open(cached_features_file, "rb") as handle:
-                train_examples, train_features, train_dataset, test_examples, test_features, test_dataset = pickle.load(handle)
-            return True, (train_examples, train_features, train_dataset, test_examples, test_features, test_dataset)
-        return False, cached_features_file
\ No newline at end of file
+        feature_cache = self._get_feature_cache()
+        key = feature_cache.make_key(
+            role=role,
+            tokenizer=self._get_tokenizer_digest(),
+            preprocessor=self._get_preprocessor_config(),
+            train_index_list=FeatureCache.hash_index_list(train_index_list),
+            test_index_list=FeatureCache.hash_index_list(test_index_list),
+            data_file=feature_cache.file_checksum(self.args.data_file_path))
+
+        if (not model_args.reprocess_input_data and not model_args.no_cache) or (
+                model_args.use_cached_eval_features and not model_args.no_cache):
+            res = feature_cache.load(key)
+            if res is not None:
+                logging.info(" Loading features from feature cache %s", key)
+                return True, res
+        return False, key
+
+    def _save_data_loader_to_cache(self, key, res):
+        """
+        Returns res with the datasets replaced by memory-mapped views of the cache entry, so processes on the same
+        host share one copy of the features.
+        """
+        if self.model_args.no_cache:
+            return res
+        return self._get_feature_cache().save(key, res)
@@ -0,0 +1,134 @@
+"""
+Lazy per-client data loading for the client processes.
+
+Instead of building the loaders of every client a worker is assigned to before training starts,
+a ClientDataProvider builds them the first time a client is used, keeps at most max_cached_clients
+of them in an LRU and, while a round trains, prepares the client of the next round in a background
+thread. The dictionaries returned by BaseDataManager._load_federated_data_local are ClientDataDict
+views of the provider, so the trainers keep indexing them by client index.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+TRAIN = 0
+TEST = 1
+TRAIN_NUM = 2
+
+
+class ClientDataProvider(object):
+    def __init__(self, load_fn, client_schedule, max_cached_clients=2, prefetch=True):
+        """
+        load_fn(client_idx) returns (train_loader, test_loader) of a client.
+        client_schedule is the client index of this worker for each round, used to know whom to prefetch.
+        """
+        self.load_fn = load_fn
+        self.client_schedule = list(client_schedule)
+        self.client_index_list = list(OrderedDict.fromkeys(self.client_schedule))
+        self.max_cached_clients = max(max_cached_clients, 1)
+        self.prefetch_enabled = prefetch
+        self.round_pointer = 0
+        self.current_client_idx = None
+        self.cache = OrderedDict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self.loads = 0
+        self.hits = 0
+
+    def get(self, client_idx):
+        """Return (train_loader, test_loader, number of train batches) of the client."""
+        if client_idx not in self.client_index_list:
+            raise KeyError(client_idx)
+        with self.lock:
+            if client_idx in self.cache:
+                self.cache.move_to_end(client_idx)
+                self.hits += 1
+                client_data = self.cache[client_idx]
+                future = None
+            else:
+                client_data = None
+                future = self.pending.get(client_idx, None)
+        if client_data is None:
+            if future is not None:
+                client_data = future.result()
+            else:
+                client_data = self._load(client_idx)
+        self._advance(client_idx)
+        return client_data
+
+    def prefetch(self, client_idx):
+        if self.executor is None:
+            return
+        with self.lock:
+            if client_idx in self.cache or client_idx in self.pending:
+                return
+            self.pending[client_idx] = self.executor.submit(self._load, client_idx)
+
+    def _load(self, client_idx):
+        try:
+            train_loader, test_loader = self.load_fn(client_idx)
+        except Exception:
+            with self.lock:
+                self.pending.pop(client_idx, None)
+            raise
+        client_data = (train_loader, test_loader, len(train_loader))
+        with self.lock:
+            self.loads += 1
+            self.pending.pop(client_idx, None)
+            self.cache[client_idx] = client_data
+            self.cache.move_to_end(client_idx)
+            while len(self.cache) > self.max_cached_clients:
+                evicted_idx, _ = self.cache.popitem(last=False)
+                logging.info("client data provider evicted client %d" % evicted_idx)
+        return client_data
+
+    def _advance(self, client_idx):
+        # the trainers look up the loaders and the sample number of a client separately, so only a new client moves
+        # the schedule forward; then prefetch the next different client of the schedule
+        if client_idx == self.current_client_idx:
+            return
+        self.current_client_idx = client_idx
+        for pointer in range(self.round_pointer, len(self.client_schedule)):
+            if self.client_schedule[pointer] == client_idx:
+                self.round_pointer = pointer + 1
+                break
+        for pointer in range(self.round_pointer, len(self.client_schedule)):
+            if self.client_schedule[pointer] != client_idx:
+                self.prefetch(self.client_schedule[pointer])
+                break
+
+    def start(self):
+        """Prefetch the client of the first round, so it is ready when training starts."""
+        if len(self.client_schedule) > 0:
+            self.prefetch(self.client_schedule[0])
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def stats(self):
+        return {"loads": self.loads, "hits": self.hits, "cached": list(self.cache.keys())}
+
+
+class ClientDataDict(Mapping):
+    """Read-only dict view of one field (train loader, test loader or train batch number) of a ClientDataProvider."""
+
+    def __init__(self, provider, field):
+        self.provider = provider
+        self.field = field
+
+    def __getitem__(self, client_idx):
+        return self.provider.get(client_idx)[self.field]
+
+    def __iter__(self):
+        return iter(self.provider.client_index_list)
+
+    def __len__(self):
+        return len(self.provider.client_index_list)
+
+    def __contains__(self, client_idx):
+        return client_idx in self.provider.client_index_list
@@ -0,0 +1,248 @@
+"""
+Content-addressed cache of the preprocessed (examples, features, dataset) triples.
+
+An entry is keyed by a hash of everything the features depend on: the cache format version,
+the tokenizer vocabulary, the preprocessor config, the index lists of the partition and the
+checksum of the data file. Each entry is a directory
+
+    <cache_dir>/<key>/
+        train_meta.pkl, test_meta.pkl       the dataset kind and the numbers of examples and features
+        train_examples.pkl, ...             examples and features, unpickled when they are first used
+        train_<i>.npy, test_<i>.npy         tensors of a TensorDataset, loaded as a MmapTensorDataset
+
+Only the tensors are needed to train, so a client process never unpickles the (large) python
+lists of examples and features unless it evaluates on them (span extraction, the wrong
+predictions of text classification).
+
+Entries are written to a temporary directory and renamed into place, so a reader never sees
+a partial entry. When max_size_gb is set, the least recently used entries are evicted after
+each write until the cache directory fits.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+from collections.abc import Sequence
+
+import numpy as np
+from torch.utils.data import TensorDataset
+
+from data_preprocessing.base.mmap_dataset import MmapTensorDataset
+
+# bump when the layout of an entry or the preprocessing output changes
+CACHE_VERSION = 2
+
+SPLITS = ["train", "test"]
+
+CHECKSUM_FILE = "checksums.json"
+
+
+class LazyPickledList(Sequence):
+    """
+    A pickled list of a cache entry, read from its file when an item is first accessed. The file is opened right
+    away, so the list can still be read if the entry is evicted in the meantime.
+    """
+
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+        self.items = None
+        self.handle = open(path, "rb")
+
+    def _load(self):
+        if self.items is None:
+            handle = self.handle if self.handle is not None else open(self.path, "rb")
+            with handle:
+                self.items = pickle.load(handle)
+            self.handle = None
+        return self.items
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # copies (e.g. to data loader workers) read the file again if they need the items
+        state = self.__dict__.copy()
+        state["items"] = None
+        state["handle"] = None
+        return state
+
+
+class FeatureCache(object):
+    def __init__(self, cache_dir, max_size_gb=None):
+        self.cache_dir = cache_dir
+        self.max_size = None if max_size_gb is None else int(max_size_gb * (1 << 30))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def hash_object(obj):
+        return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def hash_index_list(index_list):
+        if index_list is None:
+            return None
+        return hashlib.sha1(np.ascontiguousarray(index_list, dtype=np.int64).tobytes()).hexdigest()
+
+    def file_checksum(self, file_path):
+        """sha1 of the file content, memoized on (path, size, mtime) in the cache directory."""
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        stamp = "%d_%d" % (stat.st_size, stat.st_mtime_ns)
+        checksum_path = os.path.join(self.cache_dir, CHECKSUM_FILE)
+        checksums = dict()
+        if os.path.exists(checksum_path):
+            try:
+                with open(checksum_path, "r") as f:
+                    checksums = json.load(f)
+            except ValueError:
+                checksums = dict()
+        if file_path in checksums and checksums[file_path]["stamp"] == stamp:
+            return checksums[file_path]["sha1"]
+
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                sha1.update(block)
+        checksums[file_path] = {"stamp": stamp, "sha1": sha1.hexdigest()}
+        self._atomic_write(checksum_path, json.dumps(checksums).encode("utf-8"))
+        return checksums[file_path]["sha1"]
+
+    def make_key(self, **components):
+        return self.hash_object({"version": CACHE_VERSION, "components": components})
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _atomic_write(self, path, content):
+        tmp_path = "%s.tmp.%d" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        """Return (train_examples, train_features, train_dataset, test_examples, test_features,
+        test_dataset) or None on a miss."""
+        res = self._read(key)
+        if res is None:
+            self.misses += 1
+            return None
+        # the mtime of an entry is its last access time for the LRU eviction
+        try:
+            os.utime(self._entry_path(key), None)
+        except OSError:
+            # evicted by another process since, the tensors are mapped already
+            pass
+        self.hits += 1
+        logging.info("feature cache hit %s (%s)" % (key, self.stats()))
+        return res
+
+    def _read(self, key):
+        entry_path = self._entry_path(key)
+        if not os.path.isdir(entry_path):
+            return None
+        res = list()
+        try:
+            for split in SPLITS:
+                with open(os.path.join(entry_path, split + "_meta.pkl"), "rb") as handle:
+                    meta = pickle.load(handle)
+                if meta["version"] != CACHE_VERSION:
+                    return None
+                if meta["kind"] == "tensor":
+                    dataset = MmapTensorDataset.load(
+                        [os.path.join(entry_path, "%s_%d.npy" % (split, i)) for i in range(meta["num_tensors"])],
+                        meta["names"])
+                else:
+                    dataset = meta["dataset"]
+                lists = [None if meta[name] is None else
+                         LazyPickledList(os.path.join(entry_path, "%s_%s.pkl" % (split, name)), meta[name])
+                         for name in ["examples", "features"]]
+                res.extend(lists + [dataset])
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            # another process sharing the cache directory evicted the entry while it was read
+            logging.info("feature cache entry %s is gone: %s" % (key, str(e)))
+            return None
+        return tuple(res)
+
+    def save(self, key, res):
+        """
+        Write the entry and return it re-read from the cache, so the in-memory tensors can be released in favour
+        of the memory-mapped ones.
+        """
+        entry_path = self._entry_path(key)
+        tmp_path = "%s.tmp.%d" % (entry_path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for i, split in enumerate(SPLITS):
+            examples, features, dataset = res[3 * i: 3 * i + 3]
+            meta = {"version": CACHE_VERSION}
+            for name, items in [("examples", examples), ("features", features)]:
+                meta[name] = None if items is None else len(items)
+                if items is not None:
+                    with open(os.path.join(tmp_path, "%s_%s.pkl" % (split, name)), "wb") as handle:
+                        pickle.dump(list(items), handle, protocol=pickle.HIGHEST_PROTOCOL)
+            if isinstance(dataset, TensorDataset):
+                meta["kind"] = "tensor"
+                meta["num_tensors"] = len(dataset.tensors)
+                meta["names"] = getattr(dataset, "names", None)
+                for j, tensor in enumerate(dataset.tensors):
+                    np.save(os.path.join(tmp_path, "%s_%d.npy" % (split, j)), tensor.numpy())
+            else:
+                meta["kind"] = "object"
+                meta["dataset"] = dataset
+            with open(os.path.join(tmp_path, split + "_meta.pkl"), "wb") as handle:
+                pickle.dump(meta, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.isdir(entry_path):
+            # another process wrote the same entry in the meantime
+            shutil.rmtree(tmp_path)
+        else:
+            try:
+                os.rename(tmp_path, entry_path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        logging.info("feature cache saved %s" % key)
+        self.evict(keep=key)
+        cached_res = self._read(key)
+        return res if cached_res is None else cached_res
+
+    @staticmethod
+    def _dir_size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        return size
+
+    def evict(self, keep=None):
+        if self.max_size is None:
+            return
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path) and ".tmp." not in name:
+                entries.append((os.path.getmtime(path), self._dir_size(path), name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            total_size -= size
+            self.evictions += 1
+            logging.info("feature cache evicted %s" % name)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -1,4 +1,5 @@
 from data_manager.base_data_manager import BaseDataManager
+from data.raw_data_loader.base.columnar import is_columnar, read_columns
 from torch.utils.data import DataLoader
 import h5py
 import json
@@ -17,6 +18,8 @@ class LanguageModelDataManager(BaseDataManager):
 
 
     def read_instance_from_h5(self, data_file, index_list, desc=""):
+        if is_columnar(data_file):
+            return {"X": read_columns(data_file, ["X"], index_list)["X"]}
         X = list()
         for idx in tqdm(index_list, desc="Loading data from h5 file." + desc):
             X.append(data_file["X"][str(idx)][()].decode("utf-8"))
@@ -30,6 +33,8 @@ class StackOverFlowDataManager(LanguageModelDataManager):
         self.CHUNK_SIZE = 1000000
 
     def read_instance_from_h5(self, data_file, index_list, desc=""):
+        if is_columnar(data_file):
+            return {"X": read_columns(data_file, ["X"], index_list)["X"]}
         X = list()
         for idx in tqdm(index_list, desc="Loading data from h5 file." + desc):
             group_id = int(idx / self.CHUNK_SIZE)
@@ -1,4 +1,5 @@
 from data_manager.base_data_manager import BaseDataManager
+from data.raw_data_loader.base.columnar import is_columnar, read_columns
 from tqdm import tqdm
 
 class Seq2SeqDataManager(BaseDataManager):
@@ -17,6 +18,9 @@ class Seq2SeqDataManager(BaseDataManager):
 
 
     def read_instance_from_h5(self, data_file, index_list, desc=""):
+        if is_columnar(data_file):
+            columns = read_columns(data_file, ["X", "Y"], index_list)
+            return {"X": columns["X"], "y": columns["Y"]}
         X = list()
         y = list()
         for idx in tqdm(index_list, desc="Loading data from h5 file." + desc):
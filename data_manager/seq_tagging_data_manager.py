@@ -1,4 +1,6 @@
 from data_manager.base_data_manager import BaseDataManager
+from data.raw_data_loader.base.columnar import is_columnar, read_columns
+from data_preprocessing.utils.seq_tagging_utils import LazySeqTaggingDataset
 import h5py
 from torch.utils.data import DataLoader
 import logging
@@ -21,9 +23,37 @@ class SequenceTaggingDataManager(BaseDataManager):
 
 
     def read_instance_from_h5(self, data_file, index_list, desc=""):
+        if is_columnar(data_file):
+            columns = read_columns(data_file, ["X", "Y"], index_list)
+            return {"X": columns["X"], "y": columns["Y"]}
         X = list()
         y = list()
         for idx in tqdm(index_list, desc="Loading data from h5 file." + desc):
             X.append([s.decode("utf-8") for s in data_file["X"][str(idx)][()]])
             y.append([s.decode("utf-8") for s in data_file["Y"][str(idx)][()]])
-        return {"X": X, "y": y}
\ No newline at end of file
+        return {"X": X, "y": y}
+
+    def _load_client_data(self, client_idx):
+        """
+        With model_args.lazy_loading the samples of the client are read from the data file and tokenized when a
+        batch needs them (see LazySeqTaggingDataset), instead of converting all of them to features here.
+        """
+        if not self.model_args.lazy_loading:
+            return super(SequenceTaggingDataManager, self)._load_client_data(client_idx)
+        partition_file = h5py.File(self.args.partition_file_path, "r", swmr=True)
+        partition_data = partition_file[self.args.partition_method]["partition_data"][str(client_idx)]
+        train_index_list = partition_data["train"][()]
+        test_index_list = partition_data["test"][()]
+        partition_file.close()
+
+        self.model_args.labels_list = list(self.preprocessor.label_vocab.keys())
+        text_cleaner = getattr(self.preprocessor, "text_cleaner", None)
+        train_dataset = LazySeqTaggingDataset(self.args.data_file_path, train_index_list, self.preprocessor.tokenizer,
+                                              self.model_args, text_cleaner)
+        test_dataset = LazySeqTaggingDataset(self.args.data_file_path, test_index_list, self.preprocessor.tokenizer,
+                                             self.model_args, text_cleaner)
+        train_loader = self._create_data_loader(None, None, train_dataset, train=True)
+        test_loader = self._create_data_loader(None, None, test_dataset, train=False)
+        logging.info("lazily loading client %d, %d train and %d test samples" % (
+            client_idx, len(train_dataset), len(test_dataset)))
+        return train_loader, test_loader
@@ -1,4 +1,5 @@
 from data_manager.base_data_manager import BaseDataManager
+from data.raw_data_loader.base.columnar import is_columnar, read_columns
 from tqdm import tqdm
 import logging
 
@@ -13,6 +14,8 @@ class SpanExtractionDataManager(BaseDataManager):
 
         
     def read_instance_from_h5(self, data_file, index_list, desc=""):
+        if is_columnar(data_file):
+            return self._read_columns_from_h5(data_file, index_list)
         context_X = list()
         question_X = list()
         y = list()
@@ -33,3 +36,18 @@ class SpanExtractionDataManager(BaseDataManager):
             "qas_ids": qas_ids if qas_ids else None
             }
 
+    def _read_columns_from_h5(self, data_file, index_list):
+        field_names = ["context_X", "question_X", "Y"]
+        field_names += [name for name in ["Y_answer", "question_ids"] if name in data_file]
+        columns = read_columns(data_file, field_names, index_list)
+        if "Y_answer" in columns:
+            y_answers = columns["Y_answer"]
+        else:
+            y_answers = [context[start:end] for context, (start, end) in zip(columns["context_X"], columns["Y"])]
+        return {
+            "context_X": columns["context_X"],
+            "question_X": columns["question_X"],
+            "y": columns["Y"],
+            "y_answers": y_answers,
+            "qas_ids": columns.get("question_ids", None)
+            }
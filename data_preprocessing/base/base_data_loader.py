@@ -1,11 +1,78 @@
-from torch.utils.data import DataLoader
+import numpy as np
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 
 '''
-Since the torch DataLoder cannot fullfill all of our requirements, 
+Since the torch DataLoder cannot fullfill all of our requirements,
 we desgin this DataLoader to replace it.
 '''
 class BaseDataLoader(DataLoader):
     def __init__(self, examples, features, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.examples = examples
-        self.features = features
\ No newline at end of file
+        self.features = features
+
+
+class DynamicPaddingCollator(object):
+    """
+    Collate function that pads a batch only to its longest sequence instead of max_seq_length.
+    The features are padded to max_seq_length by the preprocessors, so the batch is collated as usual and then all
+    the sequence tensors (those shaped like the attention mask) are cut after the last column where a sample of the
+    batch has a real token. Only trailing columns are cut, so the token positions (start/end positions, cls_index,
+    token_to_orig_map) stay valid; left (XLNet) padded batches are kept at their full length.
+    """
+
+    def __init__(self, mask_index=2):
+        self.mask_index = mask_index
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        mask = batch[self.mask_index]
+        used = np.flatnonzero(mask.any(dim=0).numpy())
+        if len(used) == 0:
+            return batch
+        end = int(used[-1]) + 1
+        if end == mask.shape[1]:
+            return batch
+        return [t[:, :end].contiguous() if t.dim() > 1 and t.shape[1] == mask.shape[1] else t for t in batch]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples of similar length, so dynamic padding removes most of the padding.
+    Every epoch the samples are shuffled, cut into buckets of batch_size * bucket_size_multiplier samples, sorted by
+    length within a bucket and split into batches; the order of the batches is shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=100, drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        indices = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start: start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[batch_start: batch_start + self.batch_size])
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        for i in rng.permutation(len(batches)):
+            yield batches[i].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            # only the last batch of every bucket can be short
+            full_buckets, rest = divmod(len(self.lengths), self.bucket_size)
+            return full_buckets * (self.bucket_size // self.batch_size) + rest // self.batch_size
+        n_batches = 0
+        for start in range(0, len(self.lengths), self.bucket_size):
+            n_batches += int(np.ceil(min(self.bucket_size, len(self.lengths) - start) / self.batch_size))
+        return n_batches
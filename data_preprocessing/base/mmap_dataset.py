@@ -0,0 +1,34 @@
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+
+class MmapTensorDataset(TensorDataset):
+    """
+    TensorDataset whose tensors are torch.from_numpy views of numpy arrays, so building it costs no copy.
+
+    When loaded with MmapTensorDataset.load the arrays are memory-mapped .npy files opened
+    copy-on-write: every process on a host that maps the same files shares one page-cached copy, and
+    pickling the dataset (e.g. for DataLoader workers) only sends the file paths.
+    The tensors are also reachable by name, e.g. dataset.input_ids.
+    """
+
+    def __init__(self, arrays, names=None, paths=None):
+        super(MmapTensorDataset, self).__init__(*[torch.from_numpy(array) for array in arrays])
+        self.names = list(names) if names is not None else None
+        self.paths = paths
+
+    def __getattr__(self, name):
+        names = self.__dict__.get("names", None)
+        if names is not None and name in names:
+            return self.tensors[names.index(name)]
+        raise AttributeError(name)
+
+    def __reduce__(self):
+        if self.paths is None:
+            return MmapTensorDataset, ([tensor.numpy() for tensor in self.tensors], self.names)
+        return MmapTensorDataset.load, (self.paths, self.names)
+
+    @staticmethod
+    def load(paths, names=None):
+        return MmapTensorDataset([np.load(path, mmap_mode="c") for path in paths], names, paths)
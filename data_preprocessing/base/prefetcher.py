@@ -0,0 +1,97 @@
+import queue
+import threading
+
+import torch
+
+
+class DevicePrefetcher(object):
+    """
+    Iterate over a data loader with the next batches already assembled and on the device.
+
+    A background thread pulls up to `depth` batches ahead from the loader, pins them and copies them to the device
+    with non_blocking copies on a separate CUDA stream, so collating, host-to-device transfer and the training step
+    of the current batch overlap. The main thread waits for the copy of a batch only when it takes it.
+    On the CPU the batches are just assembled ahead of time. depth=0 iterates over the loader directly.
+    """
+
+    _END = object()
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for batch in self.loader:
+                yield self._to_device(batch, non_blocking=False)
+            return
+
+        use_cuda = self.device.type == "cuda"
+        stream = torch.cuda.Stream(device=self.device) if use_cuda else None
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if stop.is_set():
+                        return
+                    event = None
+                    if use_cuda:
+                        with torch.cuda.stream(stream):
+                            batch = self._to_device(self._pin(batch), non_blocking=True)
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                    else:
+                        batch = self._to_device(batch, non_blocking=False)
+                    batches.put((batch, event))
+                batches.put((self._END, None))
+            except Exception as e:
+                batches.put((e, None))
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch, event = batches.get()
+                if batch is self._END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    # the tensors were allocated on the copy stream, keep them alive until the compute stream is done
+                    self._record_stream(batch, current_stream)
+                yield batch
+        finally:
+            stop.set()
+            # unblock the producer if it waits on a full queue
+            while producer.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+
+    def _apply(self, batch, fn):
+        if torch.is_tensor(batch):
+            return fn(batch)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._apply(t, fn) for t in batch)
+        if isinstance(batch, dict):
+            return {k: self._apply(v, fn) for k, v in batch.items()}
+        return batch
+
+    def _pin(self, batch):
+        return self._apply(batch, lambda t: t if t.is_pinned() else t.pin_memory())
+
+    def _to_device(self, batch, non_blocking):
+        return self._apply(batch, lambda t: t.to(self.device, non_blocking=non_blocking))
+
+    def _record_stream(self, batch, stream):
+        self._apply(batch, lambda t: t.record_stream(stream) if t.is_cuda else None)
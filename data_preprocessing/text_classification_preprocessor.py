@@ -3,13 +3,14 @@ import os
 import re
 import string
 
+import numpy as np
 import pandas as pd
-import torch
-from torch.utils.data import TensorDataset
 
 from data_preprocessing.base.base_example import TextClassificationInputExample
 from data_preprocessing.base.base_preprocessor import BasePreprocessor
-from data_preprocessing.utils.text_classification_utils import convert_examples_to_features
+from data_preprocessing.base.mmap_dataset import MmapTensorDataset
+from data_preprocessing.utils.text_classification_utils import convert_examples_to_features, \
+    convert_examples_to_feature_arrays
 
 customized_cleaner_dict = {}
 
@@ -45,15 +46,23 @@ class TLMPreprocessor(BasePreprocessor):
         if index_list is None:
             index_list = [i for i in range(len(X))]
         examples = self.transform_examples(X, y, index_list)
-        features = self.transform_features(examples, evaluate=evaluate)
-
-        all_guid = torch.tensor([f.guid for f in features], dtype=torch.long)
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
-
-        dataset = TensorDataset(all_guid, all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        if self.args.use_fast_tokenizer:
+            # the fast path emits the feature arrays directly, there are no InputFeatures objects
+            features = None
+            feature_arrays = self.transform_feature_arrays(examples, evaluate=evaluate)
+            all_guid, all_input_ids, all_input_mask, all_segment_ids, all_label_ids = [
+                feature_arrays[name] for name in ["guid", "input_ids", "input_mask", "segment_ids", "label_ids"]]
+        else:
+            features = self.transform_features(examples, evaluate=evaluate)
+            all_guid = np.array([f.guid for f in features], dtype=np.int64)
+            all_input_ids = np.array([f.input_ids for f in features], dtype=np.int64)
+            all_input_mask = np.array([f.input_mask for f in features], dtype=np.int64)
+            all_segment_ids = np.array([f.segment_ids for f in features], dtype=np.int64)
+            all_label_ids = np.array([f.label_id for f in features], dtype=np.int64)
+
+        # the tensors are views of the arrays; the data manager swaps them for memory-mapped views of the feature cache
+        dataset = MmapTensorDataset([all_guid, all_input_ids, all_input_mask, all_segment_ids, all_label_ids],
+                                    names=["guid", "input_ids", "input_mask", "segment_ids", "label_ids"])
 
         return examples, features, dataset
 
@@ -148,6 +157,38 @@ class TLMPreprocessor(BasePreprocessor):
             #     torch.save(features, cached_features_file)
         return features
 
+    def transform_feature_arrays(self, examples, evaluate=False, silent=False):
+        """
+        Same features as transform_features, tokenized in batches by a fast tokenizer and returned as numpy arrays.
+        """
+        tokenizer = self.tokenizer
+        args = self.args
+
+        if args.labels_map and not args.regression:
+            for example in examples:
+                example.label = args.labels_map[example.label]
+
+        feature_arrays = convert_examples_to_feature_arrays(
+            examples,
+            args.max_seq_length,
+            tokenizer,
+            cls_token_at_end=bool(args.model_type in ["xlnet"]),
+            cls_token=tokenizer.cls_token,
+            cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
+            sep_token=tokenizer.sep_token,
+            sep_token_extra=bool(args.model_type in ["roberta", "camembert", "xlmroberta", "longformer"]),
+            pad_on_left=bool(args.model_type in ["xlnet"]),
+            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+            silent=args.silent or silent,
+            sliding_window=args.sliding_window,
+            stride=args.stride,
+            add_prefix_space=bool(args.model_type in ["roberta", "camembert", "xlmroberta", "longformer"]),
+            pad_to_max_length=bool(len(examples) > 1),
+        )
+        logging.info(f" {len(feature_arrays['guid'])} features created from {len(examples)} samples.")
+        return feature_arrays
+
 
 def cleaner_sentiment140(text):
     # return text  # TODO: if you would like to skip this.
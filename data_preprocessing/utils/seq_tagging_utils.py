@@ -17,19 +17,22 @@
 
 from __future__ import absolute_import, division, print_function
 
-import linecache
 import logging
 import os
 from io import open
 from multiprocessing import Pool, cpu_count
 
+import h5py
+import numpy as np
 import pandas as pd
 import torch
 from torch.functional import split
-from torch.nn import CrossEntropyLoss
 from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 
+from data.raw_data_loader.base.columnar import is_columnar, get_rows, OFFSETS_SUFFIX
+from data_preprocessing.base.base_example import SeqTaggingInputExample
+
 class InputFeatures(object):
     """A single set of features of data."""
 
@@ -349,70 +352,106 @@ def get_labels(path):
         ]
 
 
-class LazyNERDataset(Dataset):
-    def __init__(self, data_file, tokenizer, args):
-        self.data_file = data_file
-        self.lazy_loading_start_line = args.lazy_loading_start_line if args.lazy_loading_start_line else 0
-        self.example_lines, self.num_entries = self._get_examples(self.data_file, self.lazy_loading_start_line)
-        self.tokenizer = tokenizer
-        self.args = args
-        self.pad_token_label_id = CrossEntropyLoss().ignore_index
-
-    @staticmethod
-    def _get_examples(data_file, lazy_loading_start_line):
-        example_lines = {}
-        start = lazy_loading_start_line
-        entry_num = 0
-        with open(data_file, encoding="utf-8") as f:
-            for line_idx, _ in enumerate(f, 1):
-                if _ == "\n" and line_idx > lazy_loading_start_line:
-                    example_lines[entry_num] = (start, line_idx)
-                    start = line_idx + 1
-                    entry_num += 1
-
-        return example_lines, entry_num
-
-    def __getitem__(self, idx):
-        start, end = self.example_lines[idx]
-        words, labels = [], []
-        for idx in range(start, end):
-            line = linecache.getline(self.data_file, idx).rstrip("\n")
-            splits = line.split(" ")
-            words.append(splits[0])
-            if len(splits) > 1:
-                labels.append(splits[-1].replace("\n", ""))
-            else:
-                # Examples could have no label for mode = "test"
-                labels.append("O")
-        if words:
-            example = InputExample(guid="%s-%d".format("train", idx), words=words, labels=labels)
+class LazySeqTaggingDataset(Dataset):
+    """
+    Sequence tagging dataset of the samples index_list of an h5 data file (columnar or legacy layout), tokenized the
+    first time a sample is used instead of up front.
 
-        label_map = {label: i for i, label in enumerate(self.args.labels_list)}
+    Every process (e.g. every DataLoader worker) opens its own handle of the data file and reads one sentence per
+    item. The features are kept in preallocated int arrays of max_seq_length columns, so a sample is only tokenized
+    once per process and the store takes 7 bytes per token. The label map and the special token ids are looked up
+    once. Items are (guid, input_ids, input_mask, segment_ids, label_ids) like the TensorDataset of TLMPreprocessor.
+    """
 
-        example_row = (
-            example,
-            label_map,
-            self.args.max_seq_length,
-            self.tokenizer,
-            bool(self.args.model_type in ["xlnet"]),
-            self.tokenizer.cls_token,
-            2 if self.args.model_type in ["xlnet"] else 0,
-            self.tokenizer.sep_token,
-            bool(self.args.model_type in ["roberta"]),
-            bool(self.args.model_type in ["xlnet"]),
-            self.tokenizer.convert_tokens_to_ids([self.tokenizer.pad_token])[0],
-            4 if self.args.model_type in ["xlnet"] else 0,
-            self.pad_token_label_id,
+    def __init__(self, data_file_path, index_list, tokenizer, args, text_cleaner=None):
+        self.data_file_path = data_file_path
+        self.index_list = np.asarray(index_list, dtype=np.int64)
+        self.tokenizer = tokenizer
+        self.args = args
+        self.text_cleaner = text_cleaner
+        self._data_file = None
+        self._pid = None
+
+        xlnet = args.model_type in ["xlnet"]
+        self.feature_args = (
+            {label: i for i, label in enumerate(args.labels_list)},
+            args.max_seq_length,
+            tokenizer,
+            # XLNet has a CLS token at the end
+            xlnet,
+            tokenizer.cls_token,
+            2 if xlnet else 0,
+            tokenizer.sep_token,
+            # RoBERTa uses an extra separator b/w pairs of sentences
+            bool(args.model_type in ["roberta"]),
+            # PAD on the left for XLNet
+            xlnet,
+            tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            4 if xlnet else 0,
+            args.pad_token_label_id,
             0,
             True,
         )
 
-        features = convert_example_to_feature(example_row)
-        all_input_ids = torch.tensor(features.input_ids, dtype=torch.long)
-        all_input_mask = torch.tensor(features.input_mask, dtype=torch.long)
-        all_segment_ids = torch.tensor(features.segment_ids, dtype=torch.long)
-        all_label_ids = torch.tensor(features.label_ids, dtype=torch.long)
-        return (all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        # [start, end) of the words and labels of every sample in a columnar data file
+        self.bounds = None
+        data_file = self._get_data_file()
+        if is_columnar(data_file):
+            rows = get_rows(data_file, self.index_list)
+            self.bounds = {}
+            for name in ["X", "Y"]:
+                offsets = data_file[name + OFFSETS_SUFFIX][()]
+                self.bounds[name] = np.stack([offsets[rows], offsets[rows + 1]], axis=1)
+
+        n, max_seq_length = len(self.index_list), args.max_seq_length
+        self.input_ids = np.zeros((n, max_seq_length), dtype=np.int32)
+        self.input_mask = np.zeros((n, max_seq_length), dtype=np.int8)
+        self.segment_ids = np.zeros((n, max_seq_length), dtype=np.int8)
+        self.label_ids = np.zeros((n, max_seq_length), dtype=np.int16)
+        self.cached = np.zeros(n, dtype=bool)
+
+    def __getstate__(self):
+        # the h5 handle is not shared with other processes
+        state = self.__dict__.copy()
+        state["_data_file"] = None
+        state["_pid"] = None
+        return state
+
+    def _get_data_file(self):
+        if self._data_file is None or self._pid != os.getpid():
+            self._data_file = h5py.File(self.data_file_path, "r", swmr=True)
+            self._pid = os.getpid()
+        return self._data_file
+
+    def _read_field(self, name, i):
+        data_file = self._get_data_file()
+        if self.bounds is not None:
+            start, end = self.bounds[name][i]
+            values = data_file[name][start:end]
+        else:
+            values = data_file[name][str(self.index_list[i])][()]
+        return [v.decode("utf-8") if isinstance(v, bytes) else v for v in values]
+
+    def _cache_features(self, i):
+        words = self._read_field("X", i)
+        if self.text_cleaner:
+            words = self.text_cleaner(words)
+        example = SeqTaggingInputExample(guid=int(self.index_list[i]), words=words, labels=self._read_field("Y", i))
+        features = convert_example_to_feature((example,) + self.feature_args)
+        self.input_ids[i] = features.input_ids
+        self.input_mask[i] = features.input_mask
+        self.segment_ids[i] = features.segment_ids
+        self.label_ids[i] = features.label_ids
+        self.cached[i] = True
+
+    def __getitem__(self, i):
+        if not self.cached[i]:
+            self._cache_features(i)
+        return (torch.tensor(self.index_list[i], dtype=torch.long),
+                torch.from_numpy(self.input_ids[i].astype(np.int64)),
+                torch.from_numpy(self.input_mask[i].astype(np.int64)),
+                torch.from_numpy(self.segment_ids[i].astype(np.int64)),
+                torch.from_numpy(self.label_ids[i].astype(np.int64)))
 
     def __len__(self):
-        return self.num_entries
+        return len(self.index_list)
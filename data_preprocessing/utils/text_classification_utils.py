@@ -24,6 +24,7 @@ from collections import Counter
 from io import open
 from multiprocessing import Pool, cpu_count
 
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
@@ -419,6 +420,129 @@ def convert_examples_to_features(
     return features
 
 
+def _batch_tokenize(tokenizer, texts, add_prefix_space, batch_size, silent):
+    if add_prefix_space:
+        texts = [text if text.startswith(" ") else " " + text for text in texts]
+    token_ids = []
+    for start in tqdm(range(0, len(texts), batch_size), disable=silent):
+        token_ids.extend(tokenizer(texts[start: start + batch_size], add_special_tokens=False)["input_ids"])
+    return token_ids
+
+
+def convert_examples_to_feature_arrays(
+        examples,
+        max_seq_length,
+        tokenizer,
+        cls_token_at_end=False,
+        sep_token_extra=False,
+        pad_on_left=False,
+        cls_token="[CLS]",
+        sep_token="[SEP]",
+        pad_token=0,
+        sequence_a_segment_id=0,
+        sequence_b_segment_id=1,
+        cls_token_segment_id=1,
+        pad_token_segment_id=0,
+        mask_padding_with_zero=True,
+        silent=False,
+        sliding_window=False,
+        stride=None,
+        add_prefix_space=False,
+        pad_to_max_length=True,
+        batch_size=1000,
+):
+    """ Same features as convert_examples_to_features, but the texts are tokenized in batches by a fast (Rust-backed)
+        tokenizer and the features are returned as numpy arrays instead of InputFeatures objects:
+            {"guid", "input_ids", "input_mask", "segment_ids", "label_ids"}
+        Sliding window features are always flattened, the windows of an example share its guid.
+    """
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("convert_examples_to_feature_arrays needs a fast tokenizer, got %s" % type(tokenizer).__name__)
+    if any(example.bboxes for example in examples):
+        raise ValueError("Bounding boxes are not implemented for fast tokenization.")
+    if sliding_window and any(example.text_b for example in examples):
+        raise ValueError("Sequence pair tasks not implemented for sliding window tokenization.")
+
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+    all_tokens_a = _batch_tokenize(tokenizer, [example.text_a for example in examples], add_prefix_space,
+                                   batch_size, silent)
+    all_tokens_b = [None] * len(examples)
+    pair_index = [i for i, example in enumerate(examples) if example.text_b]
+    if pair_index:
+        tokens_b = _batch_tokenize(tokenizer, [examples[i].text_b for i in pair_index], add_prefix_space,
+                                   batch_size, silent)
+        for i, tokens in zip(pair_index, tokens_b):
+            all_tokens_b[i] = tokens
+
+    if sliding_window and stride < 1:
+        stride = int(max_seq_length * stride)
+    bucket_size = max_seq_length - (3 if sep_token_extra else 2)
+
+    guids, labels, token_rows, segment_rows = [], [], [], []
+    for example, tokens_a, tokens_b in zip(examples, all_tokens_a, all_tokens_b):
+        if sliding_window:
+            if len(tokens_a) > bucket_size:
+                token_sets = [tokens_a[i: i + bucket_size] for i in range(0, len(tokens_a), stride)]
+            else:
+                token_sets = [tokens_a]
+        elif tokens_b:
+            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - (4 if sep_token_extra else 3))
+            token_sets = [tokens_a]
+        else:
+            token_sets = [tokens_a[: max_seq_length - (3 if sep_token_extra else 2)]]
+
+        for tokens in token_sets:
+            tokens = tokens + [sep_token_id]
+            segment_ids = [sequence_a_segment_id] * len(tokens)
+            if tokens_b:
+                if sep_token_extra:
+                    tokens += [sep_token_id]
+                    segment_ids += [sequence_b_segment_id]
+                tokens += tokens_b + [sep_token_id]
+                segment_ids += [sequence_b_segment_id] * (len(tokens_b) + 1)
+            if cls_token_at_end:
+                tokens = tokens + [cls_token_id]
+                segment_ids = segment_ids + [cls_token_segment_id]
+            else:
+                tokens = [cls_token_id] + tokens
+                segment_ids = [cls_token_segment_id] + segment_ids
+            guids.append(example.guid)
+            labels.append(example.label)
+            token_rows.append(tokens)
+            segment_rows.append(segment_ids)
+
+    lengths = np.array([len(tokens) for tokens in token_rows], dtype=np.int64)
+    if pad_to_max_length or sliding_window:
+        width = max_seq_length
+    else:
+        width = int(lengths.max()) if len(lengths) > 0 else 0
+    positions = np.arange(width)[None, :]
+    if pad_on_left:
+        is_token = positions >= (width - lengths)[:, None]
+    else:
+        is_token = positions < lengths[:, None]
+
+    # fill the real tokens row by row in one shot, everything else keeps the padding value
+    input_ids = np.full((len(token_rows), width), pad_token, dtype=np.int64)
+    input_ids[is_token] = np.fromiter((i for tokens in token_rows for i in tokens), dtype=np.int64,
+                                      count=int(lengths.sum()))
+    segment_ids = np.full((len(token_rows), width), pad_token_segment_id, dtype=np.int64)
+    segment_ids[is_token] = np.fromiter((i for segments in segment_rows for i in segments), dtype=np.int64,
+                                        count=int(lengths.sum()))
+    if mask_padding_with_zero:
+        input_mask = is_token.astype(np.int64)
+    else:
+        input_mask = (~is_token).astype(np.int64)
+
+    return {
+        "guid": np.array(guids, dtype=np.int64),
+        "input_ids": input_ids,
+        "input_mask": input_mask,
+        "segment_ids": segment_ids,
+        "label_ids": np.array(labels, dtype=np.int64),
+    }
+
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
 
@@ -0,0 +1,95 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import torch
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from model.bidaf import BIDAF_SpanExtraction
+
+
+def add_args(parser):
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='batch size')
+
+    parser.add_argument('--c_len', type=int, default=256,
+                        help='context length')
+
+    parser.add_argument('--q_len', type=int, default=32,
+                        help='question length')
+
+    parser.add_argument('--hidden_size', type=int, default=100,
+                        help='hidden size of the model')
+
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='forward and backward passes to time')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def att_similarity_loop(model, c, q):
+    # the former loop over the question words of att_flow_layer
+    c_len = c.size(1)
+    q_len = q.size(1)
+    cq = []
+    for i in range(q_len):
+        # (batch, 1, hidden_size * 2)
+        qi = q.select(1, i).unsqueeze(1)
+        # (batch, c_len)
+        ci = model.att_weight_cq(c * qi).squeeze(-1)
+        cq.append(ci)
+    # (batch, c_len, q_len)
+    cq = torch.stack(cq, dim=-1)
+    return model.att_weight_c(c).expand(-1, -1, q_len) + \
+        model.att_weight_q(q).permute(0, 2, 1).expand(-1, c_len, -1) + \
+        cq
+
+
+def run(fn, model, c, q, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        model.zero_grad()
+        fn(c, q).sum().backward()
+    return (time.time() - start) / repeats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='loop vs. batched trilinear attention of BiDAF (CPU)'))
+    torch.manual_seed(args.seed)
+
+    # only the attention flow weights are used
+    model = BIDAF_SpanExtraction(char_vocab_size=10, word_vocab_size=10, char_emb_len=8, word_emb_len=args.hidden_size,
+                                 out_channel_dims=str(args.hidden_size), filter_heights="5", max_word_len=16,
+                                 char_out_size=args.hidden_size, dropout_rate=0.0, hidden_size=args.hidden_size,
+                                 highway_num_layers=1)
+    c = torch.randn(args.batch_size, args.c_len, args.hidden_size * 2, requires_grad=True)
+    q = torch.randn(args.batch_size, args.q_len, args.hidden_size * 2, requires_grad=True)
+
+    s_loop = att_similarity_loop(model, c, q)
+    s_loop.sum().backward()
+    grads_loop = [t.grad.clone() for t in [c, q, model.att_weight_cq.weight]]
+    model.zero_grad()
+    c.grad, q.grad = None, None
+    s_batched = model.att_similarity(c, q)
+    s_batched.sum().backward()
+    grads_batched = [c.grad, q.grad, model.att_weight_cq.weight.grad]
+    if not torch.allclose(s_loop, s_batched, rtol=1e-4, atol=1e-4):
+        raise Exception("similarity differs, max abs diff %g" % (s_loop - s_batched).abs().max().item())
+    for name, g_loop, g_batched in zip(["c", "q", "w_cq"], grads_loop, grads_batched):
+        if not torch.allclose(g_loop, g_batched, rtol=1e-4, atol=1e-3):
+            raise Exception("gradient of %s differs, max abs diff %g" % (name, (g_loop - g_batched).abs().max().item()))
+    logging.info("similarity and gradients match, max abs diff %g" % (s_loop - s_batched).abs().max().item())
+
+    loop_time = run(lambda c, q: att_similarity_loop(model, c, q), model, c, q, args.repeats)
+    batched_time = run(model.att_similarity, model, c, q, args.repeats)
+    logging.info("loop %.2f ms, batched %.2f ms per forward and backward, speedup %.1fx" % (
+        loop_time * 1000, batched_time * 1000, loop_time / batched_time))
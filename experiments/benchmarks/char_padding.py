@@ -0,0 +1,84 @@
+import argparse
+import logging
+import os
+import string
+import sys
+import time
+
+import numpy as np
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from data.raw_data_loader.base.utils import padding_data, padding_char_data, token_to_idx, char_to_idx, \
+    token_to_idx_array, char_to_idx_array, build_vocab, PAD_TOKEN, UNK_TOKEN
+
+
+def add_args(parser):
+    parser.add_argument('--num_samples', type=int, default=20000,
+                        help='number of synthetic SQuAD contexts')
+
+    parser.add_argument('--batch_size', type=int, default=60,
+                        help='batch size of the padding')
+
+    parser.add_argument('--max_sent_len', type=int, default=400,
+                        help='padded context length')
+
+    parser.add_argument('--max_word_len', type=int, default=16,
+                        help='padded word length of the char-CNN input')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_contexts(rng, num_samples, max_sent_len):
+    # SQuAD-like contexts: ~140 words of ~5 chars, a few longer than max_sent_len
+    words = ["".join(rng.choice(list(string.ascii_lowercase), rng.randint(1, 13))) for _ in range(20000)]
+    lengths = np.clip(rng.lognormal(np.log(140), 0.4, num_samples).astype(np.int64), 1, max_sent_len + 50)
+    return [[words[i] for i in rng.randint(0, len(words), length)] for length in lengths]
+
+
+def list_pipeline(tokens, chars, token_vocab, char_vocab, args):
+    padding_tokens, seq_lens = padding_data(tokens, args.max_sent_len)
+    padding_chars, word_lens = padding_char_data(chars, args.max_sent_len, args.max_word_len)
+    return np.array(token_to_idx(padding_tokens, token_vocab)), np.array(char_to_idx(padding_chars, char_vocab))
+
+
+def array_pipeline(tokens, chars, token_vocab, char_vocab, args):
+    idx_tokens, seq_lens = token_to_idx_array(tokens, token_vocab, args.max_sent_len)
+    idx_chars, word_lens = char_to_idx_array(chars, char_vocab, args.max_sent_len, args.max_word_len)
+    return idx_tokens, idx_chars
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='list vs. array padding and index conversion (SQuAD char-CNN '
+                                                        'inputs)'))
+    rng = np.random.RandomState(args.seed)
+    contexts = synthetic_contexts(rng, args.num_samples, args.max_sent_len)
+    # the vocab of half the data, so there are unknown tokens
+    token_vocab = build_vocab(contexts[: args.num_samples // 2])
+    char_vocab = {ch: i for i, ch in enumerate(string.ascii_lowercase[:20])}
+    char_vocab[UNK_TOKEN] = len(char_vocab)
+    char_vocab[PAD_TOKEN] = len(char_vocab)
+    batches = [(contexts[start: start + args.batch_size],
+                [[list(word) for word in context] for context in contexts[start: start + args.batch_size]])
+               for start in range(0, args.num_samples, args.batch_size)]
+
+    times = []
+    results = []
+    for pipeline in [list_pipeline, array_pipeline]:
+        start = time.time()
+        results.append([pipeline(tokens, chars, token_vocab, char_vocab, args) for tokens, chars in batches])
+        times.append(time.time() - start)
+    for (list_tokens, list_chars), (array_tokens, array_chars) in zip(*results):
+        if not np.array_equal(list_tokens, array_tokens) or not np.array_equal(list_chars, array_chars):
+            raise Exception("indexes differ")
+    list_bytes = sum(tokens.nbytes + chars.nbytes for tokens, chars in results[0])
+    array_bytes = sum(tokens.nbytes + chars.nbytes for tokens, chars in results[1])
+    logging.info("indexes of %d contexts are identical" % args.num_samples)
+    logging.info("lists %.2f sec (%.0f MB of indexes), arrays %.2f sec (%.0f MB of indexes), speedup %.1fx" % (
+        times[0], list_bytes / 2 ** 20, times[1], array_bytes / 2 ** 20, times[0] / times[1]))
@@ -0,0 +1,93 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from data_preprocessing.base.prefetcher import DevicePrefetcher
+
+
+def add_args(parser):
+    parser.add_argument('--num_batches', type=int, default=100,
+                        help='number of batches per run')
+
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='batch size')
+
+    parser.add_argument('--max_seq_length', type=int, default=128,
+                        help='sequence length of the batches')
+
+    parser.add_argument('--hidden_size', type=int, default=128,
+                        help='hidden size of the stand-in model')
+
+    parser.add_argument('--load_ms', type=float, default=20.0,
+                        help='simulated read latency per batch (e.g. h5 / page cache misses), in milliseconds')
+
+    parser.add_argument('--depth', type=int, default=2,
+                        help='prefetch depth')
+
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device of the stand-in model')
+
+    args = parser.parse_args()
+    return args
+
+
+class SlowDataset(Dataset):
+    """Batches of token ids whose loading waits load_ms, like a dataset read lazily from disk."""
+
+    def __init__(self, num_batches, batch_size, max_seq_length, load_ms):
+        self.num_batches = num_batches
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.load_ms = load_ms
+
+    def __len__(self):
+        return self.num_batches
+
+    def __getitem__(self, idx):
+        time.sleep(self.load_ms / 1000.0)
+        generator = torch.Generator().manual_seed(idx)
+        input_ids = torch.randint(0, 30000, (self.batch_size, self.max_seq_length), generator=generator)
+        return idx, input_ids, torch.ones_like(input_ids)
+
+
+def run(loader, model, embedding, device, depth):
+    checksum = 0.0
+    start = time.time()
+    batches = DevicePrefetcher(loader, device, depth)
+    for idx, input_ids, attention_mask in batches:
+        input_ids = input_ids.to(device)
+        attention_mask = attention_mask.to(device)
+        hidden = embedding(input_ids) * attention_mask.unsqueeze(-1)
+        checksum += model(hidden).sum().item()
+    return time.time() - start, checksum
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='training loop with and without the device prefetcher'))
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    embedding = torch.nn.Embedding(30000, args.hidden_size).to(device)
+    model = torch.nn.Sequential(torch.nn.Linear(args.hidden_size, 4 * args.hidden_size), torch.nn.GELU(),
+                                torch.nn.Linear(4 * args.hidden_size, args.hidden_size)).to(device)
+    loader = DataLoader(SlowDataset(args.num_batches, args.batch_size, args.max_seq_length, args.load_ms),
+                        batch_size=None, num_workers=0)
+
+    with torch.no_grad():
+        run(loader, model, embedding, device, 0)  # warm up
+        sync_time, sync_checksum = run(loader, model, embedding, device, 0)
+        prefetch_time, prefetch_checksum = run(loader, model, embedding, device, args.depth)
+    if abs(sync_checksum - prefetch_checksum) > 1e-3 * abs(sync_checksum):
+        raise Exception("results differ: %f vs %f" % (sync_checksum, prefetch_checksum))
+    logging.info("same results over %d batches" % args.num_batches)
+    logging.info("synchronous %.3f sec, prefetched (depth %d) %.3f sec, speedup %.2fx" % (
+        sync_time, args.depth, prefetch_time, sync_time / prefetch_time))
@@ -0,0 +1,97 @@
+import argparse
+import copy
+import logging
+import os
+import sys
+import time
+
+import torch
+from transformers import BertConfig, BertModel
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from training.utils.fedprox import FedProxRegularizer
+
+
+def add_args(parser):
+    parser.add_argument('--num_layers', type=int, default=12,
+                        help='layers of the BERT model')
+
+    parser.add_argument('--fedprox_mu', type=float, default=1.0,
+                        help='mu of the proximal term')
+
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=2,
+                        help='backwards per optimizer step')
+
+    parser.add_argument('--steps', type=int, default=4,
+                        help='training steps to time')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def former_term(model, global_model, mu):
+    # the former regularizer of the trainers, through autograd
+    fed_prox_reg = 0.0
+    for (p, g_p) in zip(model.parameters(), global_model.parameters()):
+        fed_prox_reg += ((mu / 2) * torch.norm((p - g_p.data)) ** 2)
+    return fed_prox_reg
+
+
+def train(model, args, use_regularizer):
+    # the steps of the trainers with a surrogate task loss, returns (losses, setup time, time of the term, model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-2)
+    if use_regularizer:
+        start = time.time()
+        fedprox = FedProxRegularizer(model, args.fedprox_mu)
+        setup_time = time.time() - start
+    else:
+        start = time.time()
+        global_model = copy.deepcopy(model)
+        setup_time = time.time() - start
+    generator = torch.Generator().manual_seed(args.seed)
+    targets = [torch.randn(param.shape, generator=generator) for param in model.parameters()]
+    losses = []
+    term_time = 0.0
+    for step in range(args.steps * args.gradient_accumulation_steps):
+        loss = sum((param * target).sum() for param, target in zip(model.parameters(), targets)) * 1e-3
+        # the term and its gradient, the backward of the task loss adds to it
+        start = time.time()
+        if use_regularizer:
+            term = fedprox.add_gradient(1.0 / args.gradient_accumulation_steps)
+        else:
+            term = former_term(model, global_model, args.fedprox_mu)
+            (term / args.gradient_accumulation_steps).backward()
+        term_time += time.time() - start
+        losses.append(loss.item() + term.item())
+        (loss / args.gradient_accumulation_steps).backward()
+        if (step + 1) % args.gradient_accumulation_steps == 0:
+            optimizer.step()
+            model.zero_grad()
+    return losses, setup_time, term_time / len(losses), model
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='former autograd FedProx term vs. FedProxRegularizer on '
+                                                        'BERT (CPU)'))
+    torch.manual_seed(args.seed)
+    model = BertModel(BertConfig(num_hidden_layers=args.num_layers))
+    logging.info("%.1f M parameters" % (sum(param.numel() for param in model.parameters()) / 1e6))
+
+    results = [train(copy.deepcopy(model), args, use_regularizer) for use_regularizer in [False, True]]
+    (former_losses, former_setup, former_time, former_model), (losses, setup, term_time, trained_model) = results
+    for former_loss, loss in zip(former_losses, losses):
+        if abs(former_loss - loss) > 1e-4 * max(1.0, abs(former_loss)):
+            raise Exception("losses differ: %s vs. %s" % (str(former_losses), str(losses)))
+    for former_param, param in zip(former_model.parameters(), trained_model.parameters()):
+        if not torch.allclose(former_param, param, atol=1e-5):
+            raise Exception("the trained parameters differ")
+    logging.info("losses and trained parameters of %d steps are identical" % args.steps)
+    logging.info("former: setup (deepcopy) %.1f ms, term and its gradient %.1f ms per backward; FedProxRegularizer: "
+                 "setup %.1f ms, term and its gradient %.1f ms per backward (%.1fx)" % (
+                     former_setup * 1000, former_time * 1000, setup * 1000, term_time * 1000, former_time / term_time))
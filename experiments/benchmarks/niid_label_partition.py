@@ -0,0 +1,151 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from data.advanced_partition.niid_label import dynamic_batch_fill, label_skew_process
+
+
+def add_args(parser):
+    parser.add_argument('--num_samples', type=int, default=10000000,
+                        help='number of samples of the synthetic label array')
+
+    parser.add_argument('--num_labels', type=int, default=20,
+                        help='number of labels')
+
+    parser.add_argument('--client_number', type=int, default=1000,
+                        help='number of clients')
+
+    parser.add_argument('--alpha', type=float, default=1.0,
+                        help='alpha of the Dirichlet distribution')
+
+    parser.add_argument('--seed', type=int, default=42,
+                        help='random seed')
+
+    parser.add_argument('--skip_loop', action='store_true',
+                        help='only time the vectorized partitioner')
+
+    args = parser.parse_args()
+    return args
+
+
+def label_skew_process_loop(label_vocab, label_assignment, client_num, alpha,
+                       data_length):
+    """The former per-client, per-label loop of niid_label.label_skew_process (without its prints)."""
+    label_index_matrix = [[] for _ in label_vocab]
+    label_proportion = []
+    partition_result = [[] for _ in range(client_num)]
+    client_length = 0
+    # shuffle indexs and calculate each label proportion of the dataset
+    for index, value in enumerate(label_vocab):
+        label_location = np.where(label_assignment == value)[0]
+        label_proportion.append(len(label_location) / data_length)
+        np.random.shuffle(label_location)
+        label_index_matrix[index].extend(label_location[:])
+    # calculate size for each partition client
+    label_index_tracker = np.zeros(len(label_vocab), dtype=int)
+    total_index = data_length
+    each_client_index_length = int(total_index / client_num)
+    client_dir_dis = np.array([alpha * l for l in label_proportion])
+    proportions = np.random.dirichlet(client_dir_dis)
+    # add all the unused data to the client
+    for client_id in range(len(partition_result)):
+        each_client_partition_result = partition_result[client_id]
+        proportions = np.random.dirichlet(client_dir_dis)
+        client_length = min(each_client_index_length, total_index)
+        if total_index < client_length * 2:
+            client_length = total_index
+        total_index -= client_length
+        client_length_pointer = client_length
+        # for each label calculate the offset length assigned to by Dir distribution and then extend assignment
+        for label_id, _ in enumerate(label_vocab):
+            offset = round(proportions[label_id] * client_length)
+            if offset >= client_length_pointer:
+                offset = client_length_pointer
+                client_length_pointer = 0
+            else:
+                if label_id == (len(label_vocab) - 1):
+                    offset = client_length_pointer
+                client_length_pointer -= offset
+
+            start = int(label_index_tracker[label_id])
+            end = int(label_index_tracker[label_id] + offset)
+            label_data_length = len(label_index_matrix[label_id])
+            # if the the label is assigned to a offset length that is more than what its remaining length
+            if end > label_data_length:
+                each_client_partition_result.extend(
+                    label_index_matrix[label_id][start:])
+                label_index_tracker[label_id] = label_data_length
+                label_index_offset = dynamic_batch_fill(
+                    label_index_tracker, label_index_matrix,
+                    end - label_data_length, label_id)
+                for fill_label_id in label_index_offset.keys():
+                    start = label_index_tracker[fill_label_id]
+                    end = (label_index_tracker[fill_label_id] +
+                           label_index_offset[fill_label_id])
+                    each_client_partition_result.extend(
+                        label_index_matrix[fill_label_id][start:end])
+                    label_index_tracker[fill_label_id] = (
+                        label_index_tracker[fill_label_id] +
+                        label_index_offset[fill_label_id])
+            else:
+                each_client_partition_result.extend(
+                    label_index_matrix[label_id][start:end])
+                label_index_tracker[
+                    label_id] = label_index_tracker[label_id] + offset
+
+        # if last client still has empty rooms, fill empty rooms with the rest of the unused data
+        if client_id == len(partition_result) - 1:
+            for not_fillall_label_id in range(len(label_vocab)):
+                if label_index_tracker[not_fillall_label_id] < len(
+                        label_index_matrix[not_fillall_label_id]):
+                    start = label_index_tracker[not_fillall_label_id]
+                    each_client_partition_result.extend(
+                        label_index_matrix[not_fillall_label_id][start:])
+                    label_index_tracker[not_fillall_label_id] = len(
+                        label_index_matrix[not_fillall_label_id])
+        partition_result[client_id] = each_client_partition_result
+
+    return partition_result
+
+
+def synthetic_labels(num_samples, num_labels, seed):
+    # skewed label frequencies, like most real datasets
+    rng = np.random.RandomState(seed)
+    frequencies = rng.dirichlet(np.ones(num_labels) * 2)
+    return rng.choice(num_labels, size=num_samples, p=frequencies)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='vectorized vs. loop label skew partition'))
+
+    label_assignment = synthetic_labels(args.num_samples, args.num_labels, args.seed)
+    label_vocab = list(range(args.num_labels))
+
+    np.random.seed(args.seed)
+    start = time.time()
+    partition_result = label_skew_process(label_vocab, label_assignment, args.client_number, args.alpha,
+                                          args.num_samples)
+    vectorized_time = time.time() - start
+    logging.info("vectorized partition %.3f sec" % vectorized_time)
+
+    if not args.skip_loop:
+        np.random.seed(args.seed)
+        start = time.time()
+        loop_partition_result = label_skew_process_loop(label_vocab, label_assignment, args.client_number,
+                                                        args.alpha, args.num_samples)
+        loop_time = time.time() - start
+        for client_id in range(args.client_number):
+            if not np.array_equal(partition_result[client_id],
+                                  np.array(loop_partition_result[client_id], dtype=np.int64)):
+                raise Exception("partition of client %d differs" % client_id)
+        logging.info("partitions of %d clients are identical" % args.client_number)
+        logging.info("loop partition %.3f sec, vectorized partition %.3f sec, speedup %.1fx" % (
+            loop_time, vectorized_time, loop_time / vectorized_time))
@@ -0,0 +1,137 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from model.bidaf import BIDAF_SpanExtraction
+from model.bilstm import BiLSTM_TextClassification
+
+
+def add_args(parser):
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='batch size')
+
+    parser.add_argument('--max_seq_len', type=int, default=512,
+                        help='padded length of the text classification batches (20news)')
+
+    parser.add_argument('--max_sent_len', type=int, default=400,
+                        help='padded context length of the span extraction batches (SQuAD)')
+
+    parser.add_argument('--max_ques_len', type=int, default=30,
+                        help='padded question length of the span extraction batches (SQuAD)')
+
+    parser.add_argument('--hidden_size', type=int, default=100,
+                        help='hidden size of the models')
+
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='forward and backward passes to time')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def sample_lengths(rng, batch_size, median, max_len):
+    # long tailed lengths, most of the batch is padding
+    return np.clip(rng.lognormal(np.log(median), 0.6, batch_size).astype(np.int64), 1, max_len)
+
+
+def run(fn, model, repeats):
+    # (training step, evaluation forward) time
+    model.train()
+    start = time.time()
+    for _ in range(repeats):
+        model.zero_grad()
+        fn().sum().backward()
+    train_time = (time.time() - start) / repeats
+    model.eval()
+    start = time.time()
+    with torch.no_grad():
+        for _ in range(repeats):
+            fn()
+    return train_time, (time.time() - start) / repeats
+
+
+def report(name, padding, times):
+    (padded_train, padded_eval), (packed_train, packed_eval) = times
+    logging.info("%s, %d%% padding: training step padded %.1f ms, packed %.1f ms (%.1fx); "
+                 "evaluation padded %.1f ms, packed %.1f ms (%.1fx)" % (
+                     name, padding, padded_train * 1000, packed_train * 1000, padded_train / packed_train,
+                     padded_eval * 1000, packed_eval * 1000, padded_eval / packed_eval))
+
+
+def bench_bilstm(args, rng):
+    model = BiLSTM_TextClassification(1000, args.hidden_size, 20, 1, 0.0, 0.0, 0.0, args.hidden_size, attention=True)
+    seq_lens = sample_lengths(rng, args.batch_size, 150, args.max_seq_len)
+    x = torch.zeros(args.batch_size, args.max_seq_len, dtype=torch.long)
+    for i, seq_len in enumerate(seq_lens):
+        x[i, :seq_len] = torch.from_numpy(rng.randint(1, 1000, seq_len))
+    seq_lens = torch.tensor(seq_lens)
+
+    # with packing the logits of a sample do not depend on the padding of the batch
+    model.eval()
+    with torch.no_grad():
+        logits = model(x, args.batch_size, seq_lens, "cpu")
+        for i in range(min(4, args.batch_size)):
+            alone = model(x[i: i + 1, :seq_lens[i]], 1, seq_lens[i: i + 1], "cpu")
+            if not torch.allclose(logits[i], alone[0], atol=1e-5):
+                raise Exception("logits of sample %d depend on the padding" % i)
+
+    times = []
+    for packed_sequence in [False, True]:
+        model.packed_sequence = packed_sequence
+        times.append(run(lambda: model(x, args.batch_size, seq_lens, "cpu"), model, args.repeats))
+    report("bilstm", 100 - 100 * seq_lens.sum().item() / x.numel(), times)
+
+
+def bench_bidaf(args, rng):
+    word_emb_len = args.hidden_size
+    model = BIDAF_SpanExtraction(char_vocab_size=100, word_vocab_size=1000, char_emb_len=8, word_emb_len=word_emb_len,
+                                 out_channel_dims=str(args.hidden_size), filter_heights="5", max_word_len=16,
+                                 char_out_size=args.hidden_size, dropout_rate=0.0, hidden_size=args.hidden_size,
+                                 highway_num_layers=2)
+    glove_emb_weights = torch.randn(10, word_emb_len)
+    inputs = []
+    for max_len, median in [(args.max_sent_len, 140), (args.max_ques_len, 11)]:
+        lens = sample_lengths(rng, args.batch_size, median, max_len)
+        mask = torch.from_numpy(np.arange(max_len)[None, :] < lens[:, None])
+        words = torch.from_numpy(rng.randint(0, 1010, (args.batch_size, max_len))) * mask
+        chars = torch.from_numpy(rng.randint(0, 100, (args.batch_size, max_len, 16))) * mask.unsqueeze(-1)
+        inputs.append((words, chars, mask))
+    (x, cx, x_mask), (q, cq, q_mask) = inputs
+
+    # with packing the contextual embedding of a sample does not depend on the padding of the batch
+    model.eval()
+    with torch.no_grad():
+        c = torch.randn(args.batch_size, args.max_sent_len, args.hidden_size * 2)
+        lens = x_mask.sum(dim=1)
+        out = model.lstm_forward(model.context_LSTM, c, lens)
+        for i in range(min(4, args.batch_size)):
+            alone = model.context_LSTM(c[i: i + 1, :lens[i]])[0]
+            if not torch.allclose(out[i, :lens[i]], alone[0], atol=1e-5):
+                raise Exception("context embedding of sample %d depends on the padding" % i)
+
+    times = []
+    for packed_sequence in [False, True]:
+        model.packed_sequence = packed_sequence
+        times.append(run(lambda: torch.cat(model(x, cx, x_mask, q, cq, q_mask, None, None, glove_emb_weights, "cpu")),
+                         model, args.repeats))
+    report("bidaf", 100 - 100 * x_mask.sum().item() / x_mask.numel(), times)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='padded vs. packed LSTMs of BiLSTM and BiDAF (CPU)'))
+    torch.manual_seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    bench_bilstm(args, rng)
+    bench_bidaf(args, rng)
@@ -0,0 +1,109 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from training.utils.seq2seq_utils import my_lcs, Rouge, RougeAccumulator, create_rouge_pool
+
+
+def add_args(parser):
+    parser.add_argument('--num_samples', type=int, default=256,
+                        help='number of synthetic summaries')
+
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='eval batch size')
+
+    parser.add_argument('--max_length', type=int, default=400,
+                        help='maximum length of the summaries in words')
+
+    parser.add_argument('--vocab_size', type=int, default=2000,
+                        help='number of distinct words')
+
+    parser.add_argument('--rouge_workers', type=int, default=2,
+                        help='background processes of RougeAccumulator')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def my_lcs_dp(string, sub):
+    # the former dynamic program of my_lcs
+    if(len(string)< len(sub)):
+        sub, string = string, sub
+
+    lengths = [[0 for i in range(0,len(sub)+1)] for j in range(0,len(string)+1)]
+
+    for j in range(1,len(sub)+1):
+        for i in range(1,len(string)+1):
+            if(string[i-1] == sub[j-1]):
+                lengths[i][j] = lengths[i-1][j-1] + 1
+            else:
+                lengths[i][j] = max(lengths[i-1][j] , lengths[i][j-1])
+
+    return lengths[len(string)][len(sub)]
+
+
+def synthetic_summaries(rng, num_samples, max_length, vocab_size):
+    # Zipf distributed words, so references and hypotheses share the frequent ones
+    words = ["w%d" % i for i in range(vocab_size)]
+    summaries = []
+    for length in rng.randint(1, max_length + 1, num_samples):
+        ids = np.minimum(rng.zipf(1.3, length), vocab_size) - 1
+        summaries.append(" ".join(words[i] for i in ids))
+    return summaries
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='dynamic program vs. bit-parallel LCS of the ROUGE-L '
+                                                        'evaluation of Seq2SeqTrainer'))
+    rng = np.random.RandomState(args.seed)
+    refs = synthetic_summaries(rng, args.num_samples, args.max_length, args.vocab_size)
+    hyps = synthetic_summaries(rng, args.num_samples, args.max_length, args.vocab_size)
+    pairs = [(ref.split(" "), hyp.split(" ")) for ref, hyp in zip(refs, hyps)]
+
+    times = []
+    results = []
+    for lcs in [my_lcs_dp, my_lcs]:
+        start = time.time()
+        results.append([lcs(ref, hyp) for ref, hyp in pairs])
+        times.append(time.time() - start)
+    if results[0] != results[1]:
+        raise Exception("LCS lengths differ")
+    logging.info("LCS of %d pairs identical: dynamic program %.2f sec, bit-parallel %.3f sec, speedup %.0fx" % (
+        len(pairs), times[0], times[1], times[0] / times[1]))
+
+    # the per batch Rouge().compute_score of the former eval_model vs. RougeAccumulator
+    batches = [(refs[start: start + args.batch_size], hyps[start: start + args.batch_size])
+               for start in range(0, args.num_samples, args.batch_size)]
+    start = time.time()
+    rouge_score = 0.0
+    for ref_list, hyp_list in batches:
+        res = Rouge().compute_score({idx: [line] for (idx, line) in enumerate(ref_list)},
+                                    {idx: [line] for (idx, line) in enumerate(hyp_list)})
+        rouge_score += res[0]
+    rouge_time = time.time() - start
+    # the pool is created once per trainer, not per evaluation
+    rouge_pool = create_rouge_pool(args.rouge_workers) if args.rouge_workers > 0 else None
+    start = time.time()
+    rouge_accumulator = RougeAccumulator(rouge_pool)
+    for ref_list, hyp_list in batches:
+        rouge_accumulator.add(ref_list, hyp_list)
+    accumulated_score = sum(rouge_accumulator.batch_scores())
+    accumulator_time = time.time() - start
+    if rouge_pool is not None:
+        rouge_pool.close()
+        rouge_pool.join()
+    if not np.isclose(rouge_score, accumulated_score):
+        raise Exception("ROUGE-L differs: %f vs. %f" % (rouge_score, accumulated_score))
+    logging.info("ROUGE-L %.4f: compute_score %.3f sec, RougeAccumulator (%d workers) %.3f sec" % (
+        rouge_score / len(batches), rouge_time, args.rouge_workers, accumulator_time))
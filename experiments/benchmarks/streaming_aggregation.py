@@ -0,0 +1,112 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import torch
+from transformers import BertConfig, BertModel
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from training.utils.aggregation import StateDictAverager
+
+
+def add_args(parser):
+    parser.add_argument('--num_layers', type=int, default=2,
+                        help='layers of the BERT model whose client models are averaged')
+
+    parser.add_argument('--client_num_per_round', type=int, default=10,
+                        help='client models averaged per round')
+
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='rounds to time')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def client_models(shapes, sample_nums, seed):
+    # (sample number, state dict) of each client, generated as the clients would send them
+    generator = torch.Generator().manual_seed(seed)
+    for sample_num in sample_nums:
+        yield sample_num, {name: torch.randn(shape, generator=generator) for name, shape in shapes.items()}
+
+
+def state_dict_bytes(state_dict):
+    return sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+
+
+def collect_and_average(results):
+    # what the FedML aggregators do: keep every client model of the round, then average them key by key
+    model_list = list(results)
+    training_num = sum(sample_num for sample_num, _ in model_list)
+    held_bytes = sum(state_dict_bytes(state) for _, state in model_list)
+    start = time.time()
+    (_, averaged_params) = model_list[0]
+    for k in averaged_params.keys():
+        for i in range(0, len(model_list)):
+            local_sample_number, local_model_params = model_list[i]
+            w = local_sample_number / training_num
+            if i == 0:
+                averaged_params[k] = local_model_params[k] * w
+            else:
+                averaged_params[k] += local_model_params[k] * w
+    return averaged_params, held_bytes, time.time() - start
+
+
+def stream_and_average(results, averager):
+    # fold every client model into the averager as it arrives, only one of them is held at a time
+    held_bytes = 0
+    aggregation_time = 0.0
+    for sample_num, state in results:
+        start = time.time()
+        averager.add(state, sample_num)
+        aggregation_time += time.time() - start
+        held_bytes = max(held_bytes, state_dict_bytes(state))
+    start = time.time()
+    averaged_params = averager.average()
+    aggregation_time += time.time() - start
+    return averaged_params, held_bytes + averager.buffer.numel() * averager.buffer.element_size(), aggregation_time
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='collect-then-average vs. streaming StateDictAverager '
+                                                        'aggregation of client models (CPU)'))
+    torch.manual_seed(args.seed)
+    model = BertModel(BertConfig(num_hidden_layers=args.num_layers))
+    shapes = {name: tensor.shape for name, tensor in model.state_dict().items() if tensor.is_floating_point()}
+    del model
+    model_bytes = sum(shape.numel() for shape in shapes.values()) * 4
+    logging.info("%d tensors, %.1f MB per client model, %d clients per round" % (
+        len(shapes), model_bytes / 2 ** 20, args.client_num_per_round))
+
+    averager = StateDictAverager()
+    times = [0.0, 0.0]
+    held = [0, 0]
+    for round_idx in range(args.rounds):
+        sample_nums = torch.randint(10, 1000, (args.client_num_per_round,),
+                                    generator=torch.Generator().manual_seed(round_idx)).tolist()
+        # the same client models for both, the collected ones are freed before the streaming pass
+        collected, held_bytes, aggregation_time = collect_and_average(
+            client_models(shapes, sample_nums, args.seed + round_idx))
+        times[0] += aggregation_time
+        held[0] = max(held[0], held_bytes)
+        streamed, held_bytes, aggregation_time = stream_and_average(
+            client_models(shapes, sample_nums, args.seed + round_idx), averager)
+        times[1] += aggregation_time
+        held[1] = max(held[1], held_bytes)
+        for name in shapes:
+            if not torch.allclose(collected[name], streamed[name], atol=1e-5):
+                raise Exception("the averages of %s differ" % name)
+        del collected, streamed
+    logging.info("the averages of %d rounds are identical" % args.rounds)
+    logging.info("collect-then-average: %.1f ms per round, %.0f MB of client models held; streaming: %.1f ms per "
+                 "round, %.0f MB held (one client model and the buffer)" % (
+                     times[0] / args.rounds * 1000, held[0] / 2 ** 20, times[1] / args.rounds * 1000,
+                     held[1] / 2 ** 20))
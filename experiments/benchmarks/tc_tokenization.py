@@ -0,0 +1,101 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from transformers import AutoTokenizer
+
+from data.raw_data_loader.base.columnar import is_columnar, read_columns
+from data_preprocessing.base.base_example import TextClassificationInputExample
+from data_preprocessing.utils.text_classification_utils import convert_examples_to_features, \
+    convert_examples_to_feature_arrays
+from model.transformer.model_args import ClassificationArgs
+
+
+def add_args(parser):
+    parser.add_argument('--model_name', type=str, default='bert-base-uncased',
+                        help='tokenizer name or path')
+
+    parser.add_argument('--data_file_path', type=str, default='/home/bill/fednlp_data/data_files/agnews_data.h5',
+                        help='h5 data file of a text classification dataset')
+
+    parser.add_argument('--num_samples', type=int, default=10000,
+                        help='number of samples to tokenize')
+
+    parser.add_argument('--max_seq_length', type=int, default=128,
+                        help='maximum sequence length')
+
+    parser.add_argument('--sliding_window', action='store_true',
+                        help='split long texts into overlapping windows')
+
+    parser.add_argument('--process_count', type=int, default=4,
+                        help='processes of the multiprocessing (slow) path, 0 to disable multiprocessing')
+
+    args = parser.parse_args()
+    return args
+
+
+def load_examples(data_file_path, num_samples):
+    data_file = h5py.File(data_file_path, "r")
+    if is_columnar(data_file):
+        index_list = data_file["index"][:num_samples]
+        texts = read_columns(data_file, ["X"], index_list)["X"]
+    else:
+        index_list = sorted(int(key) for key in data_file["X"].keys())[:num_samples]
+        texts = [data_file["X"][str(idx)][()].decode("utf-8") for idx in index_list]
+    data_file.close()
+    return [TextClassificationInputExample(int(idx), text, None, i % 2) for i, (idx, text) in
+            enumerate(zip(index_list, texts))]
+
+
+def features_to_arrays(features):
+    return {
+        "guid": np.array([f.guid for f in features], dtype=np.int64),
+        "input_ids": np.array([f.input_ids for f in features], dtype=np.int64),
+        "input_mask": np.array([f.input_mask for f in features], dtype=np.int64),
+        "segment_ids": np.array([f.segment_ids for f in features], dtype=np.int64),
+        "label_ids": np.array([f.label_id for f in features], dtype=np.int64),
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='fast vs. slow tokenization for text classification'))
+
+    slow_tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=False)
+    fast_tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True)
+    model_args = ClassificationArgs()
+    examples = load_examples(args.data_file_path, args.num_samples)
+    common_kwargs = dict(cls_token=slow_tokenizer.cls_token, sep_token=slow_tokenizer.sep_token,
+                         cls_token_segment_id=0, pad_token=slow_tokenizer.pad_token_id,
+                         sliding_window=args.sliding_window, stride=model_args.stride, silent=True)
+
+    start = time.time()
+    features = convert_examples_to_features(examples, args.max_seq_length, slow_tokenizer, "classification",
+                                            process_count=max(args.process_count, 1),
+                                            use_multiprocessing=args.process_count > 0, flatten=True,
+                                            args=model_args, **common_kwargs)
+    slow_time = time.time() - start
+
+    start = time.time()
+    fast_arrays = convert_examples_to_feature_arrays(examples, args.max_seq_length, fast_tokenizer,
+                                                     **common_kwargs)
+    fast_time = time.time() - start
+
+    slow_arrays = features_to_arrays(features)
+    for name in slow_arrays.keys():
+        if not np.array_equal(slow_arrays[name], fast_arrays[name]):
+            mismatch = np.nonzero((slow_arrays[name] != fast_arrays[name]).reshape(len(slow_arrays[name]), -1)
+                                  .any(axis=1))[0]
+            raise Exception("%s differs for %d features, first guid %d" % (
+                name, len(mismatch), slow_arrays["guid"][mismatch[0]]))
+    logging.info("features of %d samples are identical" % len(examples))
+    logging.info("slow path %.3f sec, fast path %.3f sec, speedup %.1fx" % (slow_time, fast_time,
+                                                                            slow_time / fast_time))
@@ -0,0 +1,77 @@
+import argparse
+import logging
+import os
+import pickle
+import sys
+import time
+
+import torch
+from transformers import BertConfig, BertModel
+
+# add the FedNLP root directory to the python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from training.utils.compression import COMPRESSIONS, create_compressor
+
+
+def add_args(parser):
+    parser.add_argument('--num_layers', type=int, default=12,
+                        help='layers of the BERT model whose updates are compressed')
+
+    parser.add_argument('--update_std', type=float, default=1e-3,
+                        help='standard deviation of the synthetic updates')
+
+    parser.add_argument('--topk_ratio', type=float, default=0.01,
+                        help='fraction of the entries kept by topk')
+
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='rounds of updates, the error of their sum shows the error feedback of topk')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+
+    args = parser.parse_args()
+    return args
+
+
+def relative_error(decoded, original):
+    squared_error = sum((decoded[name] - original[name]).pow(2).sum().item() for name in original)
+    squared_norm = sum(original[name].pow(2).sum().item() for name in original)
+    return (squared_error / squared_norm) ** 0.5
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = add_args(argparse.ArgumentParser(description='payload size, encode/decode time and reconstruction error '
+                                                        'of the update compressions (CPU)'))
+    torch.manual_seed(args.seed)
+    model = BertModel(BertConfig(num_hidden_layers=args.num_layers))
+    shapes = {name: tensor.shape for name, tensor in model.state_dict().items() if tensor.is_floating_point()}
+    del model
+    logging.info("%d tensors, %.1f M parameters" % (len(shapes), sum(shape.numel() for shape in shapes.values()) / 1e6))
+
+    for compression in COMPRESSIONS:
+        compressor = create_compressor(compression, args.topk_ratio)
+        encode_time, decode_time, payload_bytes = 0.0, 0.0, 0
+        sums = [{name: torch.zeros(shape) for name, shape in shapes.items()} for _ in range(2)]
+        # the same updates for every compression, generated one at a time to bound the memory
+        generator = torch.Generator().manual_seed(args.seed)
+        for _ in range(args.rounds):
+            update = {name: torch.randn(shape, generator=generator) * args.update_std for name, shape in shapes.items()}
+            start = time.time()
+            payload = {name: compressor.compress(name, tensor) for name, tensor in update.items()} \
+                if compressor is not None else update
+            encode_time += time.time() - start
+            # what goes over the wire
+            payload_bytes += len(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+            start = time.time()
+            decoded = {name: tensor.decode() for name, tensor in payload.items()} if compressor is not None else payload
+            decode_time += time.time() - start
+            for name in shapes:
+                sums[0][name] += decoded[name]
+                sums[1][name] += update[name]
+        logging.info("%-5s payload %7.1f MB, encode %6.1f ms, decode %6.1f ms, relative error of the last update "
+                     "%.4f, of the sum of %d updates %.4f" % (
+                         compression, payload_bytes / args.rounds / 2 ** 20, encode_time / args.rounds * 1000,
+                         decode_time / args.rounds * 1000, relative_error(decoded, update), args.rounds,
+                         relative_error(sums[0], sums[1])))
@@ -13,6 +13,7 @@ import numpy as np
 from torch import nn
 import data_preprocessing.SQuAD_1_1.data_loader
 from data_preprocessing.base.utils import *
+from data.raw_data_loader.base.utils import token_to_idx_array, char_to_idx_array
 from data_preprocessing.base.globals import *
 from model.bidaf import BIDAF_SpanExtraction
 from experiments.centralized.bidaf_exps.ema import EMA
@@ -174,10 +175,8 @@ def preprocess_data(args, dataset):
             batch_size = len(batch_data["context_X"])
             new_batch_data["x"] = list()
             new_batch_data["cx"] = list()
-            new_batch_data["x_mask"] = np.zeros([batch_size, args.max_sent_len], dtype="bool")
             new_batch_data["q"] = list()
             new_batch_data["cq"] = list()
-            new_batch_data["q_mask"] = np.zeros([batch_size, args.max_ques_len], dtype="bool")
             new_batch_data["y"] = np.zeros([batch_size, args.max_sent_len], dtype="bool")
             new_batch_data["y2"] = np.zeros([batch_size, args.max_sent_len], dtype="bool")
             for i in range(batch_size):
@@ -193,18 +192,14 @@ def preprocess_data(args, dataset):
                 new_batch_data["cq"].append(question_chars)
                 new_batch_data["y"][i][yi0] = True
                 new_batch_data["y2"][i][yi1] = True
-            padding_context_tokens, context_lens = padding_data(new_batch_data["x"], args.max_sent_len)
-            padding_question_tokens, question_lens = padding_data(new_batch_data["q"], args.max_ques_len)
-            padding_context_chars, context_word_lens = padding_char_data(new_batch_data["cx"], args.max_sent_len, args.max_word_len)
-            padding_question_chars, question_word_lens = padding_char_data(new_batch_data["cq"], args.max_ques_len, args.max_word_len)
-            new_batch_data["x"] = np.array(token_to_idx(padding_context_tokens, token_vocab))
-            new_batch_data["cx"] = np.array(char_to_idx(padding_context_chars, char_vocab))
-            new_batch_data["q"] = np.array(token_to_idx(padding_question_tokens, token_vocab))
-            new_batch_data["cq"] = np.array(char_to_idx(padding_question_chars, char_vocab))
-            for j, context_len in enumerate(context_lens):
-                new_batch_data["x_mask"][j, 0:context_len] = True 
-            for j, question_len in enumerate(question_lens):
-                new_batch_data["q_mask"][j, 0:question_len] = True 
+            new_batch_data["x"], context_lens = token_to_idx_array(new_batch_data["x"], token_vocab, args.max_sent_len)
+            new_batch_data["q"], question_lens = token_to_idx_array(new_batch_data["q"], token_vocab, args.max_ques_len)
+            new_batch_data["cx"], _ = char_to_idx_array(new_batch_data["cx"], char_vocab, args.max_sent_len,
+                                                        args.max_word_len)
+            new_batch_data["cq"], _ = char_to_idx_array(new_batch_data["cq"], char_vocab, args.max_ques_len,
+                                                        args.max_word_len)
+            new_batch_data["x_mask"] = np.arange(args.max_sent_len) < context_lens[:, None]
+            new_batch_data["q_mask"] = np.arange(args.max_ques_len) < question_lens[:, None]
             new_batch_data_list.append(new_batch_data)
 
 
@@ -5,10 +5,12 @@ import torch
 from transformers import (
     BertConfig,
     BertTokenizer,
+    BertTokenizerFast,
     BertForTokenClassification,
     BertForQuestionAnswering,
     DistilBertConfig,
     DistilBertTokenizer,
+    DistilBertTokenizerFast,
     DistilBertForTokenClassification,
     DistilBertForQuestionAnswering,
     BartConfig, 
@@ -20,6 +22,13 @@ from model.transformer.bert_model import BertForSequenceClassification
 from model.transformer.distilbert_model import DistilBertForSequenceClassification
 
 
+# Rust-backed tokenizers used by the batch encoding path of the classification preprocessor
+FAST_TOKENIZER_CLASSES = {
+    "bert": BertTokenizerFast,
+    "distilbert": DistilBertTokenizerFast,
+}
+
+
 def create_model(args, formulation="classification"):
     # create model, tokenizer, and model config (HuggingFace style)
     MODEL_CLASSES = {
@@ -43,6 +52,8 @@ def create_model(args, formulation="classification"):
     }
     config_class, model_class, tokenizer_class = MODEL_CLASSES[formulation][
         args.model_type]
+    if formulation == "classification" and args.use_fast_tokenizer:
+        tokenizer_class = FAST_TOKENIZER_CLASSES[args.model_type]
     # config = config_class.from_pretrained(
     #     args.model_name, num_labels=args.num_labels, **args.config)
     config = config_class.from_pretrained(args.model_name, **args.config)
@@ -147,6 +158,9 @@ def add_centralized_args(parser):
     # cached related
     parser.add_argument('--reprocess_input_data',  action='store_true',
                         help='whether generate features')
+
+    parser.add_argument('--use_fast_tokenizer', action='store_true',
+                        help='tokenize in batches with the fast (Rust) tokenizer, classification only')
     
     # freeze related
     parser.add_argument('--freeze_layers', type=str, default='', metavar='N',
@@ -64,6 +64,7 @@ if __name__ == "__main__":
                                  "do_lower_case": args.do_lower_case,
                                  "manual_seed": args.manual_seed,
                                  "reprocess_input_data": args.reprocess_input_data,  # for ignoring the cache features.
+                                 "use_fast_tokenizer": args.use_fast_tokenizer,
                                  "overwrite_output_dir": True,
                                  "max_seq_length": args.max_seq_length,
                                  "train_batch_size": args.train_batch_size,
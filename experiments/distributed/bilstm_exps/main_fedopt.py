@@ -22,6 +22,7 @@ import data_preprocessing.SemEval2010Task8.data_loader
 import data_preprocessing.Sentiment140.data_loader
 import data_preprocessing.news_20.data_loader
 from data_preprocessing.base.utils import *
+from data.raw_data_loader.base.utils import VocabularyService, token_to_idx_array, label_to_idx_array
 from model.bilstm import BiLSTM_TextClassification
 from training.text_classification_bilstm_trainer import TextClassificationBiLSTMTrainer
 
@@ -124,6 +125,12 @@ def add_args(parser):
     parser.add_argument('--do_remove_low_freq_words', type=int, default=5, metavar="RLW",
                         help='remove words in lower frequency')
 
+    parser.add_argument('--cache_dir', type=str, default='data/cache', metavar="CD",
+                        help='directory of the cached vocabulary and converted word embeddings, empty to disable')
+
+    parser.add_argument('--preprocess_workers', type=int, default=4, metavar="PW",
+                        help='processes that count the tokens of the vocabulary')
+
     args = parser.parse_args()
     return args
 
@@ -206,60 +213,37 @@ def preprocess_data(args, dataset):
     target_vocab = attributes["target_vocab"]
 
     # remove low frequency words and stop words
-    # build frequency vocabulary based on tokenized data
-    x = []
-    for client_index in train_data_local_num_dict.keys():
-        for i, batch_data in enumerate(train_data_local_dict[client_index]):
-            x.extend(batch_data["X"])
-        for i, batch_data in enumerate(test_data_local_dict[client_index]):
-            x.extend(batch_data["X"])
-    freq_vocab = build_freq_vocab(x)
-    logging.info("frequency vocab size %d", len(freq_vocab))
-
-    def __remove_words(word_set):
-
+    # the source vocabulary is built from one (parallel) count of the tokens of all the clients and cached, the
+    # removed words are the ones that are not in it
+    def __collect_x():
+        x = []
         for client_index in train_data_local_num_dict.keys():
             for i, batch_data in enumerate(train_data_local_dict[client_index]):
-                train_data_local_dict[client_index][i]["X"] = remove_words(batch_data["X"], word_set)
-
+                x.extend(batch_data["X"])
             for i, batch_data in enumerate(test_data_local_dict[client_index]):
-                test_data_local_dict[client_index][i]["X"] = remove_words(batch_data["X"], word_set)
-
-    if args.do_remove_low_freq_words > 0:
-        logging.info("remove low frequency words")
-        # build low frequency words set
-        low_freq_words = set()
-        for token, freq in freq_vocab.items():
-            if freq <= args.do_remove_low_freq_words:
-                low_freq_words.add(token)
-
-        __remove_words(low_freq_words)
-
-    if args.do_remove_stop_words:
-        logging.info("remove stop words")
-        __remove_words(STOP_WORDS)
-
-    x.clear()
-    for client_index in train_data_local_num_dict.keys():
-        for i, batch_data in enumerate(train_data_local_dict[client_index]):
-            x.extend(batch_data["X"])
-        for i, batch_data in enumerate(test_data_local_dict[client_index]):
-            x.extend(batch_data["X"])
-    source_vocab = build_vocab(x)
+                x.extend(batch_data["X"])
+        return x
+
+    vocab_service = VocabularyService(args.cache_dir, args.preprocess_workers)
+    source_vocab = vocab_service.build_vocab(
+        __collect_x, min_freq=args.do_remove_low_freq_words,
+        removed_words=STOP_WORDS if args.do_remove_stop_words else None,
+        cache_key={"dataset": args.dataset, "data_file": os.path.abspath(args.data_file),
+                   "partition_file": os.path.abspath(args.partition_file),
+                   "partition_method": args.partition_method, "client_num_in_total": args.client_num_in_total})
     logging.info("source vocab size %d", len(source_vocab))
+    kept_words = set(source_vocab.keys())
+
+    def __remove_words(x):
+        return [[token for token in single_x if token in kept_words] for single_x in x]
 
     # load pretrained embeddings. Note that we use source vocabulary here to reduce the input size
     embedding_weights = None
     if args.embedding_name:
-        if args.embedding_name == "word2vec":
-            logging.info("load word embedding %s" % args.embedding_name)
-            source_vocab, embedding_weights = load_word2vec_embedding(os.path.abspath(args.embedding_file), source_vocab)
-        elif args.embedding_name == "glove":
-            logging.info("load word embedding %s" % args.embedding_name)
-            source_vocab, embedding_weights = load_glove_embedding(os.path.abspath(args.embedding_file), source_vocab,
-                                                                   args.embedding_length)
-        else:
-            raise Exception("No such embedding")
+        logging.info("load word embedding %s" % args.embedding_name)
+        source_vocab, embedding_weights = vocab_service.load_embedding(os.path.abspath(args.embedding_file),
+                                                                       args.embedding_name, source_vocab,
+                                                                       args.embedding_length)
         embedding_weights = torch.tensor(embedding_weights, dtype=torch.float)
 
     if args.max_seq_len == -1:
@@ -275,19 +259,23 @@ def preprocess_data(args, dataset):
     for client_index in train_data_local_num_dict.keys():
         new_train_data_local = list()
         for i, batch_data in enumerate(train_data_local_dict[client_index]):
-            padding_x, seq_lens = padding_data(batch_data["X"], args.max_seq_len)
+            train_data_local_dict[client_index][i]["X"] = __remove_words(batch_data["X"])
+            idx_x, seq_lens = token_to_idx_array(train_data_local_dict[client_index][i]["X"], source_vocab,
+                                                 args.max_seq_len)
             new_train_data_local.append(
-                {"X": token_to_idx(padding_x, source_vocab),
-                 "Y": label_to_idx(batch_data["Y"], target_vocab),
+                {"X": idx_x,
+                 "Y": label_to_idx_array(batch_data["Y"], target_vocab),
                  "seq_lens": seq_lens})
         new_train_data_local_dict[client_index] = new_train_data_local
 
         new_test_data_local = list()
         for i, batch_data in enumerate(test_data_local_dict[client_index]):
-            padding_x, seq_lens = padding_data(batch_data["X"], args.max_seq_len)
+            test_data_local_dict[client_index][i]["X"] = __remove_words(batch_data["X"])
+            idx_x, seq_lens = token_to_idx_array(test_data_local_dict[client_index][i]["X"], source_vocab,
+                                                 args.max_seq_len)
             new_test_data_local.append(
-                {"X": token_to_idx(padding_x, source_vocab),
-                 "Y": label_to_idx(batch_data["Y"], target_vocab),
+                {"X": idx_x,
+                 "Y": label_to_idx_array(batch_data["Y"], target_vocab),
                  "seq_lens": seq_lens})
         new_test_data_local_dict[client_index] = new_test_data_local
 
@@ -5,10 +5,12 @@ import torch
 from transformers import (
     BertConfig,
     BertTokenizer,
+    BertTokenizerFast,
     BertForTokenClassification,
     BertForQuestionAnswering,
     DistilBertConfig,
     DistilBertTokenizer,
+    DistilBertTokenizerFast,
     DistilBertForTokenClassification,
     DistilBertForQuestionAnswering,
     BartConfig, 
@@ -16,14 +18,27 @@ from transformers import (
     BartTokenizer,
 )
 
-from FedML.fedml_api.distributed.fedavg.FedAvgAPI import FedML_FedAvg_distributed
-from FedML.fedml_api.distributed.fedopt.FedOptAPI import FedML_FedOpt_distributed
-from FedML.fedml_api.distributed.fedprox.FedProxAPI import FedML_FedProx_distributed
 from model.transformer.bert_model import BertForSequenceClassification
 from model.transformer.distilbert_model import DistilBertForSequenceClassification
+from training.utils.compression import COMPRESSIONS, create_compressor
 
 
-def get_fl_algorithm_initializer(alg_name):
+def get_fl_algorithm_initializer(alg_name, streaming_aggregation=False):
+    # imported here, so the single-process simulation (experiments/simulation) can use this module without FedML
+    from FedML.fedml_api.distributed.fedavg import FedAvgAPI
+    from FedML.fedml_api.distributed.fedavg.FedAvgAPI import FedML_FedAvg_distributed
+    from FedML.fedml_api.distributed.fedopt.FedOptAPI import FedML_FedOpt_distributed
+    from FedML.fedml_api.distributed.fedprox import FedProxAPI
+    from FedML.fedml_api.distributed.fedprox.FedProxAPI import FedML_FedProx_distributed
+    from training.fed_trainer_transformer import streaming_aggregator
+
+    if streaming_aggregation:
+        # the servers of FedAvg and FedProx average the client models as they arrive (FedTransformerTrainer only)
+        if alg_name == "FedAvg" and not FedAvgAPI.FedAVGAggregator.__name__.startswith("Streaming"):
+            FedAvgAPI.FedAVGAggregator = streaming_aggregator(FedAvgAPI.FedAVGAggregator)
+        elif alg_name == "FedProx" and not FedProxAPI.FedProxAggregator.__name__.startswith("Streaming"):
+            FedProxAPI.FedProxAggregator = streaming_aggregator(FedProxAPI.FedProxAggregator)
+
     if alg_name == "FedAvg":
         fl_algorithm = FedML_FedAvg_distributed
     elif alg_name == "FedOPT":
@@ -36,6 +51,24 @@ def get_fl_algorithm_initializer(alg_name):
     return fl_algorithm
 
 
+def get_compressor(args):
+    if args.compression != "none" and args.is_mobile:
+        raise Exception("--compression %s needs --is_mobile 0, the mobile payloads are lists" % args.compression)
+    if args.send_model_deltas and args.fl_algorithm == "FedOPT":
+        # the FedOPT server loads the average, <name>@delta keys included, with a strict load_state_dict
+        raise Exception("--send_model_deltas only fits FedAvg and FedProx, not %s" % args.fl_algorithm)
+    if args.compression == "topk" and not args.send_model_deltas:
+        raise Exception("--compression topk only compresses updates, it needs --send_model_deltas")
+    return create_compressor(args.compression, args.topk_ratio)
+
+
+# Rust-backed tokenizers used by the batch encoding path of the classification preprocessor
+FAST_TOKENIZER_CLASSES = {
+    "bert": BertTokenizerFast,
+    "distilbert": DistilBertTokenizerFast,
+}
+
+
 def create_model(args, formulation="classification"):
     # create model, tokenizer, and model config (HuggingFace style)
     MODEL_CLASSES = {
@@ -59,6 +92,8 @@ def create_model(args, formulation="classification"):
     }
     config_class, model_class, tokenizer_class = MODEL_CLASSES[formulation][
         args.model_type]
+    if formulation == "classification" and args.use_fast_tokenizer:
+        tokenizer_class = FAST_TOKENIZER_CLASSES[args.model_type]
     # config = config_class.from_pretrained(
     #     args.model_name, num_labels=args.num_labels, **args.config)
     config = config_class.from_pretrained(args.model_name, **args.config)
@@ -208,9 +243,31 @@ def add_federated_args(parser):
     # cached related
     parser.add_argument('--reprocess_input_data',  action='store_true',
                         help='whether generate features')
+
+    parser.add_argument('--use_fast_tokenizer', action='store_true',
+                        help='tokenize in batches with the fast (Rust) tokenizer, classification only')
     
     # freeze related
     parser.add_argument('--freeze_layers', type=str, default='', metavar='N',
                         help='freeze which layers')
 
+    # communication related
+    parser.add_argument('--trainable_params_only', action='store_true',
+                        help='exchange only the parameters with requires_grad (e.g. without the frozen layers)')
+
+    parser.add_argument('--send_model_deltas', action='store_true',
+                        help='clients send the change of their model against the last global model, '
+                             'FedAvg and FedProx only')
+
+    parser.add_argument('--compression', type=str, default='none', choices=COMPRESSIONS,
+                        help='compression of the model payloads: fp16, int8 (per tensor) or topk (with error '
+                             'feedback, needs --send_model_deltas); needs --is_mobile 0')
+
+    parser.add_argument('--topk_ratio', type=float, default=0.01,
+                        help='fraction of the entries of every tensor kept by --compression topk')
+
+    parser.add_argument('--streaming_aggregation', type=int, default=1,
+                        help='the FedAvg and FedProx servers average the client models as they arrive instead of '
+                             'keeping all of them until the round is complete')
+
     return parser
@@ -15,7 +15,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../../../")))
 
 from training.fed_trainer_transformer import FedTransformerTrainer
 from experiments.distributed.transformer_exps.initializer import add_federated_args, set_seed, create_model, \
-    get_fl_algorithm_initializer
+    get_fl_algorithm_initializer, get_compressor
 from data_preprocessing.span_extraction_preprocessor import TLMPreprocessor
 from training.se_transformer_trainer import SpanExtractionTrainer
 from model.transformer.model_args import SpanExtractionArgs
@@ -114,7 +114,8 @@ if __name__ == "__main__":
 
     client_trainer = SpanExtractionTrainer(
         model_args, device, client_model, None, None, tokenizer)
-    fed_trainer = FedTransformerTrainer(client_trainer, client_model)
+    fed_trainer = FedTransformerTrainer(client_trainer, client_model, args.trainable_params_only,
+                                        args.send_model_deltas, get_compressor(args))
 
     # data loading and management
     preprocessor = TLMPreprocessor(args=model_args, tokenizer=tokenizer)
@@ -129,7 +130,7 @@ if __name__ == "__main__":
     # for distributed algorithm, train_data_gloabl and test_data_global are required
     args.client_num_in_total = num_clients
 
-    fl_algorithm = get_fl_algorithm_initializer(args.fl_algorithm)
+    fl_algorithm = get_fl_algorithm_initializer(args.fl_algorithm, args.streaming_aggregation)
     fl_algorithm(process_id, worker_number, device, comm, client_model, train_data_num,
                  train_data_global, test_data_global, train_data_local_num_dict,
                  train_data_local_dict, test_data_local_dict, args, fed_trainer)
@@ -24,7 +24,7 @@ from FedML.fedml_api.distributed.utils.gpu_mapping import mapping_processes_to_g
 from FedML.fedml_api.distributed.fedavg.FedAvgAPI import FedML_init
 
 from experiments.distributed.transformer_exps.initializer import add_federated_args, set_seed, create_model, \
-    get_fl_algorithm_initializer
+    get_fl_algorithm_initializer, get_compressor
 
 import argparse
 import logging
@@ -111,7 +111,8 @@ if __name__ == "__main__":
     # trainer
     client_trainer = Seq2SeqTrainer(
         model_args, device, client_model, None, None, tokenizer)
-    fed_trainer = FedTransformerTrainer(client_trainer, client_model)
+    fed_trainer = FedTransformerTrainer(client_trainer, client_model, args.trainable_params_only,
+                                        args.send_model_deltas, get_compressor(args))
 
     # data manager
     preprocessor = TLMPreprocessor(
@@ -126,7 +127,7 @@ if __name__ == "__main__":
         client_trainer.test_dl = test_data_global
     args.client_num_in_total = num_clients
 
-    fl_algorithm = get_fl_algorithm_initializer(args.fl_algorithm)
+    fl_algorithm = get_fl_algorithm_initializer(args.fl_algorithm, args.streaming_aggregation)
     fl_algorithm(process_id, worker_number, device, comm, client_model, train_data_num,
                  train_data_global, test_data_global, train_data_local_num_dict,
                  train_data_local_dict, test_data_local_dict, args, fed_trainer)
@@ -24,7 +24,7 @@ from FedML.fedml_api.distributed.utils.gpu_mapping import mapping_processes_to_g
 from FedML.fedml_api.distributed.fedavg.FedAvgAPI import FedML_init
 
 from experiments.distributed.transformer_exps.initializer import add_federated_args, set_seed, create_model, \
-    get_fl_algorithm_initializer
+    get_fl_algorithm_initializer, get_compressor
 
 import argparse
 import logging
@@ -105,6 +105,7 @@ if __name__ == "__main__":
                                  "manual_seed": args.manual_seed,
                                  # for ignoring the cache features.
                                  "reprocess_input_data": args.reprocess_input_data,
+                                 "use_fast_tokenizer": args.use_fast_tokenizer,
                                  "overwrite_output_dir": True,
                                  "max_seq_length": args.max_seq_length,
                                  "train_batch_size": args.train_batch_size,
@@ -127,7 +128,12 @@ if __name__ == "__main__":
     # trainer
     client_trainer = TextClassificationTrainer(
         model_args, device, client_model, None, None)
-    fed_trainer = FedTransformerTrainer(client_trainer, client_model)
+    # the server never trains (build_optimizer freezes the layers), freeze them now so that it exchanges the same
+    # parameters as the clients with --trainable_params_only
+    if model_args.model_type == "distilbert":
+        client_trainer.freeze_model_parameters(client_model)
+    fed_trainer = FedTransformerTrainer(client_trainer, client_model, args.trainable_params_only,
+                                        args.send_model_deltas, get_compressor(args))
 
     # data manager
     preprocessor = TLMPreprocessor(
@@ -143,7 +149,7 @@ if __name__ == "__main__":
         client_trainer.test_dl = test_data_global
     args.client_num_in_total = num_clients
 
-    fl_algorithm = get_fl_algorithm_initializer(args.fl_algorithm)
+    fl_algorithm = get_fl_algorithm_initializer(args.fl_algorithm, args.streaming_aggregation)
     fl_algorithm(process_id, worker_number, device, comm, client_model, train_data_num,
                  train_data_global, test_data_global, train_data_local_num_dict,
                  train_data_local_dict, test_data_local_dict, args, fed_trainer)
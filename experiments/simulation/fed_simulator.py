@@ -0,0 +1,160 @@
+"""
+Single-process simulation of federated training of the transformer models, without MPI.
+
+One model instance is kept per process: for every client the global model is loaded into it, the task trainer
+(TextClassificationTrainer, SeqTaggingTrainer, SpanExtractionTrainer, ...) trains it on the client's data and its
+state dict is folded into the weighted sum of a StateDictAverager right away, so a round holds one client model
+besides the global one and the average however many clients it has. The clients of a round run one after the other, or over a pool of num_processes
+worker processes that each build their own model, trainer and data manager (CPU only). The server aggregation
+(FedAvg, FedProx or FedOPT) runs in the same process.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+from data_manager.client_data_provider import ClientDataProvider, TRAIN
+from training.utils.aggregation import StateDictAverager
+
+
+def sample_clients(round_idx, client_num_in_total, client_num_per_round):
+    # the same clients as the FedML aggregators sample
+    if client_num_in_total == client_num_per_round:
+        return list(range(client_num_in_total))
+    num_clients = min(client_num_per_round, client_num_in_total)
+    np.random.seed(round_idx)
+    return np.random.choice(range(client_num_in_total), num_clients, replace=False).tolist()
+
+
+def create_server_optimizer(params, name, lr, momentum):
+    optimizer_classes = {cls.__name__.lower(): cls for cls in vars(torch.optim).values()
+                         if isinstance(cls, type) and issubclass(cls, torch.optim.Optimizer)}
+    if name.lower() not in optimizer_classes:
+        raise Exception("unknown server optimizer %s" % name)
+    optimizer_class = optimizer_classes[name.lower()]
+    if optimizer_class is torch.optim.SGD:
+        return optimizer_class(params, lr=lr, momentum=momentum)
+    return optimizer_class(params, lr=lr)
+
+
+def train_client(trainer, train_loader, global_state, device):
+    """
+    Train the global model on the data of a client, returns (number of train samples, trained state dict). The
+    state dict is the one of the model, so add it to the average before the next client trains.
+    """
+    trainer.model.load_state_dict(global_state)
+    trainer.train_dl = train_loader
+    trainer.train_model(device=device)
+    return len(train_loader.dataset), trainer.model.state_dict()
+
+
+# (trainer, data manager, device, round index, global state) of a pool worker
+_worker = None
+
+
+def _init_worker(create_task, args, device, num_threads):
+    global _worker
+    torch.set_num_threads(num_threads)
+    trainer, data_manager, _ = create_task(args, device, False)
+    _worker = [trainer, data_manager, device, None, None]
+
+
+def _train_client_in_worker(task):
+    round_idx, client_idx, global_state_path = task
+    trainer, data_manager, device, worker_round_idx, global_state = _worker
+    if worker_round_idx != round_idx:
+        global_state = torch.load(global_state_path)
+        _worker[3], _worker[4] = round_idx, global_state
+    train_loader, _ = data_manager._load_client_data(client_idx)
+    sample_num, state = train_client(trainer, train_loader, global_state, device)
+    # a copy, torch sends tensors through shared memory and the model trains the next client meanwhile
+    return sample_num, {name: tensor.detach().clone() for name, tensor in state.items()}
+
+
+class FedSimulator(object):
+    def __init__(self, args, create_task, device, num_processes=0):
+        """
+        create_task(args, device, load_test_data) returns (trainer, data manager, server test loader) of the task.
+        The pool workers call it as well (without test data), so it must be a module level function.
+        """
+        self.args = args
+        self.create_task = create_task
+        self.device = device
+        self.num_processes = num_processes
+        self.trainer, self.data_manager, self.test_dl = create_task(args, device, True)
+        self.model = self.trainer.model
+        self.client_num_in_total = self.data_manager.num_clients
+        self.schedule = [sample_clients(round_idx, self.client_num_in_total, args.client_num_per_round)
+                         for round_idx in range(args.comm_round)]
+        self.averager = StateDictAverager()
+        self.server_optimizer = None
+        if args.fl_algorithm == "FedOPT":
+            self.server_optimizer = create_server_optimizer(self.model.parameters(), args.server_optimizer,
+                                                            args.server_lr, args.server_momentum)
+
+    def run(self):
+        pool, provider, tmp_dir = None, None, None
+        if self.num_processes > 0:
+            num_threads = max(1, torch.get_num_threads() // self.num_processes)
+            pool = Pool(self.num_processes, initializer=_init_worker,
+                        initargs=(self.create_task, self.args, torch.device("cpu"), num_threads))
+            tmp_dir = tempfile.mkdtemp(prefix="fed_simulation_")
+        else:
+            provider = ClientDataProvider(self.data_manager._load_client_data,
+                                          [client_idx for clients in self.schedule for client_idx in clients],
+                                          self.trainer.args.max_cached_clients, self.trainer.args.prefetch_clients)
+            provider.start()
+        try:
+            for round_idx in range(self.args.comm_round):
+                start = time.time()
+                client_indexes = self.schedule[round_idx]
+                logging.info("round %d, clients %s" % (round_idx, str(client_indexes)))
+                global_state = {name: tensor.detach().cpu().clone() for name, tensor in self.model.state_dict().items()}
+                if pool is not None:
+                    global_state_path = os.path.join(tmp_dir, "global_%d.pt" % round_idx)
+                    torch.save(global_state, global_state_path)
+                    # in schedule order, so the pool and the sequential path fold the clients the same way
+                    results = pool.imap(_train_client_in_worker, [
+                        (round_idx, client_idx, global_state_path) for client_idx in client_indexes])
+                else:
+                    results = (train_client(self.trainer, provider.get(client_idx)[TRAIN], global_state, self.device)
+                               for client_idx in client_indexes)
+                for sample_num, state in results:
+                    self.averager.add(state, sample_num)
+                averaged_state = self.averager.average()
+                if pool is not None:
+                    os.remove(global_state_path)
+                self.aggregate(global_state, averaged_state)
+                logging.info("round %d took %.1f sec" % (round_idx, time.time() - start))
+
+                if round_idx % self.args.frequency_of_the_test == 0 or round_idx == self.args.comm_round - 1:
+                    self.trainer.test_dl = self.test_dl
+                    self.trainer.eval_model(device=self.device)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            if provider is not None:
+                provider.shutdown()
+
+    def aggregate(self, global_state, averaged_state):
+        if self.server_optimizer is None:
+            # FedAvg, FedProx
+            self.model.load_state_dict(averaged_state)
+            return
+        # FedOPT: the server optimizer steps along global - average
+        self.model.load_state_dict(global_state)
+        self.server_optimizer.zero_grad()
+        with torch.no_grad():
+            for name, param in self.model.named_parameters():
+                param.grad = param.data - averaged_state[name].to(param.device)
+        self.server_optimizer.step()
+        parameter_names = set(name for name, _ in self.model.named_parameters())
+        self.model.load_state_dict({name: tensor for name, tensor in averaged_state.items()
+                                    if name not in parameter_names}, strict=False)
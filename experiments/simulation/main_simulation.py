@@ -0,0 +1,141 @@
+import argparse
+import logging
+import os
+import sys
+
+import torch
+# this is a temporal import, we will refactor FedML as a package installation
+import wandb
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.getcwd(), "../../")))
+
+from data_manager.base_data_manager import BaseDataManager
+from experiments.distributed.transformer_exps.initializer import add_federated_args, set_seed, create_model
+from experiments.simulation.fed_simulator import FedSimulator
+from model.transformer.model_args import ClassificationArgs, SeqTaggingArgs, SpanExtractionArgs, Seq2SeqArgs
+
+# model args class and create_model formulation of every task
+TASKS = {
+    "tc": (ClassificationArgs, "classification"),
+    "st": (SeqTaggingArgs, "seq_tagging"),
+    "se": (SpanExtractionArgs, "span_extraction"),
+    "ss": (Seq2SeqArgs, "seq2seq"),
+}
+
+
+def add_simulation_args(parser):
+    parser.add_argument('--task', type=str, default='tc', choices=list(TASKS.keys()),
+                        help='tc (text classification), st (sequence tagging), se (span extraction) or ss (seq2seq)')
+
+    parser.add_argument('--num_processes', type=int, default=0,
+                        help='train the clients of a round over this many worker processes (CPU only), '
+                             '0 trains them one after the other in this process')
+
+    parser.add_argument('--test_cut_off', type=int, default=None,
+                        help='evaluate on the first test_cut_off test samples only')
+    return parser
+
+
+def create_task(args, device, load_test_data=True):
+    """Model, trainer and data manager of the task, set up like the fedavg_main_* scripts of the same task."""
+    attributes = BaseDataManager.load_attributes(args.data_file_path)
+    model_args_class, formulation = TASKS[args.task]
+    model_args = model_args_class()
+    model_args.model_name = args.model_name
+    model_args.model_type = args.model_type
+    if args.task == "ss":
+        model_args.use_multiprocessing = False
+    model_args.load(model_args.model_name)
+    model_args.update_from_dict({"fl_algorithm": args.fl_algorithm,
+                                 "epochs": args.epochs,
+                                 "learning_rate": args.lr,
+                                 "gradient_accumulation_steps": args.gradient_accumulation_steps,
+                                 "do_lower_case": args.do_lower_case,
+                                 "manual_seed": args.manual_seed,
+                                 # for ignoring the cache features.
+                                 "reprocess_input_data": args.reprocess_input_data,
+                                 "overwrite_output_dir": True,
+                                 "max_seq_length": args.max_seq_length,
+                                 "train_batch_size": args.train_batch_size,
+                                 "eval_batch_size": args.eval_batch_size,
+                                 "evaluate_during_training": False,  # Disabled for FedAvg.
+                                 "evaluate_during_training_steps": args.evaluate_during_training_steps,
+                                 "fp16": args.fp16,
+                                 "data_file_path": args.data_file_path,
+                                 "partition_file_path": args.partition_file_path,
+                                 "partition_method": args.partition_method,
+                                 "dataset": args.dataset,
+                                 "output_dir": args.output_dir,
+                                 "is_debug_mode": args.is_debug_mode,
+                                 "fedprox_mu": args.fedprox_mu
+                                 })
+    if args.task in ["tc", "st"]:
+        num_labels = len(attributes["label_vocab"])
+        model_args.num_labels = num_labels
+        model_args.config["num_labels"] = num_labels
+    if args.task == "tc":
+        model_args.update_from_dict({"freeze_layers": args.freeze_layers,
+                                     "use_fast_tokenizer": args.use_fast_tokenizer})
+    model_config, model, tokenizer = create_model(model_args, formulation=formulation)
+
+    if args.task == "tc":
+        from data_manager.text_classification_data_manager import TextClassificationDataManager
+        from data_preprocessing.text_classification_preprocessor import TLMPreprocessor
+        from training.tc_transformer_trainer import TextClassificationTrainer
+        trainer = TextClassificationTrainer(model_args, device, model, None, None)
+        preprocessor = TLMPreprocessor(args=model_args, label_vocab=attributes["label_vocab"], tokenizer=tokenizer)
+        data_manager = TextClassificationDataManager(args, model_args, preprocessor, 0, args.client_num_per_round)
+    elif args.task == "st":
+        from data_manager.seq_tagging_data_manager import SequenceTaggingDataManager
+        from data_preprocessing.seq_tagging_preprocessor import TLMPreprocessor
+        from training.st_transformer_trainer import SeqTaggingTrainer
+        trainer = SeqTaggingTrainer(model_args, device, model, None, None, tokenizer)
+        preprocessor = TLMPreprocessor(args=model_args, label_vocab=attributes["label_vocab"], tokenizer=tokenizer)
+        data_manager = SequenceTaggingDataManager(args, model_args, preprocessor, 0, args.client_num_per_round)
+    elif args.task == "se":
+        from data_manager.span_extraction_data_manager import SpanExtractionDataManager
+        from data_preprocessing.span_extraction_preprocessor import TLMPreprocessor
+        from training.se_transformer_trainer import SpanExtractionTrainer
+        trainer = SpanExtractionTrainer(model_args, device, model, None, None, tokenizer)
+        preprocessor = TLMPreprocessor(args=model_args, tokenizer=tokenizer)
+        data_manager = SpanExtractionDataManager(args, model_args, preprocessor, 0, args.client_num_per_round)
+    else:
+        from data_manager.seq2seq_data_manager import Seq2SeqDataManager
+        from data_preprocessing.seq2seq_preprocessor import TLMPreprocessor
+        from training.ss_transformer_trainer import Seq2SeqTrainer
+        trainer = Seq2SeqTrainer(model_args, device, model, None, None, tokenizer)
+        preprocessor = TLMPreprocessor(args=model_args, tokenizer=tokenizer)
+        data_manager = Seq2SeqDataManager(args, model_args, preprocessor, 0, args.client_num_per_round)
+
+    test_dl = None
+    if load_test_data:
+        test_dl = data_manager.load_federated_data(process_id=0, test_cut_off=args.test_cut_off)[2]
+    return trainer, data_manager, test_dl
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = add_federated_args(parser)
+    parser = add_simulation_args(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(process)s %(asctime)s.%(msecs)03d - {%(module)s.py (%(lineno)d)} - %(funcName)s(): %(message)s',
+        datefmt='%Y-%m-%d,%H:%M:%S')
+    logging.info(args)
+
+    set_seed(args.manual_seed)
+
+    # initialize the wandb machine learning experimental tracking platform (https://wandb.ai/automl/fednlp).
+    wandb.init(project="fednlp", entity="automl", name="FedNLP-Simulation-" + str(args.fl_algorithm) + "-" +
+                                                       args.task.upper() + "-" + str(args.dataset) + "-" +
+                                                       str(args.model_name), config=args)
+
+    device = torch.device("cuda:0" if args.n_gpu > 0 and torch.cuda.is_available() and args.num_processes == 0
+                          else "cpu")
+    logging.info("device = %s" % str(device))
+
+    simulator = FedSimulator(args, create_task, device, args.num_processes)
+    simulator.run()
@@ -0,0 +1,34 @@
+TASK=$1
+FL_ALG=$2
+PARTITION_METHOD=$3
+C_LR=$4
+S_LR=$5
+ROUND=$6
+CLIENT_NUM=$7
+PROCESS_NUM=$8
+
+DATA_DIR=~/fednlp_data/
+DATA_NAME=20news
+
+# all the clients of a round are trained in this process (PROCESS_NUM=0) or over PROCESS_NUM CPU worker processes,
+# no mpirun needed
+python -m main_simulation \
+  --task $TASK \
+  --num_processes $PROCESS_NUM \
+  --client_num_per_round $CLIENT_NUM \
+  --comm_round $ROUND \
+  --dataset "${DATA_NAME}" \
+  --data_file "${DATA_DIR}/data_files/${DATA_NAME}_data.h5" \
+  --partition_file "${DATA_DIR}/partition_files/${DATA_NAME}_partition.h5" \
+  --partition_method $PARTITION_METHOD \
+  --fl_algorithm $FL_ALG \
+  --model_type distilbert \
+  --model_name distilbert-base-uncased \
+  --do_lower_case True \
+  --train_batch_size 32 \
+  --eval_batch_size 8 \
+  --max_seq_length 256 \
+  --lr $C_LR \
+  --server_lr $S_LR \
+  --epochs 1 \
+  --output_dir "/tmp/simulation_${DATA_NAME}_output/"
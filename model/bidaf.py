@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import numpy as np
 
 VERY_BIG_NUMBER = 1e30
@@ -8,7 +9,7 @@ VERY_NEGATIVE_NUMBER = -VERY_BIG_NUMBER
 
 class BIDAF_SpanExtraction(nn.Module):
     def __init__(self, char_vocab_size, word_vocab_size, char_emb_len, word_emb_len, out_channel_dims, filter_heights,
-    max_word_len, char_out_size, dropout_rate, hidden_size, highway_num_layers):
+    max_word_len, char_out_size, dropout_rate, hidden_size, highway_num_layers, packed_sequence=False):
         super(BIDAF_SpanExtraction, self).__init__()
         self.char_vocab_size = char_vocab_size
         self.word_vocab_size = word_vocab_size
@@ -21,6 +22,9 @@ class BIDAF_SpanExtraction(nn.Module):
         self.dropout_rate = dropout_rate
         self.highway_num_layers = highway_num_layers
         self.hidden_size = hidden_size
+        # run the LSTMs over packed sequences, so the padding is neither computed nor part of the backward states
+        # (off by default: on the CPU packed training steps are about 2x slower, see experiments/benchmarks)
+        self.packed_sequence = packed_sequence
 
         # 1. Character Embedding Layer
         self.char_emb = nn.Embedding(self.char_vocab_size, self.char_emb_len)
@@ -84,6 +88,32 @@ class BIDAF_SpanExtraction(nn.Module):
         self.dropout = nn.Dropout(p=self.dropout_rate)
         
 
+    def lstm_forward(self, lstm, x, lens):
+        """
+        :param x: (batch, seq_len, input_size)
+        :param lens: (batch), lengths of the sequences in x
+        :return: (batch, seq_len, hidden_size * 2), zero at the padded positions with packed_sequence
+        """
+        if not self.packed_sequence:
+            return lstm(x)[0]
+        # pack_padded_sequence sorts the batch by length itself (enforce_sorted=False), lengths must be on the cpu
+        packed = pack_padded_sequence(x, lens.cpu().clamp(min=1), batch_first=True, enforce_sorted=False)
+        return pad_packed_sequence(lstm(packed)[0], batch_first=True, total_length=x.size(1))[0]
+
+    def att_similarity(self, c, q):
+        """
+        Trilinear similarity w_c * c + w_q * q + w_cq * (c o q) of every context and question word.
+        The last term is (c o w_cq) q^T, so the whole (batch, c_len, q_len) matrix is one batched matmul.
+        :param c: (batch, c_len, hidden_size * 2)
+        :param q: (batch, q_len, hidden_size * 2)
+        :return: (batch, c_len, q_len)
+        """
+        # (batch, c_len, 1) + (batch, 1, q_len)
+        s = self.att_weight_c(c) + self.att_weight_q(q).transpose(1, 2)
+        # (batch, c_len, hidden_size * 2) * (batch, hidden_size * 2, q_len) -> (batch, c_len, q_len)
+        cq = torch.bmm(c * self.att_weight_cq.weight.view(1, 1, -1), q.transpose(1, 2))
+        return s + cq + self.att_weight_cq.bias
+
     def forward(self, x, cx, x_mask, q, cq, q_mask, y, y2, glove_emb_weights, device):
         """
         x -> [batch_size, max_sent_len]
@@ -137,46 +167,29 @@ class BIDAF_SpanExtraction(nn.Module):
             # (batch, seq_len, hidden_size * 2)
             return x
 
-        def att_flow_layer(c, q):
+        def att_flow_layer(c, q, c_mask, q_mask):
             """
             :param c: (batch, c_len, hidden_size * 2)
             :param q: (batch, q_len, hidden_size * 2)
-            :return: (batch, c_len, q_len)
+            :param c_mask: (batch, c_len)
+            :param q_mask: (batch, q_len)
+            :return: (batch, c_len, hidden_size * 8)
             """
             c_len = c.size(1)
-            q_len = q.size(1)
-
-            # (batch, c_len, q_len, hidden_size * 2)
-            #c_tiled = c.unsqueeze(2).expand(-1, -1, q_len, -1)
-            # (batch, c_len, q_len, hidden_size * 2)
-            #q_tiled = q.unsqueeze(1).expand(-1, c_len, -1, -1)
-            # (batch, c_len, q_len, hidden_size * 2)
-            #cq_tiled = c_tiled * q_tiled
-            #cq_tiled = c.unsqueeze(2).expand(-1, -1, q_len, -1) * q.unsqueeze(1).expand(-1, c_len, -1, -1)
-
-            cq = []
-            for i in range(q_len):
-                #(batch, 1, hidden_size * 2)
-                qi = q.select(1, i).unsqueeze(1)
-                #(batch, c_len, 1)
-                ci = self.att_weight_cq(c * qi).squeeze()
-                cq.append(ci)
-            # (batch, c_len, q_len)
-            cq = torch.stack(cq, dim=-1)
 
             # (batch, c_len, q_len)
-            s = self.att_weight_c(c).expand(-1, -1, q_len) + \
-                self.att_weight_q(q).permute(0, 2, 1).expand(-1, c_len, -1) + \
-                cq
+            s = self.att_similarity(c, q)
+            # padded question words get no attention, padded context words are never the max of q2c
+            s = s.masked_fill(~q_mask.unsqueeze(1), VERY_NEGATIVE_NUMBER)
 
             # (batch, c_len, q_len)
             a = F.softmax(s, dim=2)
             # (batch, c_len, q_len) * (batch, q_len, hidden_size * 2) -> (batch, c_len, hidden_size * 2)
             c2q_att = torch.bmm(a, q)
             # (batch, 1, c_len)
-            b = F.softmax(torch.max(s, dim=2)[0], dim=1).unsqueeze(1)
+            b = F.softmax(torch.max(s, dim=2)[0].masked_fill(~c_mask, VERY_NEGATIVE_NUMBER), dim=1).unsqueeze(1)
             # (batch, 1, c_len) * (batch, c_len, hidden_size * 2) -> (batch, hidden_size * 2)
-            q2c_att = torch.bmm(b, c).squeeze()
+            q2c_att = torch.bmm(b, c).squeeze(1)
             # (batch, c_len, hidden_size * 2) (tiled)
             q2c_att = q2c_att.unsqueeze(1).expand(-1, c_len, -1)
             # q2c_att = torch.stack([q2c_att] * c_len, dim=1)
@@ -189,6 +202,7 @@ class BIDAF_SpanExtraction(nn.Module):
             """
             :param g: (batch, c_len, hidden_size * 8)
             :param m: (batch, c_len ,hidden_size * 2)
+            :param l: (batch), context lengths
             :return: p1: (batch, c_len), p2: (batch, c_len)
             """
             # (batch, c_len)
@@ -197,7 +211,7 @@ class BIDAF_SpanExtraction(nn.Module):
             m1 = torch.sum(torch.softmax(torch.unsqueeze(p1, -1), -1) * m, dim=1, keepdim=True).repeat(1, p1.size(1), 1)
             # (batch, c_len, hidden_size * 2)
             # m2 = self.dropout(self.output_LSTM(m)[0])
-            m2 = self.dropout(self.output_LSTM(torch.cat([g, m, m1, m * m1], -1))[0])
+            m2 = self.dropout(self.lstm_forward(self.output_LSTM, torch.cat([g, m, m1, m * m1], -1), l))
             # (batch, c_len)
             p2 = (self.dropout(self.p2_weight_g(g)) + self.dropout(self.p2_weight_m(m2))).squeeze()
 
@@ -218,12 +232,13 @@ class BIDAF_SpanExtraction(nn.Module):
         c = highway_network(c_char, c_word)
         q = highway_network(q_char, q_word)
         # 3. Contextual Embedding Layer
-        c = self.dropout(self.context_LSTM((c))[0])
-        q = self.dropout(self.context_LSTM((q))[0])
+        c = self.dropout(self.lstm_forward(self.context_LSTM, c, c_lens))
+        q = self.dropout(self.lstm_forward(self.context_LSTM, q, q_lens))
         # 4. Attention Flow Layer
-        g = att_flow_layer(c, q)
+        g = att_flow_layer(c, q, x_mask.bool(), q_mask.bool())
         # 5. Modeling Layer
-        m = self.dropout(self.modeling_LSTM2(self.dropout(self.modeling_LSTM1(g)[0]))[0])
+        m = self.dropout(self.lstm_forward(self.modeling_LSTM2,
+                                           self.dropout(self.lstm_forward(self.modeling_LSTM1, g, c_lens)), c_lens))
         # 6. Output Layer
         p1, p2 = output_layer(g, m, c_lens)
 
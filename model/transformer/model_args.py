@@ -23,12 +23,14 @@ def get_special_tokens():
 class ModelArgs:
     adam_epsilon: float = 1e-8
     best_model_dir: str = "outputs/best_model"
+    bucket_size_multiplier: int = 100
     cache_dir: str = "cache_dir/"
     config: dict = field(default_factory=dict)
     custom_layer_parameters: list = field(default_factory=list)
     custom_parameter_groups: list = field(default_factory=list)
-    dataloader_num_workers: int = field(default_factory=get_default_process_count)
+    dataloader_num_workers: int = 0
     do_lower_case: bool = False
+    dynamic_padding: bool = False
     dynamic_quantize: bool = False
     early_stopping_consider_epochs: bool = False
     early_stopping_delta: float = 0
@@ -45,9 +47,12 @@ class ModelArgs:
     fp16: bool = True
     gradient_accumulation_steps: int = 1
     learning_rate: float = 4e-5
+    length_bucketing: bool = False
     local_rank: int = -1
     logging_steps: int = 50
     manual_seed: int = None
+    max_cache_size_gb: float = None
+    max_cached_clients: int = 2
     max_grad_norm: float = 1.0
     max_seq_length: int = 128
     model_name: str = None
@@ -60,6 +65,8 @@ class ModelArgs:
     epochs: int = 1
     output_dir: str = "outputs/"
     overwrite_output_dir: bool = False
+    prefetch_clients: bool = True
+    prefetch_depth: int = 2
     process_count: int = field(default_factory=get_default_process_count)
     quantized_model: bool = False
     reprocess_input_data: bool = True
@@ -130,6 +137,7 @@ class ClassificationArgs(ModelArgs):
     sliding_window: bool = False
     stride: float = 0.8
     tie_value: int = 1
+    use_fast_tokenizer: bool = False
     evaluate_during_training_steps: int = 20
     evaluate_during_training: bool = True
 
@@ -183,6 +191,8 @@ class Seq2SeqArgs(ModelArgs):
     dataset_class: Dataset = None
     do_sample: bool = False
     early_stopping: bool = True
+    eval_generation_every: int = 1
+    eval_generation_samples: int = 0
     evaluate_generated_text: bool = False
     length_penalty: float = 2.0
     max_length: int = 20
@@ -190,6 +200,8 @@ class Seq2SeqArgs(ModelArgs):
     num_beams: int = 4
     num_return_sequences: int = 1
     repetition_penalty: float = 1.0
+    rouge_on_token_ids: bool = False
+    rouge_workers: int = 0
     top_k: float = None
     top_p: float = None
     use_multiprocessed_decoding: bool = False
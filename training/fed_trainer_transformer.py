@@ -1,25 +1,114 @@
 import logging
+import time
+
+import torch
 
 from FedML.fedml_core.trainer.model_trainer import ModelTrainer
+from training.utils.aggregation import StateDictAverager
+from training.utils.compression import CompressedTensor
+
+# suffix of the keys whose value is the change against the last global model instead of the value itself
+DELTA_SUFFIX = "@delta"
+
+
+def state_dict_bytes(state_dict):
+    return sum(tensor.nbytes() if isinstance(tensor, CompressedTensor) else tensor.numel() * tensor.element_size()
+               for tensor in state_dict.values())
 
 
 class FedTransformerTrainer(ModelTrainer):
+    """
+    With trainable_params_only the model parameters exchanged are the parameters with requires_grad only (e.g.
+    without the layers frozen by --freeze_layers), and set_model_params merges such partial state dicts into the
+    model.
+    With send_model_deltas a client that trained since it last received the global model sends its floating point
+    parameters as <name>@delta = local - global. A weighted average of the deltas is a delta again, which the
+    receiver adds to its own (global) model, so this only fits aggregations that average the client models
+    (FedAvg, FedProx). The server never trains and always sends values.
+    With a compressor (see training/utils/compression.py) the floating point tensors sent are compressed, and the
+    compressed tensors received are decoded.
+    The bytes sent and received are counted per call in sent_bytes and received_bytes.
+    On the server, add_client_params and aggregate average the client models as they arrive (see
+    streaming_aggregator).
+    """
 
-    def __init__(self, trainer, model):
+    def __init__(self, trainer, model, trainable_params_only=False, send_model_deltas=False, compressor=None):
         super().__init__(model)
         self.model_trainer = trainer
         self.model = model
+        self.trainable_params_only = trainable_params_only
+        self.send_model_deltas = send_model_deltas
+        self.compressor = compressor
+        # the parameters of the last received global model, only kept for send_model_deltas
+        self.global_params = None
+        self.trained = False
+        self.sent_bytes = []
+        self.received_bytes = []
+        # the running weighted average of the client models of a round, only used on the server
+        self.averager = StateDictAverager()
 
     def get_model_params(self):
-        return self.model.cpu().state_dict()
+        state_dict = self.model.state_dict()
+        if self.trainable_params_only:
+            trainable_names = [name for name, param in self.model.named_parameters() if param.requires_grad]
+            state_dict = {name: state_dict[name] for name in trainable_names}
+        send_deltas = self.send_model_deltas and self.trained and self.global_params is not None
+        model_params = {}
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu()
+            is_delta = send_deltas and name in self.global_params
+            if is_delta:
+                tensor = tensor - self.global_params[name]
+                name = name + DELTA_SUFFIX
+            if self.compressor is not None and tensor.is_floating_point() and \
+                    (is_delta or not self.compressor.updates_only):
+                tensor = self.compressor.compress(name, tensor)
+            model_params[name] = tensor
+        self.sent_bytes.append(state_dict_bytes(model_params))
+        logging.info("model params sent: %d tensors, %.2f MB (full model %.2f MB)%s" % (
+            len(model_params), self.sent_bytes[-1] / 2 ** 20, state_dict_bytes(self.model.state_dict()) / 2 ** 20,
+            ", as deltas" if send_deltas else ""))
+        return model_params
 
     def set_model_params(self, model_parameters):
-        self.model.load_state_dict(model_parameters)
+        self.received_bytes.append(state_dict_bytes(model_parameters))
+        self._load_model_params(model_parameters)
+
+    def add_client_params(self, model_parameters, sample_num):
+        """Server side: add the model params of a client with sample_num train samples to the average of the round."""
+        self.received_bytes.append(state_dict_bytes(model_parameters))
+        self.averager.add(model_parameters, sample_num)
+
+    def aggregate(self):
+        """Server side: set the model to the weighted average of the client params added since the last call."""
+        self._load_model_params(self.averager.average())
+
+    def _load_model_params(self, model_parameters):
+        model_parameters = {name: tensor.decode() if isinstance(tensor, CompressedTensor) else tensor
+                            for name, tensor in model_parameters.items()}
+        values = {name: tensor for name, tensor in model_parameters.items() if not name.endswith(DELTA_SUFFIX)}
+        self.model.load_state_dict(values, strict=len(values) == len(model_parameters) and
+                                   not self.trainable_params_only)
+        state_dict = self.model.state_dict()
+        with torch.no_grad():
+            for name, delta in model_parameters.items():
+                if name.endswith(DELTA_SUFFIX):
+                    name = name[: -len(DELTA_SUFFIX)]
+                    tensor = state_dict[name]
+                    # a delta is against the last global model, not against what this process trained since
+                    if self.global_params is not None and name in self.global_params:
+                        tensor.copy_(self.global_params[name])
+                    tensor.add_(delta.to(device=tensor.device, dtype=tensor.dtype))
+        if self.send_model_deltas:
+            self.global_params = {name: tensor.detach().cpu().clone() for name, tensor in state_dict.items()
+                                  if tensor.is_floating_point()}
+        self.trained = False
 
     def train(self, train_data, device, args):
         logging.info("Client(%d)" % self.id + ":| Local Train Data Size = %d" % (len(train_data)))
         self.model_trainer.train_dl = train_data
         self.model_trainer.train_model(device=device)
+        self.trained = True
 
     def test(self, test_data, device, args=None):
         pass
@@ -27,3 +116,31 @@ class FedTransformerTrainer(ModelTrainer):
     def test_on_the_server(self, train_data_local_dict, test_data_local_dict, device, args=None):
         self.model_trainer.eval_model(device=device)
         return True
+
+
+def streaming_aggregator(aggregator_class):
+    """
+    A subclass of the FedML aggregator class (FedAVGAggregator, FedProxAggregator) whose server folds every
+    received client model into the running weighted average of its FedTransformerTrainer right away, instead of
+    keeping the models of all the clients of the round until aggregate. The model sent back to the clients is the
+    one of the server trainer, so values (not deltas) with send_model_deltas.
+    """
+
+    class StreamingAggregator(aggregator_class):
+        def add_local_trained_result(self, index, model_params, sample_num):
+            logging.info("add_model. index = %d" % index)
+            if self.args.is_mobile == 1:
+                from FedML.fedml_api.distributed.fedavg.utils import transform_list_to_tensor
+                model_params = transform_list_to_tensor(model_params)
+            self.trainer.add_client_params(model_params, sample_num)
+            self.sample_num_dict[index] = sample_num
+            self.flag_client_model_uploaded_dict[index] = True
+
+        def aggregate(self):
+            start_time = time.time()
+            self.trainer.aggregate()
+            logging.info("aggregate time cost: %.2f sec" % (time.time() - start_time))
+            return self.get_global_model_params()
+
+    StreamingAggregator.__name__ = "Streaming" + aggregator_class.__name__
+    return StreamingAggregator
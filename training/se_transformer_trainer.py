@@ -3,11 +3,11 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
 import logging
 import math
 import os
 
+import numpy as np
 import torch
 import wandb
 from torch.optim import SGD
@@ -17,11 +17,12 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
+from data_preprocessing.base.prefetcher import DevicePrefetcher
+from training.utils.fedprox import FedProxRegularizer
 from training.utils.span_extraction_utils import (
-    RawResult,
     RawResultExtended,
+    StreamingSpanDecoder,
     to_list,
-    write_predictions,
     write_predictions_extended,
     get_raw_scores,
 )
@@ -138,14 +139,15 @@ class SpanExtractionTrainer:
 
             scaler = amp.GradScaler()
 
+        fedprox = None
         if self.args.fl_algorithm == "FedProx":
-            global_model = copy.deepcopy(self.model)
+            fedprox = FedProxRegularizer(self.model, self.args.fedprox_mu)
 
         for epoch in range(0, args.epochs):
 
             self.model.train()
 
-            for batch_idx, batch in enumerate(self.train_dl):
+            for batch_idx, batch in enumerate(DevicePrefetcher(self.train_dl, device, self.args.prefetch_depth)):
 
                 batch = tuple(t.to(device) for t in batch)
                 # dataset = TensorDataset(all_guid, all_input_ids, all_attention_masks, all_token_type_ids, all_cls_index, 
@@ -166,13 +168,10 @@ class SpanExtractionTrainer:
                 if args.n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu parallel training
 
-                if self.args.fl_algorithm == "FedProx":
-                    fed_prox_reg = 0.0
-                    mu = self.args.fedprox_mu
-                    for (p, g_p) in zip(self.model.parameters(),
-                                        global_model.parameters()):
-                        fed_prox_reg += ((mu / 2) * torch.norm((p - g_p.data)) ** 2)
-                    loss += fed_prox_reg
+                if fedprox is not None:
+                    # adds the gradient of the proximal term, the backward of the loss adds to it
+                    loss_scale = scaler.get_scale() if args.fp16 else 1.0
+                    loss += fedprox.add_gradient(loss_scale / args.gradient_accumulation_steps)
 
                 current_loss = loss.item()
 
@@ -219,7 +218,7 @@ class SpanExtractionTrainer:
         logging.info("test_model self.device: " + str(device))
         self.model.to(device)
 
-        all_predictions, all_nbest_json, scores_diff_json, eval_loss = self.evaluate(output_dir)
+        all_predictions, all_nbest_json, scores_diff_json, eval_loss = self.evaluate(output_dir, device=device)
 
         result, texts = self.calculate_results(all_predictions)
         result["eval_loss"] = eval_loss
@@ -228,14 +227,18 @@ class SpanExtractionTrainer:
 
         return result, all_predictions, texts["incorrect_text"]
 
-    def evaluate(self, output_dir, verbose_logging=False):
+    def evaluate(self, output_dir, verbose_logging=False, device=None):
         """
         Evaluates the model on eval_data.
 
         Utility function to be used by the eval_model() method. Not intended to be used directly.
+        Except for XLNet, the answers of an example are decoded as soon as its features are evaluated and the
+        predictions are streamed to the json files in output_dir, so the nbest predictions are not returned (None).
         """
         tokenizer = self.tokenizer
-        device = torch.device("cuda:0")
+        if not device:
+            device = self.device
+        device = torch.device(device) if device is not None else torch.device("cpu")
         model = self.model
         model.to(device)
         args = self.args
@@ -256,76 +259,97 @@ class SpanExtractionTrainer:
         # if args.n_gpu > 1:
         #     model = torch.nn.DataParallel(model)
 
-        if self.args.fp16:
+        use_amp = self.args.fp16 and device.type == "cuda"
+        if use_amp:
             from torch.cuda import amp
 
+        prefix = "test"
+        os.makedirs(output_dir, exist_ok=True)
+
+        output_prediction_file = os.path.join(output_dir, "predictions_{}.json".format(prefix))
+        output_nbest_file = os.path.join(output_dir, "nbest_predictions_{}.json".format(prefix))
+        output_null_log_odds_file = os.path.join(output_dir, "null_odds_{}.json".format(prefix))
+
         all_results = []
-        for batch in tqdm(self.test_dl, disable=args.silent, desc="Running Evaluation"):
-            batch = tuple(t.to(device) for t in batch)
-
-            with torch.no_grad():
-                inputs = {
-                    "input_ids": batch[1],
-                    "attention_mask": batch[2],
-                    "token_type_ids": batch[3],
-                }
+        decoder = None
+        if args.model_type not in ["xlnet", "xlm"]:
+            decoder = StreamingSpanDecoder(
+                examples,
+                features,
+                args.max_seq_length,
+                args.n_best_size,
+                args.max_answer_length,
+                args.do_lower_case,
+                output_prediction_file,
+                output_nbest_file,
+                output_null_log_odds_file,
+                verbose_logging,
+                True,
+                args.null_score_diff_threshold,
+                dtype=np.float16 if args.fp16 else np.float32,
+                buffer_rows=4 * args.eval_batch_size,
+            )
+        try:
+            for batch in tqdm(self.test_dl, disable=args.silent, desc="Running Evaluation"):
+                batch = tuple(t.to(device) for t in batch)
 
-                if self.args.model_type in [
-                    "xlm",
-                    "roberta",
-                    "distilbert",
-                    "camembert",
-                    "electra",
-                    "xlmroberta",
-                    "bart",
-                ]:
-                    del inputs["token_type_ids"]
+                with torch.no_grad():
+                    inputs = {
+                        "input_ids": batch[1],
+                        "attention_mask": batch[2],
+                        "token_type_ids": batch[3],
+                    }
 
-                example_indices = batch[4]
+                    if self.args.model_type in [
+                        "xlm",
+                        "roberta",
+                        "distilbert",
+                        "camembert",
+                        "electra",
+                        "xlmroberta",
+                        "bart",
+                    ]:
+                        del inputs["token_type_ids"]
 
-                if args.model_type in ["xlnet", "xlm"]:
-                    inputs.update({"cls_index": batch[5], "p_mask": batch[6]})
+                    example_indices = batch[4]
 
-                if self.args.fp16:
-                    with amp.autocast():
+                    if args.model_type in ["xlnet", "xlm"]:
+                        inputs.update({"cls_index": batch[5], "p_mask": batch[6]})
+
+                    if use_amp:
+                        with amp.autocast():
+                            outputs = model(**inputs)
+                            eval_loss += outputs[0].mean().item()
+                    else:
                         outputs = model(**inputs)
                         eval_loss += outputs[0].mean().item()
-                else:
-                    outputs = model(**inputs)
-                    eval_loss += outputs[0].mean().item()
-                begin_idx = len(all_results)
-                for i, _ in enumerate(example_indices):
-                    eval_feature = features[begin_idx + i]
-                    unique_id = int(eval_feature.unique_id)
-                    if args.model_type in ["xlnet", "xlm"]:
-                        # XLNet uses a more complex post-processing procedure
-                        result = RawResultExtended(
-                            unique_id=unique_id,
-                            start_top_log_probs=to_list(outputs[0][i]),
-                            start_top_index=to_list(outputs[1][i]),
-                            end_top_log_probs=to_list(outputs[2][i]),
-                            end_top_index=to_list(outputs[3][i]),
-                            cls_logits=to_list(outputs[4][i]),
-                        )
+                    if decoder is not None:
+                        decoder.add(outputs[0].cpu().numpy(), outputs[1].cpu().numpy())
                     else:
-                        result = RawResult(
-                            unique_id=unique_id,
-                            start_logits=to_list(outputs[0][i]),
-                            end_logits=to_list(outputs[1][i]),
-                        )
-                    all_results.append(result)
-
-            nb_eval_steps += 1
+                        begin_idx = len(all_results)
+                        for i, _ in enumerate(example_indices):
+                            eval_feature = features[begin_idx + i]
+                            unique_id = int(eval_feature.unique_id)
+                            # XLNet uses a more complex post-processing procedure
+                            result = RawResultExtended(
+                                unique_id=unique_id,
+                                start_top_log_probs=to_list(outputs[0][i]),
+                                start_top_index=to_list(outputs[1][i]),
+                                end_top_log_probs=to_list(outputs[2][i]),
+                                end_top_index=to_list(outputs[3][i]),
+                                cls_logits=to_list(outputs[4][i]),
+                            )
+                            all_results.append(result)
+
+                nb_eval_steps += 1
+        except BaseException:
+            # do not leave half written prediction files
+            if decoder is not None:
+                decoder.abort()
+            raise
 
         eval_loss = eval_loss / nb_eval_steps
 
-        prefix = "test"
-        os.makedirs(output_dir, exist_ok=True)
-
-        output_prediction_file = os.path.join(output_dir, "predictions_{}.json".format(prefix))
-        output_nbest_file = os.path.join(output_dir, "nbest_predictions_{}.json".format(prefix))
-        output_null_log_odds_file = os.path.join(output_dir, "null_odds_{}.json".format(prefix))
-
         if args.model_type in ["xlnet", "xlm"]:
             # XLNet uses a more complex post-processing procedure
             (all_predictions, all_nbest_json, scores_diff_json, out_eval) = write_predictions_extended(
@@ -345,20 +369,8 @@ class SpanExtractionTrainer:
                 verbose_logging,
             )
         else:
-            all_predictions, all_nbest_json, scores_diff_json = write_predictions(
-                examples,
-                features,
-                all_results,
-                args.n_best_size,
-                args.max_answer_length,
-                args.do_lower_case,
-                output_prediction_file,
-                output_nbest_file,
-                output_null_log_odds_file,
-                verbose_logging,
-                True,
-                args.null_score_diff_threshold,
-            )
+            all_predictions, scores_diff_json = decoder.close()
+            all_nbest_json = None
 
         return all_predictions, all_nbest_json, scores_diff_json, eval_loss
 
@@ -3,7 +3,6 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
 import logging
 import math
 import os
@@ -14,12 +13,14 @@ import wandb
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 from torch.nn import CrossEntropyLoss
+from training.utils.fedprox import FedProxRegularizer
 from training.utils.seq2seq_utils import *
 from torch.optim import SGD
 from transformers import (
     AdamW,
     get_linear_schedule_with_warmup,
 )
+from transformers.modeling_outputs import BaseModelOutput
 
 # import bleurt 
 
@@ -42,6 +43,14 @@ class Seq2SeqTrainer:
 
         # training results
         self.results = {}
+
+        # number of eval_model calls, and the decoded references of the test data (see eval_model)
+        self.eval_round = 0
+        self.reference_cache = {}
+        self.reference_cache_dl = None
+        self.generation_sample_mask = None
+        # worker processes of the ROUGE-L of the evaluations, created once with args.rouge_workers > 0
+        self.rouge_pool = None
         
 
     def set_data(self, train_dl, test_dl=None):
@@ -49,6 +58,12 @@ class Seq2SeqTrainer:
         self.train_dl = train_dl
         self.test_dl = test_dl
 
+    def _close_rouge_pool(self):
+        if self.rouge_pool is not None:
+            self.rouge_pool.terminate()
+            self.rouge_pool.join()
+            self.rouge_pool = None
+
     def train_model(self, device=None):
 
         if not device:
@@ -143,8 +158,9 @@ class Seq2SeqTrainer:
 
             scaler = amp.GradScaler()
 
+        fedprox = None
         if self.args.fl_algorithm == "FedProx":
-            global_model = copy.deepcopy(self.model)
+            fedprox = FedProxRegularizer(self.model, self.args.fedprox_mu)
 
         # for current_epoch in train_iterator:
         #     model.train()
@@ -170,13 +186,10 @@ class Seq2SeqTrainer:
                 if args.n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu parallel training
 
-                if self.args.fl_algorithm == "FedProx":
-                    fed_prox_reg = 0.0
-                    mu = self.args.fedprox_mu
-                    for (p, g_p) in zip(self.model.parameters(),
-                                        global_model.parameters()):
-                        fed_prox_reg += ((mu / 2) * torch.norm((p - g_p.data)) ** 2)
-                    loss += fed_prox_reg
+                if fedprox is not None:
+                    # adds the gradient of the proximal term, the backward of the loss adds to it
+                    loss_scale = scaler.get_scale() if args.fp16 else 1.0
+                    loss += fedprox.add_gradient(loss_scale / args.gradient_accumulation_steps)
 
                 current_loss = loss.item()
 
@@ -214,13 +227,18 @@ class Seq2SeqTrainer:
         return global_step, tr_loss / global_step
 
     def eval_model(self, epoch=0, global_step=0, device=None):
+        """
+        The loss runs over the whole test set, and the generation (ROUGE-L) reuses the encoder outputs of the loss.
+        ROUGE-L is only computed every eval_generation_every calls, on eval_generation_samples samples of the test
+        set (drawn once with manual_seed, 0 = all of them). The test data does not change between the rounds, so
+        its references are only decoded once.
+        """
         if not device:
             device = self.device
 
         results = {}
 
         eval_loss = 0.0
-        rouge_score = 0.0
         
         # bluert_score = 0.0
         # bluert_checkpoint = "~/fednlp_data/bleurt-base-128"
@@ -228,6 +246,7 @@ class Seq2SeqTrainer:
 
 
         nb_eval_steps = 0
+        nb_generation_steps = 0
 
         n_batches = len(self.test_dl)
 
@@ -240,41 +259,63 @@ class Seq2SeqTrainer:
 
         self.model.to(device)
         self.model.eval()
-        logging.info("len(test_dl) = %d, n_batches = %d" % (len(self.test_dl), n_batches))
-        for i, batch in enumerate(self.test_dl):
-            # batch = tuple(t for t in batch)
-            inputs = self._get_inputs_dict(batch)
-            with torch.no_grad(): 
-                outputs = self.model(**inputs)
-                tmp_eval_loss = outputs[0]
-                summary_ids = self.model.generate(inputs['input_ids'], num_beams=self.args.num_beams, max_length=self.args.max_length, early_stopping=True)
-                hyp_list = [self.decoder_tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False).strip() for g in summary_ids]
-                ref_list = [self.decoder_tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False).strip() for g in inputs['decoder_input_ids']]
-                rouge = Rouge()
-                refs = {idx: [line] for (idx, line) in enumerate(ref_list)}
-                hyps = {idx: [line] for (idx, line) in enumerate(hyp_list)}
-                res = rouge.compute_score(refs, hyps)
-                rouge_score += res[0]
-                # logits = output[0]
-                # loss_fct = CrossEntropyLoss()
-                # loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-                eval_loss += tmp_eval_loss.item()
-                # logging.info("test. batch index = %d, loss = %s" % (i, str(eval_loss)))
-
-            nb_eval_steps += 1
-            start_index = self.args.eval_batch_size * i
-
-            end_index = start_index + self.args.eval_batch_size if i != (n_batches - 1) else test_sample_len
-            logging.info("batch index = %d, start_index = %d, end_index = %d" % (i, start_index, end_index))
+        generate = self.eval_round % max(self.args.eval_generation_every, 1) == 0
+        self.eval_round += 1
+        if self.reference_cache_dl is not self.test_dl:
+            self.reference_cache = {}
+            self.reference_cache_dl = self.test_dl
+            self.generation_sample_mask = self._generation_sample_mask(test_sample_len)
+        # ROUGE of a batch is computed in the background while the next batches are generated
+        if generate and self.args.rouge_workers > 0 and self.rouge_pool is None:
+            self.rouge_pool = create_rouge_pool(self.args.rouge_workers)
+        rouge_accumulator = RougeAccumulator(self.rouge_pool if generate else None)
+        special_ids = set(self.decoder_tokenizer.all_special_ids)
+        logging.info("len(test_dl) = %d, n_batches = %d, generate = %s" % (len(self.test_dl), n_batches, generate))
+        try:
+            for i, batch in enumerate(self.test_dl):
+                # batch = tuple(t for t in batch)
+                inputs = self._get_inputs_dict(batch)
+                # the test data loader is not shuffled, the samples of batch i follow the ones of batch i - 1
+                start_index = self.args.eval_batch_size * i
+                sample_indexes = np.arange(start_index, start_index + inputs["input_ids"].shape[0])
+                rows = np.flatnonzero(self.generation_sample_mask[sample_indexes]) if generate else []
+                with torch.no_grad(): 
+                    encoder_outputs = self.model.get_encoder()(inputs["input_ids"],
+                                                               attention_mask=inputs.get("attention_mask"),
+                                                               return_dict=True)
+                    outputs = self.model(**inputs, encoder_outputs=encoder_outputs)
+                    tmp_eval_loss = outputs[0]
+                    if len(rows) > 0:
+                        summary_ids = self._generate_from_encoder_outputs(inputs, encoder_outputs, rows)
+                        if self.args.rouge_on_token_ids:
+                            # ROUGE-L over the token ids, without decoding
+                            hyp_list = [[t for t in g if t not in special_ids] for g in summary_ids.tolist()]
+                        else:
+                            hyp_list = [self.decoder_tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False).strip() for g in summary_ids]
+                        ref_list = self._references(inputs["decoder_input_ids"], sample_indexes, rows, special_ids)
+                        rouge_accumulator.add(ref_list, hyp_list)
+                        nb_generation_steps += 1
+                    # logits = output[0]
+                    # loss_fct = CrossEntropyLoss()
+                    # loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+                    eval_loss += tmp_eval_loss.item()
+                    # logging.info("test. batch index = %d, loss = %s" % (i, str(eval_loss)))
+
+                nb_eval_steps += 1
+
+                end_index = start_index + self.args.eval_batch_size if i != (n_batches - 1) else test_sample_len
+                logging.info("batch index = %d, start_index = %d, end_index = %d" % (i, start_index, end_index))
  
-        eval_loss = eval_loss / nb_eval_steps
-        rouge_score = rouge_score / nb_eval_steps
+            eval_loss = eval_loss / nb_eval_steps
+            result = {"eval_loss": eval_loss}
+            rouge_scores = rouge_accumulator.batch_scores()
+        except BaseException:
+            # the pending ROUGE-L tasks of this evaluation are of no use any more
+            self._close_rouge_pool()
+            raise
+        if nb_generation_steps > 0:
+            result["rouge_score"] = sum(rouge_scores) / nb_generation_steps
 
-        result = {
-            "eval_loss": eval_loss,
-            "rouge_score": rouge_score
-        }
-        
         wandb.log(result)
         results.update(result)
 
@@ -300,6 +341,47 @@ class Seq2SeqTrainer:
 
         return result, model_preds, None
 
+    def _generation_sample_mask(self, test_sample_len):
+        # the test samples whose generations are evaluated, the same ones in every round
+        if self.args.eval_generation_samples <= 0 or self.args.eval_generation_samples >= test_sample_len:
+            return np.ones(test_sample_len, dtype=bool)
+        rng = np.random.RandomState(self.args.manual_seed)
+        mask = np.zeros(test_sample_len, dtype=bool)
+        mask[rng.choice(test_sample_len, self.args.eval_generation_samples, replace=False)] = True
+        return mask
+
+    def _generate_from_encoder_outputs(self, inputs, encoder_outputs, rows):
+        """
+        model.generate on the given rows of the batch, with the encoder outputs of the loss instead of running the
+        encoder again. Newer versions of generate take them as encoder_outputs, transformers 3 always calls
+        model.get_encoder() on input_ids, so the encoder is swapped for one that returns them while generate runs.
+        """
+        rows = torch.as_tensor(rows, device=inputs["input_ids"].device)
+        # beam search expands the encoder outputs in place, so it gets its own
+        row_outputs = BaseModelOutput(last_hidden_state=encoder_outputs.last_hidden_state.index_select(0, rows))
+        attention_mask = inputs.get("attention_mask")
+        if attention_mask is not None:
+            attention_mask = attention_mask.index_select(0, rows)
+        self.model.get_encoder = lambda: (lambda *args, **kwargs: row_outputs)
+        try:
+            return self.model.generate(inputs["input_ids"].index_select(0, rows), attention_mask=attention_mask,
+                                       encoder_outputs=row_outputs, num_beams=self.args.num_beams, max_length=self.args.max_length,
+                                       early_stopping=True)
+        finally:
+            del self.model.get_encoder
+
+    def _references(self, decoder_input_ids, sample_indexes, rows, special_ids):
+        # the references of the rows, decoded on their first evaluation
+        missing = [row for row in rows if sample_indexes[row] not in self.reference_cache]
+        if len(missing) > 0:
+            if self.args.rouge_on_token_ids:
+                references = [[t for t in g if t not in special_ids] for g in decoder_input_ids[missing].tolist()]
+            else:
+                references = [self.decoder_tokenizer.decode(g, skip_special_tokens=True, clean_up_tokenization_spaces=False).strip() for g in decoder_input_ids[missing]]
+            for row, reference in zip(missing, references):
+                self.reference_cache[sample_indexes[row]] = reference
+        return [self.reference_cache[sample_indexes[row]] for row in rows]
+
     def build_optimizer(self, model, iteration_in_total):
         warmup_steps = math.ceil(iteration_in_total * self.args.warmup_ratio)
         self.args.warmup_steps = warmup_steps if self.args.warmup_steps == 0 else self.args.warmup_steps
@@ -3,7 +3,6 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
 import logging
 import math
 import os
@@ -24,6 +23,9 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
+from data_preprocessing.base.prefetcher import DevicePrefetcher
+from training.utils.fedprox import FedProxRegularizer
+
 
 class SeqTaggingTrainer:
     def __init__(self, args, device, model, train_dl=None, test_dl=None, tokenizer=None):
@@ -65,32 +67,30 @@ class SeqTaggingTrainer:
         global_step = 0
         tr_loss, logging_loss = 0.0, 0.0
 
+        fedprox = None
         if self.args.fl_algorithm == "FedProx":
-            global_model = copy.deepcopy(self.model)
+            fedprox = FedProxRegularizer(self.model, self.args.fedprox_mu)
 
         for epoch in range(0, self.args.epochs):
 
             self.model.train()
 
-            for batch_idx, batch in enumerate(self.train_dl):
+            for batch_idx, batch in enumerate(DevicePrefetcher(self.train_dl, device, self.args.prefetch_depth)):
                 batch = tuple(t for t in batch)
                 # dataset = TensorDataset(all_guid, all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
                 x = batch[1].to(device)
+                attention_mask = batch[2].to(device)
                 labels = batch[4].to(device)
 
                 # (loss), logits, (hidden_states), (attentions)
-                output = self.model(x)
+                output = self.model(x, attention_mask=attention_mask)
                 logits = output[0]
                 loss_fct = CrossEntropyLoss()
 
                 loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-                if self.args.fl_algorithm == "FedProx":
-                    fed_prox_reg = 0.0
-                    mu = self.args.fedprox_mu
-                    for (p, g_p) in zip(self.model.parameters(),
-                                        global_model.parameters()):
-                        fed_prox_reg += ((mu / 2) * torch.norm((p - g_p.data)) ** 2)
-                    loss += fed_prox_reg
+                if fedprox is not None:
+                    # adds the gradient of the proximal term, the backward of the loss adds to it
+                    loss += fedprox.add_gradient(1.0 / self.args.gradient_accumulation_steps)
 
                 # model outputs are always tuple in pytorch-transformers (see doc)
                 # loss = outputs[0]
@@ -138,8 +138,18 @@ class SeqTaggingTrainer:
         pad_token_label_id = self.pad_token_label_id
         eval_output_dir = self.args.output_dir
 
-        preds = None
-        out_label_ids = None
+        # word-level label and prediction ids of the whole test set, and the number of words of every sentence
+        label_buffer = np.empty(test_sample_len * self.args.max_seq_length, dtype=np.int64)
+        pred_buffer = np.empty(test_sample_len * self.args.max_seq_length, dtype=np.int64)
+        word_counts = np.zeros(test_sample_len, dtype=np.int64)
+        n_words = 0
+        n_sentences = 0
+        model_outputs = []
+        ignore_ids = [
+            self.tokenizer.convert_tokens_to_ids(self.tokenizer.pad_token),
+            self.tokenizer.convert_tokens_to_ids(self.tokenizer.sep_token),
+            self.tokenizer.convert_tokens_to_ids(self.tokenizer.cls_token),
+        ]
 
         self.model.to(device)
         self.model.eval()
@@ -150,9 +160,10 @@ class SeqTaggingTrainer:
                 sample_index_list = batch[0].to(device).cpu().numpy()
 
                 x = batch[1].to(device)
+                attention_mask = batch[2].to(device)
                 labels = batch[4].to(device)
 
-                output = self.model(x)
+                output = self.model(x, attention_mask=attention_mask)
                 logits = output[0]
 
                 loss_fct = CrossEntropyLoss()
@@ -166,43 +177,27 @@ class SeqTaggingTrainer:
             end_index = start_index + self.args.eval_batch_size if i != (n_batches - 1) else test_sample_len
             logging.info("batch index = %d, start_index = %d, end_index = %d" % (i, start_index, end_index))
 
-            if preds is None:
-                preds = logits.detach().cpu().numpy()
-                out_label_ids = batch[4].detach().cpu().numpy()
-                out_input_ids = batch[1].detach().cpu().numpy()
-                out_attention_mask = batch[2].detach().cpu().numpy()
-            else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                out_label_ids = np.append(out_label_ids, batch[4].detach().cpu().numpy(), axis=0)
-                out_input_ids = np.append(out_input_ids, batch[1].detach().cpu().numpy(), axis=0)
-                out_attention_mask = np.append(
-                    out_attention_mask, batch[2].detach().cpu().numpy(), axis=0,
-                )
+            token_logits = logits.detach().cpu().numpy()
+            label_ids = batch[4].cpu().numpy()
+            # the words are the positions with a label, the other sub-word tokens are ignored
+            word_mask = label_ids != pad_token_label_id
+            batch_words = int(word_mask.sum())
+            label_buffer[n_words: n_words + batch_words] = label_ids[word_mask]
+            pred_buffer[n_words: n_words + batch_words] = token_logits.argmax(axis=2)[word_mask]
+            word_counts[n_sentences: n_sentences + len(label_ids)] = word_mask.sum(axis=1)
+            model_outputs.extend(self._convert_tokens_to_word_logits(
+                batch[1].cpu().numpy(), label_ids, batch[2].cpu().numpy(), token_logits, ignore_ids))
+            n_words += batch_words
+            n_sentences += len(label_ids)
 
         eval_loss = eval_loss / nb_eval_steps
 
-        token_logits = preds
-        preds = np.argmax(preds, axis=2)
-
-        label_map = {i: label for i, label in enumerate(self.args.labels_list)}
-
-        out_label_list = [[] for _ in range(out_label_ids.shape[0])]
-        preds_list = [[] for _ in range(out_label_ids.shape[0])]
-
-        for i in range(out_label_ids.shape[0]):
-            for j in range(out_label_ids.shape[1]):
-                if out_label_ids[i, j] != pad_token_label_id:
-                    out_label_list[i].append(label_map[out_label_ids[i][j]])
-                    preds_list[i].append(label_map[preds[i][j]])
-
-        word_tokens = []
-        for i in range(len(preds_list)):
-            w_log = self._convert_tokens_to_word_logits(
-                out_input_ids[i], out_label_ids[i], out_attention_mask[i], token_logits[i],
-            )
-            word_tokens.append(w_log)
+        label_names = np.array(self.args.labels_list, dtype=object)
+        sentence_ends = np.cumsum(word_counts[:n_sentences])[:-1]
+        out_label_list = [labels.tolist() for labels in np.split(label_names[label_buffer[:n_words]], sentence_ends)]
+        preds_list = [preds.tolist() for preds in np.split(label_names[pred_buffer[:n_words]], sentence_ends)]
 
-        model_outputs = [[word_tokens[i][j] for j in range(len(preds_list[i]))] for i in range(len(preds_list))]
+        model_outputs = [model_outputs[i][: len(preds_list[i])] for i in range(len(preds_list))]
         logging.info(preds_list[:2])
         logging.info(out_label_list[:2])
         result = {
@@ -242,33 +237,25 @@ class SeqTaggingTrainer:
         )
         return optimizer, scheduler
 
-    def _convert_tokens_to_word_logits(self, input_ids, label_ids, attention_mask, logits):
-
-        ignore_ids = [
-            self.tokenizer.convert_tokens_to_ids(self.tokenizer.pad_token),
-            self.tokenizer.convert_tokens_to_ids(self.tokenizer.sep_token),
-            self.tokenizer.convert_tokens_to_ids(self.tokenizer.cls_token),
-        ]
-
-        # Remove unuseful positions
-        masked_ids = input_ids[(1 == attention_mask)]
-        masked_labels = label_ids[(1 == attention_mask)]
-        masked_logits = logits[(1 == attention_mask)]
-        for id in ignore_ids:
-            masked_labels = masked_labels[(id != masked_ids)]
-            masked_logits = masked_logits[(id != masked_ids)]
-            masked_ids = masked_ids[(id != masked_ids)]
-
-        # Map to word logits
+    def _convert_tokens_to_word_logits(self, input_ids, label_ids, attention_mask, logits, ignore_ids):
+        """
+        Logits of the words of a batch: a word starts at a token with a label and takes the logits of the following
+        tokens without one. Padding, [CLS] and [SEP] are left out.
+        Returns a list (sentences) of lists (words) of lists (tokens) of logits.
+        """
+        keep = (attention_mask == 1) & ~np.isin(input_ids, ignore_ids)
+        rows, columns = np.nonzero(keep)
+        kept_logits = logits[rows, columns]
+        # a new word at every labelled token and at the first kept token of every sentence
+        first_of_row = np.ones(len(rows), dtype=bool)
+        first_of_row[1:] = rows[1:] != rows[:-1]
+        word_starts = np.flatnonzero(first_of_row | (label_ids[rows, columns] != self.pad_token_label_id))
+        words = [word.tolist() for word in np.split(kept_logits, word_starts[1:])]
+        # words per sentence, a sentence without kept tokens has a single empty word
+        words_per_row = np.bincount(rows[word_starts], minlength=len(input_ids))
         word_logits = []
-        tmp = []
-        for n, lab in enumerate(masked_labels):
-            if lab != self.pad_token_label_id:
-                if n != 0:
-                    word_logits.append(tmp)
-                tmp = [list(masked_logits[n])]
-            else:
-                tmp.append(list(masked_logits[n]))
-        word_logits.append(tmp)
-
+        start = 0
+        for count in words_per_row:
+            word_logits.append(words[start: start + count] if count > 0 else [[]])
+            start += count
         return word_logits
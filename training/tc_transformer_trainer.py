@@ -3,7 +3,6 @@
 
 from __future__ import absolute_import, division, print_function
 
-import copy
 import logging
 import math
 import os
@@ -12,6 +11,8 @@ import numpy as np
 import sklearn
 import torch
 import wandb
+from data_preprocessing.base.prefetcher import DevicePrefetcher
+from training.utils.fedprox import FedProxRegularizer
 from training.utils.text_classification_utils import *
 from torch.nn import CrossEntropyLoss
 from torch.optim import SGD
@@ -61,33 +62,31 @@ class TextClassificationTrainer:
         global_step = 0
         tr_loss, logging_loss = 0.0, 0.0
 
+        fedprox = None
         if self.args.fl_algorithm == "FedProx":
-            global_model = copy.deepcopy(self.model)
+            fedprox = FedProxRegularizer(self.model, self.args.fedprox_mu)
 
         for epoch in range(0, self.args.epochs):
 
             self.model.train()
 
-            for batch_idx, batch in enumerate(self.train_dl):
+            for batch_idx, batch in enumerate(DevicePrefetcher(self.train_dl, device, self.args.prefetch_depth)):
                 batch = tuple(t for t in batch)
                 # dataset = TensorDataset(all_guid, all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
                 x = batch[1].to(device)
+                attention_mask = batch[2].to(device)
                 labels = batch[4].to(device)
 
                 # (loss), logits, (hidden_states), (attentions)
-                output = self.model(x)
+                output = self.model(x, attention_mask=attention_mask)
                 logits = output[0]
 
                 loss_fct = CrossEntropyLoss()
                 loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
-                if self.args.fl_algorithm == "FedProx":
-                    fed_prox_reg = 0.0
-                    mu = self.args.fedprox_mu
-                    for (p, g_p) in zip(self.model.parameters(),
-                                        global_model.parameters()):
-                        fed_prox_reg += ((mu / 2) * torch.norm((p - g_p.data)) ** 2)
-                    loss += fed_prox_reg
+                if fedprox is not None:
+                    # adds the gradient of the proximal term, the backward of the loss adds to it
+                    loss += fedprox.add_gradient(1.0 / self.args.gradient_accumulation_steps)
 
                 # model outputs are always tuple in pytorch-transformers (see doc)
                 # loss = outputs[0]
@@ -143,9 +142,10 @@ class TextClassificationTrainer:
                 # if i == len(self.test_dl) - 1:
                 #     logging.info(batch)
                 x = batch[1]
+                attention_mask = batch[2]
                 labels = batch[4]
 
-                output = self.model(x)
+                output = self.model(x, attention_mask=attention_mask)
                 logits = output[0]
 
                 loss_fct = CrossEntropyLoss()
@@ -0,0 +1,96 @@
+"""
+Streaming weighted averaging of model state dicts (FedAvg, FedProx).
+
+Instead of collecting the state dicts of all the clients of a round and averaging them afterwards, a
+StateDictAverager folds every state dict into one preallocated flat buffer as it arrives:
+
+    buffer[entry] += sample_num * state_dict[name]      (in place, per received state dict)
+    buffer *= 1 / total sample num                       (once, when the average is taken)
+
+so the memory of the aggregation is one model whatever the number of clients. The floating point entries share
+one contiguous buffer (float32, or float64 when an entry is float64); the other entries (e.g. num_batches_tracked)
+are those of the first state dict, as averaging them makes no sense. The layout of the buffer is taken from the
+first state dict of an average, the next ones must have the same keys. The values may be CompressedTensors (see
+training/utils/compression.py), which are added without building the dense tensor when they can.
+"""
+import torch
+
+from training.utils.compression import CompressedTensor
+
+
+class StateDictAverager(object):
+    def __init__(self, device=None):
+        # device of the buffer, that of the first floating point entry added if None
+        self.device = device
+        self.buffer = None
+        # name -> (offset, shape, dtype) of the floating point entries in the buffer
+        self.layout = None
+        self.others = None
+        self.total_weight = 0
+        self.count = 0
+
+    def _create_buffer(self, state_dict):
+        self.layout = {}
+        offset = 0
+        buffer_dtype = torch.float32
+        device = self.device
+        for name, tensor in state_dict.items():
+            if isinstance(tensor, CompressedTensor):
+                tensor = tensor.decode()
+            if not tensor.is_floating_point():
+                continue
+            if tensor.dtype == torch.float64:
+                buffer_dtype = torch.float64
+            if device is None:
+                device = tensor.device
+            self.layout[name] = (offset, tensor.shape, tensor.dtype)
+            offset += tensor.numel()
+        self.buffer = torch.zeros(offset, dtype=buffer_dtype, device=device if device is not None else "cpu")
+
+    def entry(self, name):
+        """The view of the buffer that holds the (weighted sum of the) entry name."""
+        offset, shape, _ = self.layout[name]
+        return self.buffer[offset: offset + shape.numel()].view(shape)
+
+    def add(self, state_dict, weight):
+        """Add weight * state_dict to the running sum, weight is the number of train samples of the client."""
+        if self.count == 0:
+            # the first state dict of a new average
+            if self.layout is None or any(name not in state_dict for name in self.layout):
+                self._create_buffer(state_dict)
+            else:
+                self.buffer.zero_()
+            self.others = {name: tensor.detach().clone() for name, tensor in state_dict.items()
+                           if name not in self.layout}
+        if len(state_dict) != len(self.layout) + len(self.others):
+            raise Exception("the state dict has %d entries, the first one added had %d" % (
+                len(state_dict), len(self.layout) + len(self.others)))
+        with torch.no_grad():
+            for name, tensor in state_dict.items():
+                if name in self.others:
+                    continue
+                if name not in self.layout:
+                    raise Exception("%s is not an entry of the first state dict of the average" % name)
+                if isinstance(tensor, CompressedTensor):
+                    tensor.add_to(self.entry(name), weight)
+                else:
+                    self.entry(name).add_(tensor.to(self.buffer.device), alpha=weight)
+        self.total_weight += weight
+        self.count += 1
+
+    def average(self):
+        """
+        The weighted average of the state dicts added since the last average. Its floating point entries are views
+        of the buffer (cast to their own dtype if it differs), so use them before the next add.
+        """
+        if self.count == 0:
+            raise Exception("no state dict to average")
+        self.buffer.mul_(1.0 / self.total_weight)
+        averaged = {}
+        for name, (_, _, dtype) in self.layout.items():
+            averaged[name] = self.entry(name).to(dtype)
+        averaged.update(self.others)
+        # the next add starts a new average in the same buffer
+        self.total_weight = 0
+        self.count = 0
+        return averaged
@@ -0,0 +1,136 @@
+"""
+Compression of the model payloads exchanged by FedTransformerTrainer.
+
+A compressor turns a floating point tensor of a payload into a CompressedTensor (the tensors of
+a compressor with updates_only are only compressed when they are deltas):
+
+    fp16    HalfTensor, the tensor cast to float16
+    int8    Int8Tensor, symmetric per-tensor quantization to int8 with one float32 scale
+    topk    SparseTensor, the ratio largest magnitudes with their indices. What is left out is kept in a
+            residual per tensor name and added to the next update of that tensor (error feedback), so nothing
+            is lost, only delayed. Only meant for updates (deltas), not for the model weights themselves.
+
+A CompressedTensor is pickled in its compact form. Multiplying or adding it decodes it, so the
+weighted sum of a FedAvg aggregator works on the received payloads as they are; add_to adds it in
+place (what StateDictAverager uses, a SparseTensor is not decoded for it) and set_model_params
+decodes them explicitly.
+"""
+import torch
+
+COMPRESSIONS = ["none", "fp16", "int8", "topk"]
+
+
+class CompressedTensor(object):
+    def decode(self):
+        raise NotImplementedError()
+
+    def nbytes(self):
+        raise NotImplementedError()
+
+    def add_to(self, tensor, alpha=1):
+        """tensor += alpha * decoded tensor, in place."""
+        tensor.add_(self.decode().to(tensor.device).view_as(tensor), alpha=alpha)
+
+    def __mul__(self, other):
+        return self.decode() * other
+
+    __rmul__ = __mul__
+
+    def __add__(self, other):
+        return self.decode() + other
+
+    __radd__ = __add__
+
+
+class HalfTensor(CompressedTensor):
+    def __init__(self, tensor):
+        self.dtype = tensor.dtype
+        self.data = tensor.to(torch.float16)
+
+    def decode(self):
+        return self.data.to(self.dtype)
+
+    def nbytes(self):
+        return self.data.numel() * self.data.element_size()
+
+
+class Int8Tensor(CompressedTensor):
+    def __init__(self, tensor):
+        self.dtype = tensor.dtype
+        max_abs = tensor.abs().max().item() if tensor.numel() > 0 else 0.0
+        self.scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        self.data = torch.round(tensor / self.scale).clamp_(-127, 127).to(torch.int8)
+
+    def decode(self):
+        return self.data.to(self.dtype) * self.scale
+
+    def nbytes(self):
+        return self.data.numel() + 4
+
+
+class SparseTensor(CompressedTensor):
+    def __init__(self, indices, values, shape):
+        self.indices = indices
+        self.values = values
+        self.shape = shape
+
+    def decode(self):
+        tensor = torch.zeros(self.shape, dtype=self.values.dtype)
+        tensor.view(-1)[self.indices.long()] = self.values
+        return tensor
+
+    def add_to(self, tensor, alpha=1):
+        values = (self.values * alpha).to(device=tensor.device, dtype=tensor.dtype)
+        tensor.view(-1).index_add_(0, self.indices.long().to(tensor.device), values)
+
+    def nbytes(self):
+        return self.indices.numel() * self.indices.element_size() + self.values.numel() * self.values.element_size()
+
+
+class FP16Compressor(object):
+    updates_only = False
+
+    def compress(self, name, tensor):
+        return HalfTensor(tensor)
+
+
+class Int8Compressor(object):
+    updates_only = False
+
+    def compress(self, name, tensor):
+        return Int8Tensor(tensor)
+
+
+class TopKCompressor(object):
+    updates_only = True
+
+    def __init__(self, ratio=0.01):
+        self.ratio = ratio
+        # the error feedback of every tensor name
+        self.residuals = {}
+
+    def compress(self, name, tensor):
+        update = tensor.reshape(-1)
+        if name in self.residuals:
+            update = update + self.residuals[name]
+        k = max(1, int(self.ratio * update.numel()))
+        indices = torch.topk(update.abs(), k, sorted=False).indices
+        values = update[indices]
+        residual = update.clone()
+        residual[indices] = 0
+        self.residuals[name] = residual
+        # int32 indices unless the tensor is too large for them
+        index_dtype = torch.int32 if update.numel() < 2 ** 31 else torch.int64
+        return SparseTensor(indices.to(index_dtype), values, tensor.shape)
+
+
+def create_compressor(compression, topk_ratio=0.01):
+    if compression == "none":
+        return None
+    elif compression == "fp16":
+        return FP16Compressor()
+    elif compression == "int8":
+        return Int8Compressor()
+    elif compression == "topk":
+        return TopKCompressor(topk_ratio)
+    raise Exception("unknown compression %s, expected one of %s" % (compression, ", ".join(COMPRESSIONS)))
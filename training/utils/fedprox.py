@@ -0,0 +1,44 @@
+"""
+The proximal term of FedProx, (mu / 2) * ||w - w_global||^2, for the task trainers.
+
+The global weights are copied once, when the local training starts, into one contiguous buffer. At every step
+w - w_global is written into a second flat buffer (one subtraction per parameter, no allocation), the term is
+the dot product of that buffer with itself, and its gradient mu * (w - w_global) is added to the gradients of the
+parameters directly instead of going through autograd. The parameters without requires_grad are left out, they
+do not move away from the global model.
+"""
+import torch
+
+
+class FedProxRegularizer(object):
+    def __init__(self, model, mu):
+        self.mu = mu
+        self.params = [param for param in model.parameters() if param.requires_grad]
+        numels = [param.numel() for param in self.params]
+        dtype = self.params[0].dtype if self.params else torch.float32
+        device = self.params[0].device if self.params else None
+        self.global_buffer = torch.empty(sum(numels), dtype=dtype, device=device)
+        self.diff_buffer = torch.empty_like(self.global_buffer)
+        self.global_params = [view.view_as(param) for view, param in
+                              zip(torch.split(self.global_buffer, numels), self.params)]
+        self.diffs = [view.view_as(param) for view, param in zip(torch.split(self.diff_buffer, numels), self.params)]
+        with torch.no_grad():
+            for global_param, param in zip(self.global_params, self.params):
+                global_param.copy_(param)
+
+    def add_gradient(self, scale=1.0):
+        """
+        Add scale * mu * (w - w_global) to the gradients of the parameters and return the proximal term (without
+        scale) as a tensor without grad, to add to the loss that is logged. Call it once per backward, with the
+        factor the loss is multiplied by before its backward as scale (1 / gradient_accumulation_steps, times the
+        loss scale of a GradScaler).
+        """
+        with torch.no_grad():
+            for diff, param, global_param in zip(self.diffs, self.params, self.global_params):
+                torch.sub(param, global_param, out=diff)
+            for diff, param in zip(self.diffs, self.params):
+                if param.grad is None:
+                    param.grad = diff.mul(self.mu * scale)
+                else:
+                    param.grad.add_(diff, alpha=self.mu * scale)
+            return (self.mu / 2) * torch.dot(self.diff_buffer, self.diff_buffer)
@@ -9,6 +9,7 @@
 
 import numpy as np
 import pdb
+from multiprocessing import get_context
 
 def my_lcs(string, sub):
     """
@@ -18,20 +19,27 @@ def my_lcs(string, sub):
     :returns: length (list of int): length of the longest common subsequence between the two strings
 
     Note: my_lcs only gives length of the longest common subsequence, not the actual LCS
+    Works on any hashable tokens (e.g. token ids). Bit-parallel (Allison-Dix / Crochemore et al.): a row of the DP
+    table is kept as the bits of an integer over the longer sequence, so the table is filled one python integer
+    operation per token of the shorter one instead of one step per cell.
     """
     if(len(string)< len(sub)):
         sub, string = string, sub
-
-    lengths = [[0 for i in range(0,len(sub)+1)] for j in range(0,len(string)+1)]
-
-    for j in range(1,len(sub)+1):
-        for i in range(1,len(string)+1):
-            if(string[i-1] == sub[j-1]):
-                lengths[i][j] = lengths[i-1][j-1] + 1
-            else:
-                lengths[i][j] = max(lengths[i-1][j] , lengths[i][j-1])
-
-    return lengths[len(string)][len(sub)]
+    if len(sub) == 0:
+        return 0
+
+    # bit i of the match mask of a token is set where string[i] is that token
+    match_masks = {}
+    for i, token in enumerate(string):
+        match_masks[token] = match_masks.get(token, 0) | (1 << i)
+
+    all_ones = (1 << len(string)) - 1
+    row = all_ones
+    for token in sub:
+        matches = row & match_masks.get(token, 0)
+        row = ((row + matches) | (row - matches)) & all_ones
+    # the zero bits of the row count the LCS
+    return len(string) - bin(row).count("1")
 
 class Rouge():
     '''
@@ -51,15 +59,26 @@ class Rouge():
         """
         assert(len(candidate)==1)	
         assert(len(refs)>0)         
-        prec = []
-        rec = []
 
         # split into tokens
-        token_c = candidate[0].split(" ")
-    	
-        for reference in refs:
-            # split into tokens
-            token_r = reference.split(" ")
+        return self.calc_token_score(candidate[0].split(" "), [reference.split(" ") for reference in refs])
+
+    def calc_token_score(self, token_c, token_refs):
+        """
+        calc_score of a tokenized candidate and references, the tokens can be words or token ids
+        :param token_c: list : tokens of the candidate
+        :param token_refs: list of list : tokens of the references
+        :returns score: float (ROUGE-L score)
+        """
+        if len(token_c) == 0:
+            return 0.0
+        prec = []
+        rec = []
+        for token_r in token_refs:
+            if len(token_r) == 0:
+                prec.append(0.0)
+                rec.append(0.0)
+                continue
             # compute the longest common subsequence
             lcs = my_lcs(token_r, token_c)
             prec.append(lcs/float(len(token_c)))
@@ -102,4 +121,46 @@ class Rouge():
         return average_score, np.array(score)
 
     def method(self):
-        return "Rouge"
\ No newline at end of file
+        return "Rouge"
+
+
+def _rouge_l_batch(refs, hyps, beta):
+    # mean ROUGE-L of a batch, the references and hypotheses are strings or lists of tokens (ids)
+    rouge = Rouge()
+    rouge.beta = beta
+    scores = [rouge.calc_token_score(hyp.split(" ") if isinstance(hyp, str) else hyp,
+                                     [ref.split(" ") if isinstance(ref, str) else ref])
+              for ref, hyp in zip(refs, hyps)]
+    return float(np.mean(np.array(scores)))
+
+
+def create_rouge_pool(num_workers):
+    """
+    Worker processes for RougeAccumulator, meant to be kept across evaluations. They are spawned, not forked,
+    since the evaluating process may have initialized CUDA or MPI.
+    """
+    return get_context("spawn").Pool(num_workers)
+
+
+class RougeAccumulator():
+    """
+    Computes the mean ROUGE-L (Rouge().compute_score) of the batches of an evaluation in the processes of pool (see
+    create_rouge_pool), so the evaluation loop goes on with the next batch. Without a pool they are computed right
+    away. The pool is not closed by the accumulator.
+    """
+
+    def __init__(self, pool=None, beta=1.2):
+        self.beta = beta
+        self.pool = pool
+        self.batch_results = []
+
+    def add(self, refs, hyps):
+        """refs and hyps are the references and hypotheses of a batch, as strings or as lists of token ids"""
+        if self.pool is not None:
+            self.batch_results.append(self.pool.apply_async(_rouge_l_batch, (refs, hyps, self.beta)))
+        else:
+            self.batch_results.append(_rouge_l_batch(refs, hyps, self.beta))
+
+    def batch_scores(self):
+        """Wait for the workers, returns the mean ROUGE-L of every batch in the order they were added"""
+        return [result.get() if self.pool is not None else result for result in self.batch_results]
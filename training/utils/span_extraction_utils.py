@@ -4,7 +4,9 @@ import logging
 import string
 import re
 import math
+import os
 
+import numpy as np
 from transformers.tokenization_bert import BasicTokenizer
 
 from transformers import XLMTokenizer
@@ -23,129 +25,149 @@ def to_list(tensor):
     return tensor.detach().cpu().tolist()
 
 
-def write_predictions(
-    all_examples,
-    all_features,
-    all_results,
+def feature_span_masks(features, max_seq_length):
+    """
+    Boolean [num_features, max_seq_length] arrays of the token positions a predicted span may start and end at:
+    a span ends at a token of the document and starts at a token of the document whose feature has its max context.
+    """
+    valid_start = np.zeros((len(features), max_seq_length), dtype=bool)
+    valid_end = np.zeros((len(features), max_seq_length), dtype=bool)
+    for i, feature in enumerate(features):
+        num_tokens = min(len(feature.tokens), max_seq_length)
+        valid_end[i, [index for index in feature.token_to_orig_map if index < num_tokens]] = True
+        valid_start[i, [index for index, is_max in feature.token_is_max_context.items()
+                        if is_max and index < num_tokens]] = True
+    valid_start &= valid_end
+    return valid_start, valid_end
+
+
+def get_nbest_spans(start_logits, end_logits, valid_start, valid_end, n_best_size, max_answer_length):
+    """
+    Candidate spans of all the features at once: the pairs of the n_best_size best start and end positions of a feature
+    that are valid, not reversed and at most max_answer_length long.
+    Returns the feature, start and end index and the start and end logit of every candidate, in the order of
+    (feature, rank of the start, rank of the end).
+    """
+    n_best_size = min(n_best_size, start_logits.shape[1])
+    # a stable sort keeps the lower index first among equal logits
+    start_top = np.argsort(-start_logits, axis=1, kind="stable")[:, :n_best_size]
+    end_top = np.argsort(-end_logits, axis=1, kind="stable")[:, :n_best_size]
+    rows = np.arange(len(start_logits))[:, None]
+    starts = start_top[:, :, None]
+    ends = end_top[:, None, :]
+    mask = valid_start[rows, start_top][:, :, None] & valid_end[rows, end_top][:, None, :] & \
+        (ends >= starts) & (ends - starts + 1 <= max_answer_length)
+    feature_index, start_rank, end_rank = np.nonzero(mask)
+    start_index = start_top[feature_index, start_rank]
+    end_index = end_top[feature_index, end_rank]
+    return (feature_index, start_index, end_index, start_logits[feature_index, start_index],
+            end_logits[feature_index, end_index])
+
+
+def _span_text(example, feature, start_index, end_index, do_lower_case, verbose_logging):
+    tok_tokens = feature.tokens[start_index : (end_index + 1)]
+    orig_doc_start = feature.token_to_orig_map[start_index]
+    orig_doc_end = feature.token_to_orig_map[end_index]
+    orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
+    tok_text = " ".join(tok_tokens)
+
+    # De-tokenize WordPieces that have been split off.
+    tok_text = tok_text.replace(" ##", "")
+    tok_text = tok_text.replace("##", "")
+
+    # Clean whitespace
+    tok_text = tok_text.strip()
+    tok_text = " ".join(tok_text.split())
+    orig_text = " ".join(orig_tokens)
+    return get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+
+
+def decode_span_predictions(
+    examples,
+    features,
+    example_feature_positions,
+    start_logits,
+    end_logits,
     n_best_size,
     max_answer_length,
     do_lower_case,
-    output_prediction_file,
-    output_nbest_file,
-    output_null_log_odds_file,
     verbose_logging,
     version_2_with_negative,
     null_score_diff_threshold,
 ):
-    """Write final predictions to the json file and log-odds of null if needed."""
-    # logger.info("Writing predictions to: %s" % (output_prediction_file))
-    # logger.info("Writing nbest to: %s" % (output_nbest_file))
-    logging.info("start write prediction")
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        # example_index = example.guid
-        # every example has unique guid
-        example_index_to_features[feature.example_index].append(feature)
-    unique_id_to_result = {}
-    for result in all_results:
-        # every feature has unique id
-        # An example can have multiple features
-        unique_id_to_result[result.unique_id] = result
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"],
-    )
-
+    """
+    Batched n-best decoding of the examples.
+    start_logits and end_logits are [len(features), max_seq_length] arrays, row i holds the logits of features[i];
+    example_feature_positions[j] lists the positions in features of the features of examples[j].
+    The candidate spans of all the features are found with numpy (get_nbest_spans); only the text of the n-best
+    answers is built in python. Gives the same predictions as the former loop over features and n-best pairs.
+    Returns all_predictions, all_nbest_json and scores_diff_json keyed by example guid.
+    """
+    start_logits = np.asarray(start_logits, dtype=np.float64)
+    end_logits = np.asarray(end_logits, dtype=np.float64)
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
     scores_diff_json = collections.OrderedDict()
-    logging.info("start filtering answers")
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example.guid]
-        prelim_predictions = []
+    if len(examples) == 0:
+        return all_predictions, all_nbest_json, scores_diff_json
+
+    # position of every feature in its example
+    example_of_feature = np.full(len(features), -1, dtype=np.int64)
+    index_in_example = np.zeros(len(features), dtype=np.int64)
+    for example_position, positions in enumerate(example_feature_positions):
+        example_of_feature[positions] = example_position
+        index_in_example[positions] = np.arange(len(positions))
+
+    valid_start, valid_end = feature_span_masks(features, start_logits.shape[1])
+    feature_index, start_index, end_index, start_scores, end_scores = get_nbest_spans(
+        start_logits, end_logits, valid_start, valid_end, n_best_size, max_answer_length)
+    scores = start_scores + end_scores
+    candidate_example = example_of_feature[feature_index]
+    # sort by example, then by score, ties in the order the candidates of an example were generated
+    generation_order = index_in_example[feature_index] * (len(feature_index) + 1) + np.arange(len(feature_index))
+    order = np.lexsort((generation_order, -scores, candidate_example))
+    order = order[candidate_example[order] >= 0]
+    bounds = np.searchsorted(candidate_example[order], np.arange(len(examples) + 1))
+    null_scores = start_logits[:, 0] + end_logits[:, 0] if start_logits.shape[1] > 0 else np.zeros(len(features))
+
+    _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+        "NbestPrediction", ["text", "start_logit", "end_logit"]
+    )
+
+    for example_position, example in enumerate(examples):
+        positions = example_feature_positions[example_position]
+        candidates = order[bounds[example_position]: bounds[example_position + 1]].tolist()
         # keep track of the minimum score of null start+end of position 0
         score_null = 1000000  # large and positive
-        min_null_feature_index = 0  # the paragraph slice with min null score
         null_start_logit = 0  # the start logit at the slice with min null score
         null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
+        if version_2_with_negative and len(positions) > 0:
+            min_null_position = positions[int(np.argmin(null_scores[positions]))]
+            if null_scores[min_null_position] < score_null:
+                score_null = float(null_scores[min_null_position])
+                null_start_logit = float(start_logits[min_null_position, 0])
+                null_end_logit = float(end_logits[min_null_position, 0])
+
+        # (start_index, end_index, start_logit, end_logit, feature position) of the candidates by descending score;
+        # the null prediction goes after the candidates with the same score
+        prelim_predictions = [(int(start_index[c]), int(end_index[c]), float(start_scores[c]), float(end_scores[c]),
+                               int(feature_index[c])) for c in candidates]
         if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
-            )
-        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True,)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"]
-        )
+            insert_at = len(prelim_predictions)
+            for i, c in enumerate(candidates):
+                if scores[c] < null_start_logit + null_end_logit:
+                    insert_at = i
+                    break
+            prelim_predictions.insert(insert_at, (0, 0, null_start_logit, null_end_logit, None))
 
         seen_predictions = {}
         nbest = []
-        for pred in prelim_predictions:
+        for pred_start, pred_end, pred_start_logit, pred_end_logit, position in prelim_predictions:
             if len(nbest) >= n_best_size:
                 break
-            if pred.start_index > 0:  # this is a non-null prediction
-                feature = features[pred.feature_index]
-                tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
-                tok_text = " ".join(tok_tokens)
-                
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+            if pred_start > 0:  # this is a non-null prediction
+                final_text = _span_text(example, features[position], pred_start, pred_end, do_lower_case,
+                                        verbose_logging)
                 if final_text in seen_predictions:
                     continue
 
@@ -154,7 +176,7 @@ def write_predictions(
                 final_text = ""
                 seen_predictions[final_text] = True
 
-            nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit,))
+            nbest.append(_NbestPrediction(text=final_text, start_logit=pred_start_logit, end_logit=pred_end_logit,))
         # if we didn't include the empty option in the n-best, include it
         if version_2_with_negative:
             if "" not in seen_predictions:
@@ -204,6 +226,56 @@ def write_predictions(
             else:
                 all_predictions[example.guid] = best_non_null_entry.text
         all_nbest_json[example.guid] = nbest_json
+    return all_predictions, all_nbest_json, scores_diff_json
+
+
+def _stack_result_logits(all_features, all_results):
+    unique_id_to_result = {}
+    for result in all_results:
+        # every feature has unique id
+        # An example can have multiple features
+        unique_id_to_result[result.unique_id] = result
+    results = [unique_id_to_result[feature.unique_id] for feature in all_features]
+    # the logits of dynamically padded batches can be shorter, pad them with -inf that is never a best index
+    max_length = max([len(result.start_logits) for result in results], default=0)
+    start_logits = np.full((len(results), max_length), -np.inf, dtype=np.float64)
+    end_logits = np.full((len(results), max_length), -np.inf, dtype=np.float64)
+    for i, result in enumerate(results):
+        start_logits[i, :len(result.start_logits)] = result.start_logits
+        end_logits[i, :len(result.end_logits)] = result.end_logits
+    return start_logits, end_logits
+
+
+def write_predictions(
+    all_examples,
+    all_features,
+    all_results,
+    n_best_size,
+    max_answer_length,
+    do_lower_case,
+    output_prediction_file,
+    output_nbest_file,
+    output_null_log_odds_file,
+    verbose_logging,
+    version_2_with_negative,
+    null_score_diff_threshold,
+):
+    """Write final predictions to the json file and log-odds of null if needed."""
+    # logger.info("Writing predictions to: %s" % (output_prediction_file))
+    # logger.info("Writing nbest to: %s" % (output_nbest_file))
+    logging.info("start write prediction")
+    example_index_to_positions = collections.defaultdict(list)
+    for position, feature in enumerate(all_features):
+        # example_index = example.guid
+        # every example has unique guid
+        example_index_to_positions[feature.example_index].append(position)
+    start_logits, end_logits = _stack_result_logits(all_features, all_results)
+
+    logging.info("start filtering answers")
+    all_predictions, all_nbest_json, scores_diff_json = decode_span_predictions(
+        all_examples, all_features, [example_index_to_positions[example.guid] for example in all_examples],
+        start_logits, end_logits, n_best_size, max_answer_length, do_lower_case, verbose_logging,
+        version_2_with_negative, null_score_diff_threshold)
     logging.info("end filtering answers")
     with open(output_prediction_file, "w") as writer:
         writer.write(json.dumps(all_predictions, indent=4) + "\n")
@@ -219,6 +291,192 @@ def write_predictions(
 
 
 
+class _JsonDictStreamWriter(object):
+    """Writes a dict to a json file one item at a time, formatted as json.dump(d, f, indent=4) followed by a newline."""
+
+    def __init__(self, file_path):
+        self.file = open(file_path, "w")
+        self.count = 0
+
+    def write(self, key, value):
+        # strip the braces of a one item dict, leaves the indented "key": value
+        item = json.dumps({key: value}, indent=4)[2:-2]
+        self.file.write(("{\n" if self.count == 0 else ",\n") + item)
+        self.count += 1
+
+    def close(self):
+        self.file.write("{}\n" if self.count == 0 else "\n}\n")
+        self.file.close()
+
+    def abort(self):
+        # remove the unfinished file
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.file.name)
+
+
+class StreamingSpanDecoder(object):
+    """
+    Incremental version of write_predictions for an evaluation loop over the features in order.
+
+    add() takes the start/end logits of the next batch of features. They are kept in a preallocated
+    [rows, max_seq_length] buffer indexed by feature position, and as soon as all the features of an example
+    have been added the example is decoded (decode_span_predictions), its predictions are appended to the
+    prediction, nbest and null odds json files and its rows of the buffer are reused. Since the features of an
+    example are consecutive, the memory does not grow with the size of the test set.
+    The files are the same as the ones of write_predictions. If the evaluation fails, abort() closes and removes
+    the unfinished files.
+    """
+
+    def __init__(
+        self,
+        all_examples,
+        all_features,
+        max_seq_length,
+        n_best_size,
+        max_answer_length,
+        do_lower_case,
+        output_prediction_file,
+        output_nbest_file,
+        output_null_log_odds_file,
+        verbose_logging,
+        version_2_with_negative,
+        null_score_diff_threshold,
+        dtype=np.float32,
+        buffer_rows=1024,
+    ):
+        self.examples = all_examples
+        self.features = all_features
+        self.max_seq_length = max_seq_length
+        self.n_best_size = n_best_size
+        self.max_answer_length = max_answer_length
+        self.do_lower_case = do_lower_case
+        self.verbose_logging = verbose_logging
+        self.version_2_with_negative = version_2_with_negative
+        self.null_score_diff_threshold = null_score_diff_threshold
+
+        example_index_to_positions = collections.defaultdict(list)
+        for position, feature in enumerate(all_features):
+            # every example has unique guid
+            example_index_to_positions[feature.example_index].append(position)
+        self.example_positions = [example_index_to_positions[example.guid] for example in all_examples]
+        # an example is complete once the logits of its last feature are added, the buffer has to keep the rows
+        # from the first feature of the examples that are not complete yet
+        self.last_position = [max(positions, default=-1) for positions in self.example_positions]
+        self.first_pending_position = [len(all_features)] * (len(all_examples) + 1)
+        for i in range(len(all_examples) - 1, -1, -1):
+            self.first_pending_position[i] = min(self.example_positions[i] + [self.first_pending_position[i + 1]])
+
+        self.start_buffer = np.empty((buffer_rows, max_seq_length), dtype=dtype)
+        self.end_buffer = np.empty((buffer_rows, max_seq_length), dtype=dtype)
+        self.buffer_offset = 0  # feature position of the first row of the buffer
+        self.received = 0
+        self.next_example = 0
+
+        self.all_predictions = collections.OrderedDict()
+        self.scores_diff_json = collections.OrderedDict()
+        self.prediction_writer = None
+        self.nbest_writer = None
+        self.null_odds_writer = None
+        try:
+            self.prediction_writer = _JsonDictStreamWriter(output_prediction_file)
+            self.nbest_writer = _JsonDictStreamWriter(output_nbest_file)
+            if version_2_with_negative:
+                self.null_odds_writer = _JsonDictStreamWriter(output_null_log_odds_file)
+        except BaseException:
+            self.abort()
+            raise
+
+    def add(self, start_logits, end_logits):
+        """start_logits and end_logits are [batch size, sequence length] arrays of the next features."""
+        batch_size, length = start_logits.shape
+        self._reserve(batch_size)
+        rows = slice(self.received - self.buffer_offset, self.received - self.buffer_offset + batch_size)
+        # the logits of dynamically padded batches are shorter, -inf is never a best index
+        self.start_buffer[rows, length:] = -np.inf
+        self.end_buffer[rows, length:] = -np.inf
+        self.start_buffer[rows, :length] = start_logits
+        self.end_buffer[rows, :length] = end_logits
+        self.received += batch_size
+        self._decode_complete_examples()
+
+    def close(self):
+        """Finish the json files, returns all_predictions and scores_diff_json keyed by example guid."""
+        try:
+            # examples without features
+            self._decode_complete_examples()
+            if self.received != len(self.features) or self.next_example != len(self.examples):
+                raise Exception("got the logits of %d features, expected %d" % (self.received, len(self.features)))
+        except BaseException:
+            self.abort()
+            raise
+        for writer in self._writers():
+            writer.close()
+        return self.all_predictions, self.scores_diff_json
+
+    def abort(self):
+        """Close and remove the json files, for an evaluation that did not finish."""
+        for writer in self._writers():
+            writer.abort()
+
+    def _writers(self):
+        return [writer for writer in [self.prediction_writer, self.nbest_writer, self.null_odds_writer]
+                if writer is not None]
+
+    def _reserve(self, batch_size):
+        used = self.received - self.buffer_offset
+        if used + batch_size <= len(self.start_buffer):
+            return
+        # drop the rows of the decoded examples
+        keep_from = min(self.first_pending_position[self.next_example], self.received)
+        kept = slice(keep_from - self.buffer_offset, used)
+        used = self.received - keep_from
+        rows = max(len(self.start_buffer), used + batch_size)
+        if rows > len(self.start_buffer):
+            logging.info("growing the logits buffer to %d rows" % rows)
+            start_buffer = np.empty((rows, self.max_seq_length), dtype=self.start_buffer.dtype)
+            end_buffer = np.empty((rows, self.max_seq_length), dtype=self.end_buffer.dtype)
+        else:
+            start_buffer, end_buffer = self.start_buffer, self.end_buffer
+        start_buffer[:used] = self.start_buffer[kept]
+        end_buffer[:used] = self.end_buffer[kept]
+        self.start_buffer, self.end_buffer = start_buffer, end_buffer
+        self.buffer_offset = keep_from
+
+    def _decode_complete_examples(self):
+        begin = end = self.next_example
+        while end < len(self.examples) and self.last_position[end] < self.received:
+            end += 1
+        if end == begin:
+            return
+        positions = [position for example_positions in self.example_positions[begin:end]
+                     for position in example_positions]
+        low = min(positions, default=self.received)
+        high = max(positions, default=self.received - 1) + 1
+        all_predictions, all_nbest_json, scores_diff_json = decode_span_predictions(
+            self.examples[begin:end],
+            self.features[low:high],
+            [[position - low for position in example_positions]
+             for example_positions in self.example_positions[begin:end]],
+            self.start_buffer[low - self.buffer_offset: high - self.buffer_offset],
+            self.end_buffer[low - self.buffer_offset: high - self.buffer_offset],
+            self.n_best_size,
+            self.max_answer_length,
+            self.do_lower_case,
+            self.verbose_logging,
+            self.version_2_with_negative,
+            self.null_score_diff_threshold,
+        )
+        for guid, prediction in all_predictions.items():
+            self.all_predictions[guid] = prediction
+            self.prediction_writer.write(guid, prediction)
+            self.nbest_writer.write(guid, all_nbest_json[guid])
+            if self.null_odds_writer is not None:
+                self.scores_diff_json[guid] = scores_diff_json[guid]
+                self.null_odds_writer.write(guid, scores_diff_json[guid])
+        self.next_example = end
+
+
 def write_predictions_extended(
     all_examples,
     all_features,
@@ -704,169 +962,16 @@ def get_best_predictions(
     null_score_diff_threshold,
 ):
 
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
-
-    unique_id_to_result = {}
-    for result in all_results:
-        unique_id_to_result[result.unique_id] = result
+    example_index_to_positions = collections.defaultdict(list)
+    for position, feature in enumerate(all_features):
+        example_index_to_positions[feature.example_index].append(position)
+    start_logits, end_logits = _stack_result_logits(all_features, all_results)
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"],
-    )
-
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
-
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
-
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
-        min_null_feature_index = 0  # the paragraph slice with min null score
-        null_start_logit = 0  # the start logit at the slice with min null score
-        null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
-        if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
-            )
-        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True,)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"]
-        )
-
-        seen_predictions = {}
-        nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            if pred.start_index > 0:  # this is a non-null prediction
-                feature = features[pred.feature_index]
-                tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
-                tok_text = " ".join(tok_tokens)
-
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-                if final_text in seen_predictions:
-                    continue
-
-                seen_predictions[final_text] = True
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
-
-            nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit,))
-        # if we didn't include the empty option in the n-best, include it
-        if version_2_with_negative:
-            if "" not in seen_predictions:
-                nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
-
-            # In very rare edge cases we could only have single null prediction.
-            # So we just create a nonce prediction in this case to avoid failure.
-            if len(nbest) == 1:
-                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        best_non_null_entry = None
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1
-
-        if not version_2_with_negative:
-            all_predictions[example.guid] = nbest_json[0]["text"]
-        else:
-            # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
-            scores_diff_json[example.guid] = score_diff
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example.guid] = ""
-            else:
-                all_predictions[example.guid] = best_non_null_entry.text
-        all_nbest_json[example.guid] = nbest_json
+    all_predictions, all_nbest_json, scores_diff_json = decode_span_predictions(
+        all_examples, all_features, [example_index_to_positions[example_index]
+                                     for example_index in range(len(all_examples))],
+        start_logits, end_logits, n_best_size, max_answer_length, do_lower_case, verbose_logging,
+        version_2_with_negative, null_score_diff_threshold)
 
     all_best = [
         {